@@ -144,6 +144,9 @@ def create_app(
 
     app.celery.Task = ContextTask
 
+    # Index published tasks so their queue position can be looked up cheaply
+    from .extensions import queue_position  # NOQA
+
     if testing:
         return app
 
@@ -482,6 +482,25 @@ class HoustonModel(TimestampViewed, ElasticsearchModel):
             return self.user_is_owner(User.get_public_user())
         return False
 
+    @classmethod
+    def get_owned_by_filter(cls, user_guids):
+        """
+        SQL expression matching the rows ``user_is_owner()`` is true for, for any
+        of ``user_guids``, or ``None`` if ownership is not expressible in SQL
+        """
+        owner_guid = getattr(cls, 'owner_guid', None)
+        if owner_guid is None:
+            return None
+        return owner_guid.in_(list(user_guids))
+
+    @classmethod
+    def get_permitted_filter(cls, user_guids, action):
+        """
+        SQL expression matching the rows any of ``user_guids`` may perform ``action``
+        on through ownership, see ``ObjectActionRule.filter_query()``
+        """
+        return cls.get_owned_by_filter(user_guids)
+
     def current_user_has_view_permission(self):
         from app.modules.users.permissions.rules import ObjectActionRule
         from app.modules.users.permissions.types import AccessOperation
@@ -603,7 +622,13 @@ db.JSON = JSON
 
 
 def parallel(
-    worker_func, args_list, kwargs_list=None, thread=True, workers=None, desc=None
+    worker_func,
+    args_list,
+    kwargs_list=None,
+    thread=True,
+    workers=None,
+    desc=None,
+    callback=None,
 ):
     import multiprocessing
     from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
@@ -633,6 +658,9 @@ def parallel(
         for future in tqdm.tqdm(futures):
             result = future.result()
             results.append(result)
+            # Called from the calling thread, in order, as each result is collected
+            if callback is not None:
+                callback(len(results), len(futures))
 
         pool.shutdown(True)
 
@@ -44,6 +44,9 @@ if is_extension_enabled('prometheus'):
 
 # Register Module-level tasks
 
+if is_module_enabled('assets'):
+    import app.modules.assets.tasks  # noqa
+
 if is_module_enabled('asset_groups'):
     import app.modules.asset_groups.tasks  # noqa
 
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 """ Client initialization for Elasticsearch """
+import base64
 import datetime
 import enum
+import hashlib
+import hmac
 import json
 import logging
 import pprint
@@ -31,10 +34,19 @@ if not is_extension_enabled('elasticsearch'):
 ENABLED = True
 TESTING_PREFIX = 'testing'
 REGISTERED_MODELS = {}
+# Positive cache of GUIDs known to exist in the database, by model class, as
+# {guid: expiry time}.  The cache is per process, GUIDs are only added once committed
+# and expire so that deletions made by other processes are eventually seen
+GUID_CACHE = {}
+GUID_CACHE_TTL = 60
+GUID_CACHE_PURGE = {'next': 0}
 
 CELERY_VERIFY_TIMEOUT = 60.0
 CELERY_ASYNC_PROMISES = []
 
+ELASTICSEARCH_INDEX_ALL_CHUNK_SIZE = 1000
+ELASTICSEARCH_EXISTS_CHUNK_SIZE = 10000
+
 ELASTICSEARCH_SORTING_PREFIX = 'elasticsearch.'
 
 MAX_UNICODE_CODE_POINT_CHAR = chr(int(hex(sys.maxunicode), 16))
@@ -58,6 +70,17 @@ class ElasticsearchModel(object):
     def get_elasticsearch_settings(cls):
         return None
 
+    @classmethod
+    def get_elasticsearch_load_options(cls):
+        # SQLAlchemy loader options (e.g., selectinload) for the relationships that
+        # get_elasticsearch_schema() walks, used when loading objects in bulk
+        return []
+
+    @classmethod
+    def get_elasticsearch_search_load_options(cls):
+        # SQLAlchemy loader options applied to search results when load=True
+        return []
+
     @classmethod
     def patch_elasticsearch_mappings(cls, mappings):
         # Check all fields that are GUIDs or "IDs"
@@ -103,7 +126,16 @@ class ElasticsearchModel(object):
         return es_index_name(cls)
 
     @classmethod
-    def index_all(cls, app=None, prune=True, pit=False, update=True, force=False):
+    def index_all(
+        cls,
+        app=None,
+        prune=True,
+        pit=False,
+        update=True,
+        force=False,
+        chunked=False,
+        chunk_size=ELASTICSEARCH_INDEX_ALL_CHUNK_SIZE,
+    ):
         index = cls._index()
 
         es_index_mappings_patch(cls, app=app)
@@ -165,11 +197,52 @@ class ElasticsearchModel(object):
                 )
                 quiet = len(guids) < 100
 
+                if chunked:
+                    # Stream the objects in chunks directly into the bulk indexer
+                    if len(guids) == len(all_guids):
+                        guids = None
+                    cls._index_all_chunked(
+                        guids, app=app, force=force, chunk_size=chunk_size
+                    )
+                    return
+
                 # Load all objects and index
                 objs = cls.query.filter(cls.guid.in_(guids)).order_by(cls.guid).all()
                 for obj in tqdm.tqdm(objs, desc=desc, disable=quiet):
                     obj.index(app=app, force=force)
 
+    @classmethod
+    def _index_all_chunked(
+        cls,
+        guids=None,
+        app=None,
+        force=False,
+        chunk_size=ELASTICSEARCH_INDEX_ALL_CHUNK_SIZE,
+    ):
+        """
+        Index objects chunk-by-chunk, bypassing the session's bulk tracking so that
+        only one chunk of ORM objects is ever held in memory.  If ``guids`` is None,
+        the entire table is paged through by GUID (keyset pagination).
+        """
+        if is_disabled() or session.in_skip_mode():
+            return 0
+
+        total = 0 if guids is None else len(guids)
+        desc = 'Indexing (Chunked) {}'.format(cls.__name__)
+        quiet = guids is not None and total < 100
+
+        succeeded = 0
+        with tqdm.tqdm(total=total or None, desc=desc, disable=quiet) as progress:
+            for objs in es_iter_chunks(cls, guids=guids, chunk_size=chunk_size):
+                items = [(obj, force) for obj in objs]
+                succeeded += session._es_index_bulk(cls, items, app=app, parallel=True)
+                progress.update(len(items))
+
+                # Drop our references so the (weak) identity map can release the chunk
+                del items, objs
+
+        return succeeded
+
     @classmethod
     def prune_all(cls, app=None):
         index = cls._index()
@@ -231,6 +304,21 @@ class ElasticsearchModel(object):
 
         return response
 
+    @classmethod
+    def elasticsearch_cursor(cls, search, cursor=None, app=None, *args, **kwargs):
+        body = {}
+
+        if search is None:
+            search = {}
+
+        if len(search) > 0:
+            body['query'] = search
+
+        with session.begin():
+            response = es_elasticsearch_cursor(app, cls, body, cursor, *args, **kwargs)
+
+        return response
+
     @classmethod
     def bulk_class(cls):
         from app.extensions.git_store import GitStore
@@ -613,10 +701,9 @@ class ElasticSearchBulkOperation(object):
             return total
 
         # We only update the indexed timestamps of the objects that succeded as a group
-        all_guids = cls.query.with_entities(cls.guid).all()
-        all_guids = {str(item[0]) for item in all_guids}
-
-        invalid_guids = set(pending) & all_guids
+        pending_guids = [uuid.UUID(str(guid)) for guid in pending]
+        existing_guids = es_existing_guids(cls, pending_guids, app=app)
+        invalid_guids = {str(guid) for guid in existing_guids}
         if len(invalid_guids) > 0:
             if ELASTICSEARCH_VERBOSE:
                 log.info('Invalidating (Bulk) {}'.format(cls.__name__))
@@ -1433,6 +1520,89 @@ def es_pit(cls, app=None):
     return pit_id
 
 
+def es_guid_cache_enabled(app=None):
+    from flask import current_app
+
+    if app is None:
+        app = current_app
+
+    return app.config.get('ELASTICSEARCH_GUID_CACHE', False)
+
+
+def es_guid_cache_store(cache, guids):
+    """
+    Remember ``guids`` in the GUID ``cache`` of a class, once the current transaction
+    (which may have created them) is committed
+    """
+    guids = list(guids)
+
+    def store():
+        now = time.time()
+        expires = now + GUID_CACHE_TTL
+        for guid in guids:
+            cache[guid] = expires
+
+        if now >= GUID_CACHE_PURGE['next']:
+            # Drop the expired GUIDs every so often so the cache does not keep growing
+            GUID_CACHE_PURGE['next'] = expires
+            for cache_ in GUID_CACHE.values():
+                expired = [guid for guid, expires_ in cache_.items() if expires_ <= now]
+                for guid in expired:
+                    cache_.pop(guid, None)
+
+    if guids:
+        db.on_commit(store)
+
+
+def es_guid_cache_add(obj):
+    for cls, cache in GUID_CACHE.items():
+        if isinstance(obj, cls):
+            es_guid_cache_store(cache, [obj.guid])
+
+
+def es_guid_cache_discard(obj):
+    # Discarded right away, a rolled back deletion only costs a database check
+    for cls, cache in GUID_CACHE.items():
+        if isinstance(obj, cls):
+            cache.pop(obj.guid, None)
+
+
+def es_guid_cache_clear():
+    GUID_CACHE.clear()
+
+
+def es_existing_guids(cls, guids, app=None, chunk_size=ELASTICSEARCH_EXISTS_CHUNK_SIZE):
+    """
+    Return the subset of ``guids`` that exist in the database for ``cls``.  Only the
+    given GUIDs are queried (in chunks of ``IN (...)``), and GUIDs already in the
+    positive GUID cache (if enabled, entries expire after ``GUID_CACHE_TTL`` seconds)
+    are not queried at all.
+    """
+    guids = set(guids)
+
+    if es_guid_cache_enabled(app=app):
+        cache = GUID_CACHE.setdefault(cls, {})
+    else:
+        cache = None
+
+    if cache is None:
+        existing = set()
+    else:
+        now = time.time()
+        existing = {guid for guid in guids if cache.get(guid, 0) > now}
+
+    unknown = sorted(guids - existing)
+    found = set()
+    for chunk in ut.ichunks(unknown, chunk_size):
+        rows = cls.query.filter(cls.guid.in_(chunk)).with_entities(cls.guid).all()
+        found |= {row[0] for row in rows}
+
+    if cache is not None:
+        es_guid_cache_store(cache, found)
+
+    return existing | found
+
+
 def es_status(app=None, outdated=True, missing=False, active=True, health=True):
     from flask import current_app
 
@@ -1696,6 +1866,12 @@ def attach_listeners(app):
             log.error('ES index delete failed for {!r}'.format(obj))
             raise
 
+    def _after_insert(mapper, connection, obj):
+        es_guid_cache_add(obj)
+
+    def _after_delete(mapper, connection, obj):
+        es_guid_cache_discard(obj)
+
     def _create_transaction(db_session, db_transaction):
         session.begin().enter()
 
@@ -1711,12 +1887,41 @@ def attach_listeners(app):
             listen(cls, 'before_insert', _before_insert_or_update, propagate=True)
             listen(cls, 'before_update', _before_insert_or_update, propagate=True)
             listen(cls, 'before_delete', _before_delete, propagate=True)
+            listen(cls, 'after_insert', _after_insert, propagate=True)
+            listen(cls, 'after_delete', _after_delete, propagate=True)
             REGISTERED_MODELS[cls]['status'] = True
 
     listen(db.session, 'after_transaction_create', _create_transaction, propagate=True)
     listen(db.session, 'after_transaction_end', _end_transaction, propagate=True)
 
 
+def es_iter_chunks(cls, guids=None, chunk_size=ELASTICSEARCH_INDEX_ALL_CHUNK_SIZE):
+    """
+    Yield lists of at most ``chunk_size`` objects, ordered by GUID, with the class's
+    Elasticsearch loader options applied.  If ``guids`` is None, the whole table is
+    walked with keyset pagination (``guid > last_guid``) instead of OFFSET.
+    """
+    query = cls.query.options(*cls.get_elasticsearch_load_options())
+
+    if guids is None:
+        last_guid = None
+        while True:
+            chunk_query = query
+            if last_guid is not None:
+                chunk_query = chunk_query.filter(cls.guid > last_guid)
+            objs = chunk_query.order_by(cls.guid).limit(chunk_size).all()
+            if len(objs) == 0:
+                break
+            yield objs
+            last_guid = objs[-1].guid
+    else:
+        guids = sorted(guids)
+        for chunk in ut.ichunks(guids, chunk_size):
+            objs = query.filter(cls.guid.in_(chunk)).order_by(cls.guid).all()
+            if len(objs) > 0:
+                yield objs
+
+
 def es_index_all(*args, **kwargs):
     for cls in REGISTERED_MODELS:
         cls.index_all(*args, **kwargs)
@@ -1828,20 +2033,18 @@ def es_elasticsearch(
         guid = uuid.UUID(hit['_id'])
         hit_guids.append(guid)
 
-    # Get all possible corect matches
-    all_guids = cls.query.with_entities(cls.guid).all()
-    all_guids = {item[0] for item in all_guids}
+    # Only verify the hit GUIDs against the database, not the entire table
+    existing_guids = es_existing_guids(cls, hit_guids, app=app)
 
-    if filter_guids is None:
-        filter_guids = all_guids
-    filter_guids = set(filter_guids)
+    if filter_guids is not None:
+        filter_guids = set(filter_guids)
 
     # Cross reference with ES hit GUIDs
     search_guids = []
     search_prune = []
     for guid in hit_guids:
-        if guid in all_guids:
-            if guid in filter_guids:
+        if guid in existing_guids:
+            if filter_guids is None or guid in filter_guids:
                 search_guids.append(guid)
         else:
             search_prune.append(guid)
@@ -1920,16 +2123,9 @@ def es_elasticsearch(
     query = query.filter(cls.guid.in_(search_guids))
 
     if pre_sorted:
-        # We pre-sorted, so let's do all filtering on the GUIDs here since the query is being broken up here
-        query = query.with_entities(cls.guid)
-
-        houston_guids = query.all()
-        houston_guids = {local_result[0] for local_result in houston_guids}
-
-        elasticsearch_guids = []
-        for search_guid in search_guids:
-            if search_guid in houston_guids:
-                elasticsearch_guids.append(search_guid)
+        # We pre-sorted, the search GUIDs are already known to exist in the database
+        # (es_existing_guids above), keep them in the Elasticsearch order
+        elasticsearch_guids = list(search_guids)
 
         if offset is not None:
             offset = max(0, min(offset, len(elasticsearch_guids)))
@@ -1943,9 +2139,16 @@ def es_elasticsearch(
             elasticsearch_guids = elasticsearch_guids[::-1]
 
         if load:
+            # Fetch the whole page in one query, then restore the Elasticsearch order
+            objs = (
+                cls.query.options(*cls.get_elasticsearch_search_load_options())
+                .filter(cls.guid.in_(elasticsearch_guids))
+                .all()
+            )
+            objs = {obj.guid: obj for obj in objs}
             results = []
             for elasticsearch_guid in elasticsearch_guids:
-                obj = cls.query.get(elasticsearch_guid)
+                obj = objs.get(elasticsearch_guid, None)
                 if (
                     obj
                 ):  # This should always be True since we have already filtered on the DB
@@ -1956,6 +2159,10 @@ def es_elasticsearch(
         # We are performing a Houston-forward SQL query, so let's stay within SQLalchemy for as long as possible
         query = query.order_by(sort_func_1(), sort_func_2()).offset(offset).limit(limit)
 
+        if load:
+            # Before from_self(), so that the options apply to the loaded entity
+            query = query.options(*cls.get_elasticsearch_search_load_options())
+
         if reverse_after:
             after_sort_func_1 = sort_column.asc if reverse else sort_column.desc
             after_sort_func_2 = default_column.asc if reverse else default_column.desc
@@ -1976,6 +2183,180 @@ def es_elasticsearch(
         return results
 
 
+class ElasticsearchCursorExpired(ValueError):
+    """The point-in-time of a cursor is gone, the search has to be restarted"""
+
+
+def es_cursor_signature(payload, app=None):
+    from flask import current_app
+
+    if app is None:
+        app = current_app
+
+    key = app.config['SECRET_KEY']
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return hmac.new(key, payload, hashlib.sha256).hexdigest()
+
+
+def es_encode_cursor(data, app=None):
+    """
+    Serialize ``data`` into an opaque cursor, signed with the app's secret key so
+    a client cannot hand back a point-in-time or index it was not given
+    """
+    payload = json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    cursor = {
+        'data': base64.urlsafe_b64encode(payload).decode('ascii'),
+        'signature': es_cursor_signature(payload, app=app),
+    }
+    cursor = json.dumps(cursor, sort_keys=True, separators=(',', ':'))
+    return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+
+
+def es_decode_cursor(cursor, index=None, app=None):
+    try:
+        cursor_ = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        cursor_ = json.loads(cursor_.decode('utf-8'))
+        assert isinstance(cursor_, dict)
+        payload = base64.urlsafe_b64decode(cursor_['data'].encode('ascii'))
+        signature = es_cursor_signature(payload, app=app)
+        assert hmac.compare_digest(signature, cursor_['signature'])
+        data = json.loads(payload.decode('utf-8'))
+        assert isinstance(data, dict)
+        assert isinstance(data.get('pit'), str)
+        assert isinstance(data.get('search_after'), list)
+        assert index is None or data.get('index') == index
+    except Exception:
+        raise ValueError('Invalid Elasticsearch cursor {!r}'.format(cursor))
+    return data
+
+
+def es_elasticsearch_cursor(
+    app,
+    cls,
+    body,
+    cursor=None,
+    prune=True,
+    load=True,
+    limit=100,
+    sort='guid',
+    reverse=False,
+):
+    """
+    Page through a search with ``search_after`` on the class's point-in-time (PIT),
+    fetching only ``limit`` hits per call regardless of how deep the page is.
+
+    Returns a tuple of ``(next_cursor, results)``.  The cursor is opaque to the
+    caller and should be passed back (with the same search body) to get the next
+    page; it is None once the search is exhausted.  Cursors are signed and bound to
+    the index, a tampered cursor or one for another index raises a ValueError and a
+    cursor whose PIT has expired raises ElasticsearchCursorExpired.
+    """
+    from flask import current_app
+
+    if app is None:
+        app = current_app
+
+    index = es_index_name(cls, app=app)
+
+    if index is None or not es_index_exists(index, app=app):
+        return None, []
+
+    assert isinstance(body, dict)
+    assert limit is not None and limit > 0
+
+    if cursor is None:
+        pit_id = REGISTERED_MODELS.get(cls, {}).get('pit', None)
+        search_after = None
+    else:
+        data = es_decode_cursor(cursor, index=index, app=app)
+        pit_id = data.get('pit', None)
+        search_after = data['search_after']
+        sort = data.get('sort', sort)
+        reverse = data.get('reverse', reverse)
+
+    es_sort_term = sort.replace(ELASTICSEARCH_SORTING_PREFIX, '')
+    es_sort_order = 'desc' if reverse else 'asc'
+    es_sort = [{es_sort_term: {'order': es_sort_order}}]
+    if es_sort_term != 'guid':
+        es_sort.append({'guid': {'order': es_sort_order}})
+
+    body = dict(body)
+    body['_source'] = False
+    body['size'] = limit
+    body['sort'] = es_sort
+    body['track_total_hits'] = False
+    body['pit'] = {
+        'id': pit_id,
+        'keep_alive': '1d',
+    }
+    if search_after is not None:
+        body['search_after'] = search_after
+
+    # The registered PIT is shared by every other client, so it is never re-opened
+    # (closed) from here: a new search without a usable one gets a private PIT and a
+    # resumed search whose PIT has expired (or been replaced) has to be restarted
+    resp = None
+    if pit_id is not None:
+        try:
+            resp = app.es.search(body=body)
+        except elasticsearch.exceptions.NotFoundError:
+            if search_after is not None:
+                raise ElasticsearchCursorExpired('Elasticsearch cursor has expired')
+    if resp is None:
+        resp = app.es.open_point_in_time(index, keep_alive=body['pit']['keep_alive'])
+        body['pit']['id'] = resp.get('id', None)
+        resp = app.es.search(body=body)
+
+    pit_id = resp.get('pit_id', body['pit']['id'])
+    hits = resp.get('hits', {}).get('hits', [])
+
+    if len(hits) < limit:
+        next_cursor = None
+    else:
+        next_cursor = es_encode_cursor(
+            {
+                'index': index,
+                'pit': pit_id,
+                'search_after': hits[-1]['sort'],
+                'sort': sort,
+                'reverse': reverse,
+            },
+            app=app,
+        )
+
+    hit_guids = [uuid.UUID(hit['_id']) for hit in hits]
+    existing_guids = es_existing_guids(cls, hit_guids, app=app)
+    search_guids = [guid for guid in hit_guids if guid in existing_guids]
+    search_prune = [guid for guid in hit_guids if guid not in existing_guids]
+
+    if prune and len(search_prune) > 0:
+        with session.begin():
+            log.warning(
+                'Found %d items to prune for class %r after cursor search in %r'
+                % (
+                    len(search_prune),
+                    cls,
+                    index,
+                )
+            )
+            for guid in search_prune:
+                es_delete_guid(cls, guid, app=app)
+
+    if load:
+        objs = (
+            cls.query.options(*cls.get_elasticsearch_search_load_options())
+            .filter(cls.guid.in_(search_guids))
+            .all()
+        )
+        objs = {obj.guid: obj for obj in objs}
+        results = [objs[guid] for guid in search_guids if guid in objs]
+    else:
+        results = search_guids
+
+    return next_cursor, results
+
+
 def init_app(app, **kwargs):
     # pylint: disable=unused-argument
     """
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Input arguments (Parameters) for Elasticsearch resources RESTful API
+--------------------------------------------------------------------
+"""
+
+from flask_marshmallow import base_fields
+from marshmallow import validate
+
+from flask_restx_patched import Parameters
+
+
+class CursorParameters(Parameters):
+    """
+    Cursor-based (search_after) pagination, which stays flat in cost however deep
+    the client pages.
+    """
+
+    cursor = base_fields.String(
+        description='the opaque cursor returned in X-Next-Cursor by the previous page',
+        required=False,
+    )
+    limit = base_fields.Integer(
+        description='limit a number of items (allowed range is 1-100)',
+        missing=100,
+        validate=validate.Range(min=1, max=100),
+    )
+    sort = base_fields.String(
+        description='the Elasticsearch field to sort the results by (ignored with a cursor)',
+        missing='guid',
+    )
+    reverse = base_fields.Boolean(
+        description='the field to reverse the sorted results (ignored with a cursor)',
+        missing=False,
+    )
@@ -6,11 +6,16 @@ RESTful API User resources
 """
 
 import logging
+from http import HTTPStatus
+
+from flask import request
 
 from app.extensions import is_extension_enabled
-from app.extensions.api import Namespace
+from app.extensions.api import Namespace, abort
 from flask_restx_patched import Resource
 
+from . import parameters
+
 log = logging.getLogger(__name__)
 api = Namespace('search', description='Searching via Elasticsearch')
 
@@ -35,6 +40,51 @@ class ElasticsearchMappings(Resource):
         return mappings
 
 
+def _cursor_search(index, args, search):
+    from app.extensions import elasticsearch as es
+    from app.modules.users.permissions import rules
+    from app.modules.users.permissions.types import AccessOperation
+
+    cls = es.es_index_class(index)
+    if cls is None or cls not in es.REGISTERED_MODELS:
+        abort(HTTPStatus.NOT_FOUND, 'Index {!r} is not searchable'.format(index))
+
+    if not rules.ModuleActionRule(cls, AccessOperation.READ).check():
+        abort(code=HTTPStatus.FORBIDDEN)
+
+    try:
+        cursor, guids = cls.elasticsearch_cursor(search, load=False, **args)
+    except es.ElasticsearchCursorExpired as ex:
+        abort(HTTPStatus.GONE, str(ex))
+    except ValueError as ex:
+        abort(HTTPStatus.BAD_REQUEST, str(ex))
+
+    headers = {}
+    if cursor is not None:
+        headers['X-Next-Cursor'] = cursor
+
+    return [str(guid) for guid in guids], HTTPStatus.OK, headers
+
+
+@api.route('/<string:index>/cursor')
+@api.login_required(oauth_scopes=['search:read'])
+class ElasticsearchCursor(Resource):
+    """
+    Page through an index with an opaque cursor (Elasticsearch search_after on a
+    point-in-time), returning the GUIDs of each page and the next cursor in the
+    X-Next-Cursor header.
+    """
+
+    @api.parameters(parameters.CursorParameters(), locations=('query',))
+    def get(self, args, index):
+        return _cursor_search(index, args, {})
+
+    @api.parameters(parameters.CursorParameters(), locations=('query',))
+    def post(self, args, index):
+        search = request.get_json()
+        return _cursor_search(index, args, search)
+
+
 @api.route('/status')
 @api.login_required(oauth_scopes=['search:read'])
 class ElasticsearchStatus(Resource):
@@ -47,7 +47,7 @@ def es_task_refresh_index_all(force=False):
     # Re-index everything
     try:
         with es.session.begin(blocking=True, verify=True):
-            es.es_index_all(app=current_app)
+            es.es_index_all(app=current_app, chunked=True)
     except Exception:
         log.info('Elasticsearch Index All session failed to verify')
 
@@ -3,10 +3,16 @@
 Flask-SQLAlchemy adapter
 ------------------------
 """
+import logging
 import uuid
 
 from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
-from sqlalchemy import MetaData
+from sqlalchemy import MetaData, event
+
+log = logging.getLogger(__name__)
+
+# Session.info key of the callbacks waiting for the current transaction to commit
+ON_COMMIT_CALLBACKS_KEY = 'on_commit_callbacks'
 
 
 class AlembicDatabaseMigrationConfig(object):
@@ -52,6 +58,9 @@ class SQLAlchemy(BaseSQLAlchemy):
         )
         super(SQLAlchemy, self).__init__(*args, **kwargs)
 
+        event.listen(self.session, 'after_commit', self._after_commit)
+        event.listen(self.session, 'after_rollback', self._after_rollback)
+
     def init_app(self, app):
         super(SQLAlchemy, self).init_app(app)
 
@@ -61,3 +70,39 @@ class SQLAlchemy(BaseSQLAlchemy):
         app.extensions['migrate'] = AlembicDatabaseMigrationConfig(
             self, compare_type=True
         )
+
+    def on_commit(self, callback):
+        """
+        Call ``callback()`` once the current transaction is committed, or right away
+        when there is no transaction in progress.  The callback is dropped if the
+        transaction is rolled back.
+
+        Used to publish changes outside of the database (e.g. shared caches) only
+        once other processes can read them.
+        """
+        session = self.session()
+        transaction = session.transaction
+        if transaction is None or not transaction.is_active:
+            callback()
+            return
+        session.info.setdefault(ON_COMMIT_CALLBACKS_KEY, []).append(callback)
+
+    def has_on_commit(self, callback):
+        """
+        Whether ``callback`` is waiting for the current transaction to commit
+        """
+        return callback in self.session().info.get(ON_COMMIT_CALLBACKS_KEY, [])
+
+    @staticmethod
+    def _after_commit(session):
+        # Only called for the outermost transaction, not for subtransactions
+        callbacks = session.info.pop(ON_COMMIT_CALLBACKS_KEY, [])
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:  # pragma: no cover
+                log.exception('On commit callback %r failed' % (callback,))
+
+    @staticmethod
+    def _after_rollback(session):
+        session.info.pop(ON_COMMIT_CALLBACKS_KEY, None)
@@ -11,11 +11,11 @@ import logging
 import os
 import pathlib
 import shutil
+import threading
 import uuid
 
 import git
 import requests.exceptions
-import tqdm
 import utool as ut
 from flask import current_app, render_template, request, session  # NOQA
 from flask_login import current_user  # NOQA
@@ -34,21 +34,152 @@ KEYWORD_SET = set(keyword.kwlist)
 log = logging.getLogger(__name__)
 
 
-def compute_xxhash64_digest_filepath(filepath):
+XXHASH64_CHUNK_SIZE = 2 ** 20  # 1 MiB
+
+DERIVED_FORMATS_CHUNK_SIZE = 50
+
+# Sidecar (in the un-committed _derived/ folder) of digests keyed on file stats
+DIGEST_CACHE_FILENAME = '.xxhash64.json'
+
+_magic_local = threading.local()
+
+
+def compute_xxhash64_digest_filepath(
+    filepath, chunk_size=XXHASH64_CHUNK_SIZE, use_mmap=False
+):
     try:
+        import mmap
         import os
 
         import xxhash
 
         assert os.path.exists(filepath)
 
+        # Stream the file so memory does not grow with the size of the asset
+        hasher = xxhash.xxh64()
         with open(filepath, 'rb') as file_:
-            digest = xxhash.xxh64_hexdigest(file_.read())
+            size = os.fstat(file_.fileno()).st_size
+            if use_mmap and size > 0:
+                # Hash zero-copy views of the mapped file, skipping a read() per chunk
+                with mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    with memoryview(mapped) as view:
+                        for offset in range(0, size, chunk_size):
+                            hasher.update(view[offset : offset + chunk_size])
+            else:
+                for chunk in iter(lambda: file_.read(chunk_size), b''):
+                    hasher.update(chunk)
+        digest = hasher.hexdigest()
     except Exception:  # pragma: no cover
         digest = None
     return digest
 
 
+def get_digest_cache_key(filepath):
+    # Any rewrite of the file changes at least one of these
+    stat = os.stat(filepath)
+    return '%d:%d:%d' % (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def load_digest_cache(cache_filepath):
+    try:
+        with open(cache_filepath, 'r') as cache_file:
+            digest_cache = json.load(cache_file)
+        assert isinstance(digest_cache, dict)
+    except (OSError, ValueError, AssertionError):
+        digest_cache = {}
+    return digest_cache
+
+
+def save_digest_cache(cache_filepath, digest_cache):
+    # Write to a temporary file and rename so readers never see a partial cache
+    temp_filepath = '%s.%s.tmp' % (cache_filepath, uuid.uuid4().hex)
+    try:
+        with open(temp_filepath, 'w') as cache_file:
+            json.dump(digest_cache, cache_file)
+        os.replace(temp_filepath, cache_filepath)
+    except OSError:  # pragma: no cover
+        log.warning('Could not save digest cache %r' % (cache_filepath,))
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+
+
+def compute_xxhash64_digests_cached(
+    filepath_list, cache_filepath=None, use_mmap=False, callback=None
+):
+    """
+    Compute the xxHash64 digest of every file, re-using cached digests for any
+    file whose (inode, size, mtime) is unchanged since it was last hashed
+
+    The cache is rewritten with only the given files so it does not grow with
+    files that have since been removed.
+    """
+    digest_cache = load_digest_cache(cache_filepath) if cache_filepath else {}
+
+    cache_keys, digests, pending = [], [], []
+    for index, filepath in enumerate(filepath_list):
+        try:
+            cache_key = get_digest_cache_key(filepath)
+        except OSError:  # pragma: no cover
+            cache_key = None
+        cache_keys.append(cache_key)
+        digests.append(digest_cache.get(cache_key))
+        if digests[index] is None:
+            pending.append(index)
+
+    log.info(
+        'Hashing %d files (%d cached digests re-used)'
+        % (len(pending), len(filepath_list) - len(pending))
+    )
+
+    if pending:
+        pending_digests = parallel(
+            compute_xxhash64_digest_filepath,
+            [(filepath_list[index],) for index in pending],
+            kwargs_list=[{'use_mmap': use_mmap}] * len(pending),
+            callback=callback,
+        )
+        for index, digest in zip(pending, pending_digests):
+            digests[index] = digest
+    elif callback is not None:
+        callback(0, 0)
+
+    if cache_filepath:
+        digest_cache = {
+            cache_key: digest
+            for cache_key, digest in zip(cache_keys, digests)
+            if None not in [cache_key, digest]
+        }
+        save_digest_cache(cache_filepath, digest_cache)
+
+    return digests
+
+
+def _get_magic_instances():
+    import magic
+
+    # libmagic handles are not safe to share across threads, so keep one pair per thread
+    if not hasattr(_magic_local, 'instances'):
+        _magic_local.instances = (magic.Magic(mime=True), magic.Magic())
+    return _magic_local.instances
+
+
+def inspect_upload_filepath(filepath, mime_type_whitelist):
+    """
+    Sniff the MIME type and magic signature of a single uploaded file
+
+    Returns a tuple of ``(mime_type, magic_signature, size_bytes)``, where the
+    magic signature and size are ``None`` if the MIME type is not whitelisted.
+    Safe to call from a worker thread (does not touch the app or database).
+    """
+    magic_mime, magic_signature = _get_magic_instances()
+
+    mime_type = magic_mime.from_file(filepath)
+    if mime_type not in mime_type_whitelist:
+        return mime_type, None, None
+
+    return mime_type, magic_signature.from_file(filepath), os.path.getsize(filepath)
+
+
 class _Git(BaseGit):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -447,6 +578,9 @@ class GitStore(db.Model, HoustonModel):
             # We need the progress to be set to at least 99% at this point
             self.post_preparation_hook()
 
+            # Build the derived images in the background, ahead of the first viewer
+            self.make_derived_formats_delay()
+
         if self.progress_preparation and update:
             self.progress_preparation.set(100)
 
@@ -454,6 +588,23 @@ class GitStore(db.Model, HoustonModel):
         # Currently no hook
         pass
 
+    def make_derived_formats_delay(self, chunk_size=DERIVED_FORMATS_CHUNK_SIZE):
+        asset_guids = [
+            str(asset.guid) for asset in self.assets if asset.is_mime_type_major('image')
+        ]
+        if not asset_guids:
+            return
+
+        from app.modules.assets.tasks import make_derived_formats
+
+        # Fan the assets out over several tasks so workers can share a large group
+        for asset_guid_chunk in ut.ichunks(asset_guids, chunk_size):
+            if current_app.testing:
+                # When testing, run on-demand and don't use celery workers
+                make_derived_formats(asset_guid_chunk)
+            else:
+                make_derived_formats.delay(asset_guid_chunk)
+
     def git_commit_delay(self, input_filenames):
         # Start the git_commit that will process the assets (update=True) and commit the new files to the Git repo (commit=True)
         description = 'Tus collect commit for GitStore {!r}'.format(self.guid)
@@ -869,6 +1020,24 @@ class GitStore(db.Model, HoustonModel):
         ]
         pass
 
+    def _progress_preparation_callback(self, start, end):
+        """
+        Build a ``parallel()`` callback that maps completed work onto the
+        ``[start, end]`` percentage range of the preparation progress
+        """
+        last = [None]
+
+        def _callback(completed, total):
+            if not self.progress_preparation or total <= 0:
+                return
+            value = int(start + (end - start) * completed / total)
+            # Only update when the whole percentage moves, writes are also coalesced
+            if value != last[0]:
+                last[0] = value
+                self.progress_preparation.set(value, coalesce=True)
+
+        return _callback
+
     def update_asset_symlinks(
         self, existing_filepath_guid_mapping={}, input_filenames=[]
     ):
@@ -889,7 +1058,6 @@ class GitStore(db.Model, HoustonModel):
         try:
             assert self.exists
 
-            import magic
             import utool as ut
 
             # Step 3.1
@@ -901,7 +1069,16 @@ class GitStore(db.Model, HoustonModel):
             local_name_path = os.path.join(local_store_path, '_uploads')
             local_assets_path = os.path.join(local_store_path, '_assets')
 
-            # Walk the local store path, looking for white-listed MIME type files
+            # Map stored (hashed) upload filenames back to their original input filenames
+            from app.utils import get_stored_filename
+
+            input_filename_mapping = {}
+            for input_filename in input_filenames:
+                stored_filename = get_stored_filename(input_filename)
+                input_filename_mapping.setdefault(stored_filename, input_filename)
+
+            # Walk the local store path, collecting candidate files
+            candidates = []
             files = []
             skipped = []
             errors = []
@@ -918,7 +1095,7 @@ class GitStore(db.Model, HoustonModel):
                         )
                     )
 
-                for filename in tqdm.tqdm(filenames, desc='Walking Assets'):
+                for filename in filenames:
                     filepath = os.path.join(root, filename)
 
                     # Normalize path (sanity check)
@@ -927,59 +1104,65 @@ class GitStore(db.Model, HoustonModel):
                     # Sanity check, ensure that the path is formatted well
                     assert os.path.exists(filepath)
                     assert os.path.isabs(filepath)
-                    try:
-                        basename = os.path.basename(filepath)
-                        _, extension = os.path.splitext(basename)
-                        extension = extension.lower()
-                        extension = extension.strip('.')
-
-                        if basename.startswith('.'):
-                            # Skip hidden files
-                            if basename not in ['.touch']:
-                                skipped.append((filepath, basename))
-                            continue
-
-                        if os.path.isdir(filepath):
-                            # Skip any directories (sanity check)
-                            skipped.append((filepath, extension))
-                            continue
-
-                        if os.path.islink(filepath):
-                            # Skip any symbolic links (sanity check)
-                            skipped.append((filepath, extension))
-                            continue
-                        mime_type = magic.from_file(filepath, mime=True)
-                        if mime_type not in self.mime_type_whitelist:
-                            # Skip any unsupported MIME types
-                            skipped.append((filepath, extension))
-                            continue
-
-                        magic_signature = magic.from_file(filepath)
-                        size_bytes = os.path.getsize(filepath)
-
-                        this_input_filename = None
-                        for input_filename in input_filenames:
-                            from app.utils import get_stored_filename
-
-                            if get_stored_filename(input_filename) == basename:
-                                this_input_filename = input_filename
-                                break
-
-                        file_data = {
-                            'filepath': filepath,
-                            'path': this_input_filename
-                            if this_input_filename
-                            else basename,
-                            'mime_type': mime_type,
-                            'magic_signature': magic_signature,
-                            'size_bytes': size_bytes,
-                            'git_store_guid': self.guid,
-                        }
-
-                        files.append(file_data)
-                    except Exception:  # pragma: no cover
-                        logging.exception('Got exception in update_asset_symlinks')
-                        errors.append(filepath)
+
+                    basename = os.path.basename(filepath)
+                    _, extension = os.path.splitext(basename)
+                    extension = extension.lower()
+                    extension = extension.strip('.')
+
+                    if basename.startswith('.'):
+                        # Skip hidden files
+                        if basename not in ['.touch']:
+                            skipped.append((filepath, basename))
+                        continue
+
+                    if os.path.isdir(filepath):
+                        # Skip any directories (sanity check)
+                        skipped.append((filepath, extension))
+                        continue
+
+                    if os.path.islink(filepath):
+                        # Skip any symbolic links (sanity check)
+                        skipped.append((filepath, extension))
+                        continue
+
+                    candidates.append((filepath, basename, extension))
+
+            # Extract the Magic signatures and file stats with a pool of workers
+            def _inspect(filepath):
+                try:
+                    return inspect_upload_filepath(filepath, self.mime_type_whitelist)
+                except Exception:  # pragma: no cover
+                    logging.exception('Got exception in update_asset_symlinks')
+                    return None
+
+            inspections = parallel(
+                _inspect,
+                [(filepath,) for filepath, _, _ in candidates],
+                desc='Walking Assets',
+                callback=self._progress_preparation_callback(1, 10),
+            )
+            for candidate, inspection in zip(candidates, inspections):
+                filepath, basename, extension = candidate
+                if inspection is None:
+                    errors.append(filepath)
+                    continue
+
+                mime_type, magic_signature, size_bytes = inspection
+                if magic_signature is None:
+                    # Skip any unsupported MIME types
+                    skipped.append((filepath, extension))
+                    continue
+
+                file_data = {
+                    'filepath': filepath,
+                    'path': input_filename_mapping.get(basename, basename),
+                    'mime_type': mime_type,
+                    'magic_signature': magic_signature,
+                    'size_bytes': size_bytes,
+                    'git_store_guid': self.guid,
+                }
+                files.append(file_data)
 
             if len(skipped) > 0:
                 skipped_ext_list = [skip[1] for skip in skipped]
@@ -1000,9 +1183,16 @@ class GitStore(db.Model, HoustonModel):
 
             # Compute the xxHash64 for all found files
             filepath_list = [file_data_['filepath'] for file_data_ in files]
-            arguments_list = list(zip(filepath_list))
-            filesystem_xxhash64_list = parallel(
-                compute_xxhash64_digest_filepath, arguments_list
+            digest_cache_filepath = os.path.join(
+                local_store_path, '_derived', DIGEST_CACHE_FILENAME
+            )
+            if not os.path.isdir(os.path.dirname(digest_cache_filepath)):
+                digest_cache_filepath = None
+            filesystem_xxhash64_list = compute_xxhash64_digests_cached(
+                filepath_list,
+                cache_filepath=digest_cache_filepath,
+                use_mmap=current_app.config.get('GIT_STORE_DIGEST_USE_MMAP', False),
+                callback=self._progress_preparation_callback(10, 19),
             )
             filesystem_guid_list = list(
                 map(ut.hashable_to_uuid, filesystem_xxhash64_list)
@@ -1055,8 +1245,8 @@ class GitStore(db.Model, HoustonModel):
                 self.progress_preparation.set(20)
 
             # Step 3.4
-            #   Description: Add the assets to the database
-            #   Delay: the majority of the processing, unbounded seconds
+            #   Description: Add the assets to the database in bulk, see Asset.bulk_upsert()
+            #   Delay: a handful of queries per thousand assets, unbounded seconds
             #   Percentage: 60% (20% -> 80%)
             assert self.exists
 
@@ -1064,59 +1254,15 @@ class GitStore(db.Model, HoustonModel):
             local_asset_filepath_list = [
                 file_data.pop('filepath', None) for file_data in files
             ]
-            zipped = list(zip(files, local_asset_filepath_list))
-            for index, zip_data in enumerate(zipped):
-                assert self.exists
-
-                file_data, local_asset_filepath = zip_data
-
-                semantic_guid = file_data.get('semantic_guid', None)
-                asset = Asset.query.filter(Asset.semantic_guid == semantic_guid).first()
-                if asset is None:
-
-                    # Check if we can recycle existing GUID from symlink
-                    recycle_guid = existing_filepath_guid_mapping.get(
-                        local_asset_filepath, None
-                    )
-                    if recycle_guid is not None:
-                        file_data['guid'] = recycle_guid
-
-                    # Create record if asset is new
-                    with db.session.begin(subtransactions=True):
-                        asset = Asset(**file_data)
-                        db.session.add(asset)
-                else:
-                    log.info(
-                        'Found asset {!r} for semantic_guid = {!r}'.format(
-                            asset, semantic_guid
-                        )
-                    )
+            for file_data, local_asset_filepath in zip(files, local_asset_filepath_list):
+                # Check if we can recycle existing GUID from symlink, used for new Assets
+                recycle_guid = existing_filepath_guid_mapping.get(
+                    local_asset_filepath, None
+                )
+                if recycle_guid is not None:
+                    file_data['guid'] = recycle_guid
 
-                    # Update record if Asset exists
-                    search_keys = [
-                        'filesystem_guid',
-                        'semantic_guid',
-                        'git_store_guid',
-                    ]
-
-                    with db.session.begin(subtransactions=True):
-                        for key in file_data:
-                            if key in search_keys:
-                                continue
-                            value = file_data[key]
-                            setattr(asset, key, value)
-                        db.session.merge(asset)
-                assets.append(asset)
-
-                if self.progress_preparation:
-                    numerator = index
-                    denominator = len(zipped)
-                    percentage = numerator / denominator
-                    offset = 20.0
-                    domain = 60.0
-                    new_percentage = offset + (domain * percentage)
-                    new_percentage = max(offset, min(offset + domain, new_percentage))
-                    self.progress_preparation.set(new_percentage)
+            assets = Asset.bulk_upsert(files)
 
             if self.progress_preparation:
                 self.progress_preparation.set(80)
@@ -1127,14 +1273,17 @@ class GitStore(db.Model, HoustonModel):
             #   Percentage: 9% (89% -> 89%)
             assert self.exists
 
-            # Update all symlinks for each Asset
+            # Update all symlinks for each Asset, the Assets were loaded by bulk_upsert()
             for asset, local_asset_filepath in zip(assets, local_asset_filepath_list):
-                db.session.refresh(asset)
                 asset.update_symlink(local_asset_filepath)
-                asset.set_derived_meta()
 
                 log.debug(f'Created Asset {asset}')
 
+            # Read the image headers for the derived metadata with a pool of workers
+            Asset.set_derived_meta_many(
+                assets, callback=self._progress_preparation_callback(80, 89)
+            )
+
             # Get all historical and current Assets for this Git Store
             assert self.exists
             db.session.refresh(self)
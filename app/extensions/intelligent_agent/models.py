@@ -313,7 +313,7 @@ class IntelligentAgentContent(db.Model, HoustonModel):
     def derive_location_id(self):
         from app.modules.site_settings.models import Regions
 
-        reg = Regions()
+        reg = Regions.get_site_regions()
         matches = reg.find_fuzzy_list(self.content_as_string().split())
         if not matches:
             return None
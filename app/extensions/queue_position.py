@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Queue position index
+--------------------
+
+Keeps track of the position of pending jobs so that the number of jobs ahead of a
+given Celery task or Sage job is a constant time lookup instead of a scan of the
+queue.
+
+Celery tasks published on the default queue are added to a Redis sorted set when
+they are published, scored by their publish time, and removed when a worker starts
+them (or they are revoked).  Sage jobs are not published by
+Houston, so a snapshot of the pending Sage queue is stored by the periodic Sage jobs
+sync instead.
+"""
+import logging
+import time
+
+from celery import signals
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_CELERY_QUEUE_NAME = 'celery'
+CELERY_QUEUE_INDEX_KEY = 'queue_position.celery'
+# Tasks lost without ever starting (e.g. purged queues) would otherwise stay in the
+# index forever, the tasks published longer ago than this (in seconds) are dropped
+CELERY_QUEUE_INDEX_MAX_AGE = 60 * 60 * 24
+SAGE_QUEUE_SNAPSHOT_KEY = 'queue_position.sage'
+# The snapshot is refreshed by the Sage jobs sync, drop it if that stops running
+SAGE_QUEUE_SNAPSHOT_TTL = 60 * 15
+
+REDIS_CONNECTIONS = {}
+
+
+def _get_connection(url=None):
+    import redis
+
+    if url is None:
+        from celery import current_app as current_celery
+
+        url = current_celery.conf.broker_url
+
+    conn = REDIS_CONNECTIONS.get(url, None)
+    if conn is None:
+        conn = redis.from_url(url, socket_connect_timeout=2)
+        REDIS_CONNECTIONS[url] = conn
+    return conn
+
+
+def celery_task_enqueued(task_id, conn=None):
+    if conn is None:
+        conn = _get_connection()
+    now = time.time()
+    pipeline = conn.pipeline()
+    pipeline.zadd(CELERY_QUEUE_INDEX_KEY, {str(task_id): now})
+    pipeline.zremrangebyscore(
+        CELERY_QUEUE_INDEX_KEY, '-inf', f'({now - CELERY_QUEUE_INDEX_MAX_AGE}'
+    )
+    pipeline.execute()
+
+
+def celery_task_dequeued(task_id, conn=None):
+    if conn is None:
+        conn = _get_connection()
+    conn.zrem(CELERY_QUEUE_INDEX_KEY, str(task_id))
+
+
+def celery_task_ahead(task_id, conn=None):
+    """
+    Return the number of pending tasks published before this one, or None if the task
+    is not pending.  Tasks lost from the broker queue may linger in the index, so this
+    is never more than the length of the queue
+    """
+    if conn is None:
+        conn = _get_connection()
+    pipeline = conn.pipeline()
+    pipeline.zrank(CELERY_QUEUE_INDEX_KEY, str(task_id))
+    pipeline.llen(DEFAULT_CELERY_QUEUE_NAME)
+    ahead, length = pipeline.execute()
+    if ahead is None:
+        return None
+    return min(ahead, length)
+
+
+def set_sage_queue(pending_job_ids, conn=None):
+    """
+    Store a snapshot of the pending Sage jobs, in queue order (Sage runs them by
+    jobcounter, oldest first), as a job id -> number of jobs ahead hash, the snapshot
+    is swapped in atomically
+    """
+    if conn is None:
+        conn = _get_connection()
+
+    positions = {str(job_id): ahead for ahead, job_id in enumerate(pending_job_ids)}
+    if not positions:
+        conn.delete(SAGE_QUEUE_SNAPSHOT_KEY)
+        return
+
+    staging_key = f'{SAGE_QUEUE_SNAPSHOT_KEY}.staging'
+    pipeline = conn.pipeline()
+    pipeline.delete(staging_key)
+    pipeline.hset(staging_key, mapping=positions)
+    pipeline.expire(staging_key, SAGE_QUEUE_SNAPSHOT_TTL)
+    pipeline.rename(staging_key, SAGE_QUEUE_SNAPSHOT_KEY)
+    pipeline.execute()
+
+
+def sage_job_ahead(job_id, conn=None):
+    """
+    Return the number of pending Sage jobs ahead of this one in the last snapshot, or
+    None if the job was not pending
+    """
+    if conn is None:
+        conn = _get_connection()
+    ahead = conn.hget(SAGE_QUEUE_SNAPSHOT_KEY, str(job_id))
+    if ahead is None:
+        return None
+    return int(ahead)
+
+
+# Signal handlers, these must never get in the way of publishing or running a task
+
+
+@signals.before_task_publish.connect
+def queue_position_task_published(sender=None, headers=None, routing_key=None, **kw):
+    if routing_key not in (None, DEFAULT_CELERY_QUEUE_NAME):
+        return
+    task_id = (headers or {}).get('id', None)
+    if task_id is None:
+        return
+    try:
+        celery_task_enqueued(task_id)
+    except Exception as ex:
+        log.debug(f'Unable to index published task {task_id}: {ex}')
+
+
+@signals.task_prerun.connect
+def queue_position_task_started(sender=None, task_id=None, **kw):
+    if task_id is None:
+        return
+    try:
+        celery_task_dequeued(task_id)
+    except Exception as ex:
+        log.debug(f'Unable to unindex started task {task_id}: {ex}')
+
+
+@signals.task_revoked.connect
+def queue_position_task_revoked(sender=None, request=None, **kw):
+    task_id = getattr(request, 'id', None)
+    if task_id is None:
+        return
+    try:
+        celery_task_dequeued(task_id)
+    except Exception as ex:
+        log.debug(f'Unable to unindex revoked task {task_id}: {ex}')
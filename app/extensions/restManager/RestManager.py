@@ -8,6 +8,9 @@ system using REST API
 import json
 import keyword
 import logging
+import random
+import threading
+import time
 import uuid
 from collections import namedtuple
 
@@ -15,10 +18,26 @@ import requests
 import utool as ut
 from flask import current_app, render_template, request, session  # NOQA
 from flask_login import current_user  # NOQA
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from werkzeug.exceptions import BadRequest
 
 KEYWORD_SET = set(keyword.kwlist)
 
+# Used for any setting missing from the {NAME}_TRANSPORT configuration
+DEFAULT_TRANSPORT = {
+    'pool_maxsize': 10,
+    'retries': 3,
+    'backoff_factor': 0.5,
+    'connect_timeout': 10,
+    'read_timeout': 300,
+    'circuit_breaker_threshold': 5,
+    'circuit_breaker_timeout': 30,
+}
+
+# Gateway errors, retried for idempotent requests and counted as target failures
+UNAVAILABLE_STATUS_CODES = (502, 503, 504)
+
 log = logging.getLogger(__name__)
 
 
@@ -38,6 +57,67 @@ def _json_object_hook(data):
     return data_
 
 
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of sending a request to a target whose circuit is open"""
+
+
+class JitteredRetry(Retry):
+    """
+    Retry policy with a random ("full jitter") exponential backoff, so workers
+    failing together do not retry in lockstep
+    """
+
+    def get_backoff_time(self):
+        backoff = super(JitteredRetry, self).get_backoff_time()
+        return random.uniform(0, backoff) if backoff > 0 else 0
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to a target for ``timeout`` seconds after ``threshold``
+    consecutive failures (connection errors, timeouts or gateway errors), then lets
+    a single trial request through before closing again
+    """
+
+    def __init__(self, name, threshold, timeout):
+        self.name = name
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        with self.lock:
+            if self.opened is None:
+                return
+            if time.monotonic() - self.opened < self.timeout:
+                raise CircuitOpenError(
+                    f'{self.name} circuit is open after {self.failures} failures'
+                )
+            # Half-open, this request is the trial and the others wait for it
+            self.opened = time.monotonic()
+
+    def record_success(self):
+        with self.lock:
+            if self.opened is not None:
+                log.info(f'{self.name} circuit closed')
+            self.failures = 0
+            self.opened = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.threshold <= 0 or self.failures < self.threshold:
+                return
+            if self.opened is None:
+                log.warning(
+                    f'{self.name} circuit opened after {self.failures} failures, '
+                    f'requests are refused for {self.timeout} seconds'
+                )
+            self.opened = time.monotonic()
+
+
 # Not entirely certain how appropriate this is as a Mixin as it's dependent on a couple of things in
 # the main class
 class RestManagerUserMixin(object):
@@ -47,7 +127,7 @@ class RestManagerUserMixin(object):
         success = False
         for target in self.targets:
             # Create temporary session
-            temporary_session = requests.Session()
+            temporary_session = self._new_session()
             try:
                 response = self._request(
                     'get',
@@ -95,6 +175,7 @@ class RestManager(RestManagerUserMixin):
         # Start with all contents as empty structures
         self.targets = set()
         self.sessions = {}
+        self.circuit_breakers = {}
         self.uris = {}
         self.auths = {}
 
@@ -179,6 +260,49 @@ class RestManager(RestManagerUserMixin):
             # Assign local references to the configuration settings
             self.auths = authns
 
+    def _get_transport_config(self):
+        transport = DEFAULT_TRANSPORT.copy()
+        transport.update(current_app.config.get(f'{self.NAME}_TRANSPORT', {}))
+        return transport
+
+    def _new_session(self):
+        """
+        Create a session with a persistent connection pool, and a retry policy for
+        connection errors and idempotent requests
+        """
+        transport = self._get_transport_config()
+        retries = transport['retries']
+        max_retries = JitteredRetry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=transport['backoff_factor'],
+            status_forcelist=UNAVAILABLE_STATUS_CODES,
+            # Return the last response instead of raising once the retries are exhausted
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_maxsize=transport['pool_maxsize'], max_retries=max_retries
+        )
+        session_ = requests.Session()
+        session_.mount('http://', adapter)
+        session_.mount('https://', adapter)
+        return session_
+
+    def _get_circuit_breaker(self, target):
+        if target not in self.circuit_breakers:
+            transport = self._get_transport_config()
+            self.circuit_breakers.setdefault(
+                target,
+                CircuitBreaker(
+                    f'{self.NAME} ({target})',
+                    transport['circuit_breaker_threshold'],
+                    transport['circuit_breaker_timeout'],
+                ),
+            )
+        return self.circuit_breakers[target]
+
     def _init_all_sessions(self):
         for target in self.uris:
             self._ensure_session(target)
@@ -190,7 +314,7 @@ class RestManager(RestManagerUserMixin):
         """
         if target not in self.sessions:
             log.debug(f'Creating anonymous session for {target}')
-            self.sessions[target] = requests.Session()
+            self.sessions[target] = self._new_session()
 
         if target in self.auths:
             auth = self.auths[target]
@@ -281,15 +405,32 @@ class RestManager(RestManagerUserMixin):
             #          f'Contents {passthrough_kwargs}')
 
         session_ = target_session or self.sessions[target]
+        if _pre_request_func is not None:
+            session_ = _pre_request_func(session_)
+
+        request_func = getattr(session_, method, None)
+        assert request_func is not None
+
+        request_kwargs = dict(passthrough_kwargs)
+        if 'timeout' not in request_kwargs:
+            transport = self._get_transport_config()
+            request_kwargs['timeout'] = (
+                transport['connect_timeout'],
+                transport['read_timeout'],
+            )
 
-        with session_:
-            if _pre_request_func is not None:
-                session_ = _pre_request_func(session_)
-
-            request_func = getattr(session_, method, None)
-            assert request_func is not None
-
-            response = request_func(endpoint_encoded, **passthrough_kwargs)
+        # The session is kept open, so its pooled connections are reused
+        circuit_breaker = self._get_circuit_breaker(target)
+        circuit_breaker.before_request()
+        try:
+            response = request_func(endpoint_encoded, **request_kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            circuit_breaker.record_failure()
+            raise
+        if response.status_code in UNAVAILABLE_STATUS_CODES:
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success()
 
         if response.ok:
             if decode_as_object:
@@ -405,7 +546,10 @@ class RestManager(RestManagerUserMixin):
             data_ = passthrough_kwargs.pop('data', None)
             if data_ is not None:
                 passthrough_kwargs['json'] = data_
-        elif passthrough_kwargs.get('data'):
+        elif passthrough_kwargs.get('data') and not hasattr(
+            passthrough_kwargs['data'], 'read'
+        ):
+            # Streamed bodies (e.g. multipart file uploads) are never json
             log.warning(
                 f'Data for tag={tag} is not sent as json: data={passthrough_kwargs["data"]}'
             )
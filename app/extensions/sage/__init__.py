@@ -5,8 +5,10 @@ Asset Curation Model (Sage) manager.
 
 """
 
+import json
 import keyword
 import logging
+import os
 import uuid
 
 import tqdm
@@ -23,72 +25,192 @@ if not is_extension_enabled('sage'):
 
 KEYWORD_SET = set(keyword.kwlist)
 SAGE_UNKNOWN_NAME = '____'
+SAGE_SYNC_CHUNK_SIZE = 100
+SAGE_SYNC_BULK_LIST_THRESHOLD = 1000
+SAGE_SYNC_BATCH_SIZE = 50
 
 log = logging.getLogger(__name__)
 
 
 class SageModel(object):
-    """Adds `viewed` column to a derived declarative model."""
+    """Adds Sage sync helpers to a derived declarative model.
+
+    The derived model needs a `content_guid` column for the Sage UUID and a
+    `sage_synced` column, which records when the object was last successfully synced
+    and is compared against `updated` to find the objects that need an incremental sync.
+    """
 
     @classmethod
-    def sync_all_with_sage(cls, prune=False, **kwargs):
+    def get_sage_bulk_uuids(cls):
         houston_tag, sage_tag = cls.get_sage_sync_tags()
-        sage_uuids = current_app.sage.request_passthrough_result(
-            '{}.list'.format(houston_tag), 'get', target='sync'
-        )
-        sage_uuids = {from_sage_uuid(guid) for guid in sage_uuids}
-
-        bulk_sage_uuids = {
-            houston_tag: sage_uuids,
-        }
-
+        houston_tags = [houston_tag]
         if houston_tag == 'annotation':
-            houston_tag_ = 'asset'
-            sage_uuids_ = current_app.sage.request_passthrough_result(
+            houston_tags.append('asset')
+
+        bulk_sage_uuids = {}
+        for houston_tag_ in houston_tags:
+            sage_uuids = current_app.sage.request_passthrough_result(
                 '{}.list'.format(houston_tag_), 'get', target='sync'
             )
-            sage_uuids_ = {from_sage_uuid(guid) for guid in sage_uuids_}
-            bulk_sage_uuids[houston_tag_] = sage_uuids_
+            bulk_sage_uuids[houston_tag_] = {from_sage_uuid(guid) for guid in sage_uuids}
+
+        return bulk_sage_uuids
+
+    @classmethod
+    def get_sage_existing_uuids(cls, content_guids, batch_size=SAGE_SYNC_BATCH_SIZE):
+        """Check which content GUIDs exist on Sage, with one request per batch"""
+        houston_tag, sage_tag = cls.get_sage_sync_tags()
+
+        content_guids = sorted({guid for guid in content_guids if guid is not None})
+        existing_uuids = set()
+        for start in range(0, len(content_guids), batch_size):
+            chunk = content_guids[start : start + batch_size]
+            sage_uuid_list = json.dumps(
+                [to_sage_uuid(guid) for guid in chunk], separators=(',', ':')
+            )
+            sage_rowids = current_app.sage.request_passthrough_result(
+                '{}.exists_list'.format(houston_tag),
+                'get',
+                args=sage_uuid_list,
+                target='sync',
+            )
+            for content_guid, sage_rowid in zip(chunk, sage_rowids):
+                if sage_rowid is not None:
+                    existing_uuids.add(content_guid)
+
+        return existing_uuids
+
+    @classmethod
+    def get_sage_outdated_guids(cls):
+        from app.extensions import db
+
+        guids = (
+            cls.query.filter(
+                db.or_(cls.sage_synced.is_(None), cls.updated > cls.sage_synced)
+            )
+            .with_entities(cls.guid)
+            .all()
+        )
+        return [guid for (guid,) in guids]
+
+    @classmethod
+    def mark_synced_with_sage(cls, watermarks):
+        """
+        Stamp the `sage_synced` watermark of each object from a dict of GUID to the
+        `updated` timestamp it had when it was loaded for the sync, so a change made
+        while the sync was running leaves the object outdated and it is pushed again
+        """
+        from app.extensions import db
+
+        if len(watermarks) == 0:
+            return
+
+        table = cls.__table__
+        # Bypass the ORM so that setting the watermark does not also bump `updated`
+        with db.session.begin(subtransactions=True):
+            db.session.execute(
+                table.update()
+                .where(table.c.guid == db.bindparam('_guid'))
+                .values(sage_synced=db.bindparam('_sage_synced')),
+                [
+                    {'_guid': guid, '_sage_synced': updated}
+                    for guid, updated in watermarks.items()
+                ],
+            )
+
+    @classmethod
+    def sync_all_with_sage(
+        cls,
+        prune=False,
+        incremental=False,
+        chunk_size=SAGE_SYNC_CHUNK_SIZE,
+        **kwargs,
+    ):
+        """
+        Push the objects to Sage.  An incremental sync only checks the objects that
+        changed since their last successful sync, so an object that was synced and then
+        deleted on the Sage side is never re-checked, only a full sync with ``ensure``
+        finds and re-uploads it.  Pruning the Sage records Houston no longer has is
+        separate, see prune_with_sage()
+        """
+        houston_tag, sage_tag = cls.get_sage_sync_tags()
+
+        if incremental:
+            # Only the objects that have changed since their last successful sync
+            guids = cls.get_sage_outdated_guids()
+        else:
+            guids = [guid for (guid,) in cls.query.with_entities(cls.guid).all()]
+
+        # Listing everything on Sage only pays off when there are many objects to check
+        bulk_sage_uuids = None
+        if not incremental or prune or len(guids) >= SAGE_SYNC_BULK_LIST_THRESHOLD:
+            bulk_sage_uuids = cls.get_sage_bulk_uuids()
+
+        if incremental:
+            log.info('Sage Sync %s: %d outdated objects' % (cls.__name__, len(guids)))
 
-        objs = cls.query.all()
         desc = 'Sage Sync {}'.format(cls.__name__)
-        for obj in tqdm.tqdm(objs, desc=desc):
-            obj.sync_with_sage(bulk_sage_uuids=bulk_sage_uuids, **kwargs)
+        with tqdm.tqdm(total=len(guids), desc=desc) as progress:
+            for start in range(0, len(guids), chunk_size):
+                chunk = guids[start : start + chunk_size]
+                objs = cls.query.filter(cls.guid.in_(chunk)).all()
+                loaded = {obj.guid: obj.updated for obj in objs}
+
+                cls.sync_many_with_sage(objs, bulk_sage_uuids=bulk_sage_uuids, **kwargs)
+                watermarks = {
+                    obj.guid: loaded[obj.guid]
+                    for obj in objs
+                    if obj.is_synced_with_sage()
+                }
+                progress.update(len(chunk))
+
+                # Objects that failed keep their old watermark and are retried next time
+                cls.mark_synced_with_sage(watermarks)
 
         if prune:
-            houston_sage_uuids = cls.query.with_entities(cls.content_guid).all()
+            cls.prune_with_sage(sage_uuids=bulk_sage_uuids[houston_tag])
 
-            # Standardize
-            houston_sage_uuids = {
-                guid for (guid,) in houston_sage_uuids if guid is not None
-            }
+    @classmethod
+    def prune_with_sage(cls, sage_uuids=None):
+        houston_tag, sage_tag = cls.get_sage_sync_tags()
 
-            # Calculate
-            delete_sage_uuids = sage_uuids - houston_sage_uuids
+        if sage_uuids is None:
+            sage_uuids = current_app.sage.request_passthrough_result(
+                '{}.list'.format(houston_tag), 'get', target='sync'
+            )
+            sage_uuids = {from_sage_uuid(guid) for guid in sage_uuids}
 
-            if len(delete_sage_uuids) > 0:
-                log.warning(
-                    'Pruning %d %s records from Sage'
-                    % (
-                        len(delete_sage_uuids),
-                        cls.__name__,
-                    )
-                )
+        houston_sage_uuids = cls.query.with_entities(cls.content_guid).all()
 
-                key = '{}_uuid_list'.format(sage_tag)
-                sage_request = {
-                    key: [],
-                }
-                for delete_sage_uuid in delete_sage_uuids:
-                    sage_request[key].append(to_sage_uuid(delete_sage_uuid))
-
-                sage_response = current_app.sage.request_passthrough_result(
-                    '{}.delete'.format(houston_tag),
-                    'delete',
-                    {'json': sage_request},
-                    target='sync',
+        # Standardize
+        houston_sage_uuids = {guid for (guid,) in houston_sage_uuids if guid is not None}
+
+        # Calculate
+        delete_sage_uuids = sage_uuids - houston_sage_uuids
+
+        if len(delete_sage_uuids) > 0:
+            log.warning(
+                'Pruning %d %s records from Sage'
+                % (
+                    len(delete_sage_uuids),
+                    cls.__name__,
                 )
-                assert sage_response
+            )
+
+            key = '{}_uuid_list'.format(sage_tag)
+            sage_request = {
+                key: [],
+            }
+            for delete_sage_uuid in delete_sage_uuids:
+                sage_request[key].append(to_sage_uuid(delete_sage_uuid))
+
+            sage_response = current_app.sage.request_passthrough_result(
+                '{}.delete'.format(houston_tag),
+                'delete',
+                {'json': sage_request},
+                target='sync',
+            )
+            assert sage_response
 
     @classmethod
     def get_sage_sync_tags(cls):
@@ -97,6 +219,15 @@ class SageModel(object):
     def sync_with_sage(cls, **kwargs):
         raise NotImplementedError('implement this function in each class')
 
+    @classmethod
+    def sync_many_with_sage(cls, objs, **kwargs):
+        # Override with a batched version where Sage supports it
+        for obj in objs:
+            obj.sync_with_sage(**kwargs)
+
+    def is_synced_with_sage(self):
+        return self.content_guid is not None
+
 
 def to_sage_uuid(houston_guid):
     if houston_guid is None:
@@ -141,6 +272,7 @@ class SageManager(RestManager):
             'list': '//annot/json/',
             'data': '//annot/name/uuid/json/?annot_uuid_list=[{"__UUID__": "%s"}]',
             'exists': '//annot/rowid/uuid/json/?annot_uuid_list=[{"__UUID__":"%s"}]',
+            'exists_list': '//annot/rowid/uuid/json/?annot_uuid_list=%s',
             'create': '//annot/json/',
             'delete': '//annot/json/',
         },
@@ -148,6 +280,7 @@ class SageManager(RestManager):
             'list': '//image/json/',
             'create': '//image/json/',
             'exists': '//image/rowid/uuid/json/?image_uuid_list=[{"__UUID__":"%s"}]',
+            'exists_list': '//image/rowid/uuid/json/?image_uuid_list=%s',
             'upload': '//upload/image/json/',
             'delete': '//image/json/',
         },
@@ -275,10 +408,15 @@ class SageManager(RestManager):
         return statuses, sage_jobs
 
     def sync_jobs(self, verbose=True):
+        from app.extensions import queue_position
+        from app.extensions.elapsed_time import ElapsedTime
+
+        timer = ElapsedTime()
         jobs = current_app.sage.request_passthrough_result(
             'engine.list', 'get', target='default'
         )['json_result']
         statuses, sage_jobs = current_app.sage.get_job_status(jobs)
+        list_time = timer.elapsed()
 
         sage_completed_job_guids = {
             sage_job_id for sage_job_id, status in sage_jobs if status in ['completed']
@@ -286,24 +424,36 @@ class SageManager(RestManager):
         sage_failed_job_guids = {
             sage_job_id for sage_job_id, status in sage_jobs if status in ['exception']
         }
-        sage_pending_job_guids = {
+        sage_pending_job_ids = [
             sage_job_id
             for sage_job_id, status in sage_jobs
             if status not in ['completed', 'exception', 'corrupted', 'None']
-        }
+        ]
+        sage_pending_job_guids = set(sage_pending_job_ids)
+
+        # Snapshot the Sage queue order so that progress polling never asks Sage
+        try:
+            queue_position.set_sage_queue(sage_pending_job_ids)
+        except Exception as ex:
+            log.warning(f'Unable to store the Sage queue snapshot: {ex}')
 
+        timer = ElapsedTime()
         detection_active, detection_seen_jobs = self.sync_jobs_detection(
             sage_completed_job_guids,
             sage_failed_job_guids,
             sage_pending_job_guids,
             verbose=verbose,
         )
+        detection_time = timer.elapsed()
+
+        timer = ElapsedTime()
         identification_active, identification_seen_jobs = self.sync_jobs_identification(
             sage_completed_job_guids,
             sage_failed_job_guids,
             sage_pending_job_guids,
             verbose=verbose,
         )
+        identification_time = timer.elapsed()
 
         active = detection_active + identification_active
         seen_jobs = set(detection_seen_jobs + identification_seen_jobs)
@@ -312,92 +462,225 @@ class SageManager(RestManager):
         sage_failed_job_guids = set(sage_failed_job_guids) - set(seen_jobs)
         sage_pending_job_guids = set(sage_pending_job_guids) - set(seen_jobs)
         if verbose:
+            # Includes the jobs of the objects that are no longer in detection or
+            # identification, their jobs are not checked
             log.info('Not Tracked Jobs')
             log.info('\tCompleted    : %d' % (len(sage_completed_job_guids),))
             log.info('\tFailed       : %d' % (len(sage_failed_job_guids),))
             log.info('\tActive       : %d' % (len(sage_pending_job_guids),))
 
+        log.info(
+            f'Sage jobs synced, {active} active: engine list {list_time}s, '
+            f'detection {detection_time}s, identification {identification_time}s'
+        )
         return active
 
-    def sync_jobs_detection(
+    def _classify_jobs(
         self,
+        jobs_by_guid,
+        start_keys,
+        end_keys,
         sage_completed_job_guids,
         sage_failed_job_guids,
         sage_pending_job_guids,
-        verbose=True,
     ):
-        from app.modules.asset_groups.models import (
-            AssetGroupSighting,
-            AssetGroupSightingStage,
-        )
-
-        asset_group_sightings = AssetGroupSighting.query.all()
-
-        start_keys = {'model', 'active', 'start', 'asset_guids'}
-        end_keys = start_keys | {'json_result', 'end'}
-
+        """
+        Sort the houston jobs, given as (object guid, jobs) pairs, against their Sage
+        status, returns the number of completed jobs, a dictionary of the
+        (guid, job_id) lists by kind and the seen job ids
+        """
         completed = 0
-        fetch_jobs = []
-        failed_jobs = []
-        pending_jobs = []
-        unknown_jobs = []
-        corrupt_jobs = []
+        kinds = {
+            'fetch': [],
+            'failed': [],
+            'pending': [],
+            'unknown': [],
+            'corrupt': [],
+        }
         seen_jobs = []
-        for asset_group_sighting in tqdm.tqdm(asset_group_sightings):
-            if asset_group_sighting.jobs:
-                for job_id in asset_group_sighting.jobs:
-                    job_metadata = asset_group_sighting.jobs[job_id]
-                    job_data = (asset_group_sighting, job_id)
+        for guid, jobs in tqdm.tqdm(jobs_by_guid):
+            if jobs:
+                for job_id in jobs:
+                    job_metadata = jobs[job_id]
+                    job_data = (guid, job_id)
 
                     seen_jobs.append(job_id)
 
                     if job_metadata.keys() < start_keys:
-                        corrupt_jobs.append(job_data)
+                        kinds['corrupt'].append(job_data)
                     elif job_metadata.get('active'):
                         if job_id in sage_completed_job_guids:
-                            fetch_jobs.append(job_data)
+                            kinds['fetch'].append(job_data)
                         elif job_id in sage_failed_job_guids:
-                            failed_jobs.append(job_data)
+                            kinds['failed'].append(job_data)
                         elif job_id in sage_pending_job_guids:
-                            pending_jobs.append(job_data)
+                            kinds['pending'].append(job_data)
                         else:
-                            unknown_jobs.append(job_data)
+                            kinds['unknown'].append(job_data)
                     else:
                         if job_metadata.keys() < end_keys:
                             if job_id in sage_completed_job_guids:
-                                fetch_jobs.append(job_data)
-                            elif job_id in sage_failed_job_guids:
-                                corrupt_jobs.append(job_data)
-                            elif job_id in sage_pending_job_guids:
-                                corrupt_jobs.append(job_data)
+                                kinds['fetch'].append(job_data)
                             else:
-                                corrupt_jobs.append(job_data)
+                                kinds['corrupt'].append(job_data)
                         else:
                             completed += 1
 
+        return completed, kinds, seen_jobs
+
+    def _log_job_kinds(self, title, completed, kinds):
+        log.info(title)
+        log.info('\tCompleted    : %d' % (completed,))
+        log.info('\tFailed       : %d' % (len(kinds['failed']),))
+        log.info('\tActive       : %d' % (len(kinds['pending']),))
+        log.info('\tFetch Results: %d' % (len(kinds['fetch']),))
+        log.info('\tMissing      : %d' % (len(kinds['unknown']),))
+        log.info('\tCorrupted    : %d' % (len(kinds['corrupt']),))
+
+    def fetch_job_results(self, job_ids):
+        """
+        Fetch the ``engine.result`` of the Sage jobs concurrently, on as many threads
+        as there are pooled connections, returns the results in order, None for a
+        failed fetch
+        """
+        from app.extensions import parallel
+        from app.extensions.elapsed_time import ElapsedTime
+
+        if not job_ids:
+            return []
+
+        app = current_app._get_current_object()
+
+        def fetch_job_result(job_id):
+            with app.app_context():
+                try:
+                    return self.request_passthrough_result(
+                        'engine.result',
+                        'get',
+                        target='default',
+                        args=job_id,
+                    )
+                except Exception as ex:
+                    log.warning(f'Failed to fetch the result of Sage job {job_id}: {ex}')
+                    return None
+
+        timer = ElapsedTime()
+        results = parallel(
+            fetch_job_result,
+            [(job_id,) for job_id in job_ids],
+            workers=self._get_transport_config()['pool_maxsize'],
+            desc='engine.result',
+        )
+        log.info(f'Fetched {len(job_ids)} Sage job results in {timer.elapsed()} seconds')
+        return results
+
+    def upload_image(self, filepath, target='sync'):
+        """
+        Upload an image to Sage, streaming the file from disk instead of reading it
+        into memory, returns its Sage UUID
+        """
+        from requests_toolbelt.multipart.encoder import MultipartEncoder
+
+        with open(filepath, 'rb') as image_file:
+            encoder = MultipartEncoder(
+                fields={'image': (os.path.basename(filepath), image_file)}
+            )
+            passthrough_kwargs = {
+                'data': encoder,
+                'headers': {'Content-Type': encoder.content_type},
+            }
+            sage_response = self.request_passthrough_result(
+                'asset.upload', 'post', passthrough_kwargs, target=target
+            )
+        return from_sage_uuid(sage_response)
+
+    def upload_images(self, filepaths, workers=None, target='sync'):
+        """
+        Upload the images to Sage concurrently, returns their Sage UUIDs in order,
+        None for a failed upload
+        """
+        from app.extensions import parallel
+        from app.extensions.elapsed_time import ElapsedTime
+
+        if not filepaths:
+            return []
+
+        if workers is None:
+            workers = current_app.config.get('SAGE_UPLOAD_WORKERS', 4)
+        workers = max(1, min(workers, self._get_transport_config()['pool_maxsize']))
+
+        app = current_app._get_current_object()
+
+        def upload_image(filepath):
+            with app.app_context():
+                try:
+                    return self.upload_image(filepath, target=target)
+                except Exception as ex:
+                    log.warning(f'Failed to upload image {filepath} to Sage: {ex}')
+                    return None
+
+        timer = ElapsedTime()
+        sage_uuids = parallel(
+            upload_image,
+            [(filepath,) for filepath in filepaths],
+            workers=workers,
+            desc='asset.upload',
+        )
+        log.info(f'Uploaded {len(filepaths)} images to Sage in {timer.elapsed()} seconds')
+        return sage_uuids
+
+    def sync_jobs_detection(
+        self,
+        sage_completed_job_guids,
+        sage_failed_job_guids,
+        sage_pending_job_guids,
+        verbose=True,
+    ):
+        from app.modules.asset_groups.models import (
+            AssetGroupSighting,
+            AssetGroupSightingStage,
+        )
+
+        # Only the jobs are needed to sort them, the objects are loaded for the results.
+        # The jobs of an asset group sighting are only active (or waiting on their
+        # results) while it is in detection, the finished ones are not loaded
+        jobs_by_guid = (
+            AssetGroupSighting.query.filter(
+                AssetGroupSighting.stage == AssetGroupSightingStage.detection
+            )
+            .with_entities(AssetGroupSighting.guid, AssetGroupSighting.jobs)
+            .all()
+        )
+
+        start_keys = {'model', 'active', 'start', 'asset_guids'}
+        end_keys = start_keys | {'json_result', 'end'}
+
+        completed, kinds, seen_jobs = self._classify_jobs(
+            jobs_by_guid,
+            start_keys,
+            end_keys,
+            sage_completed_job_guids,
+            sage_failed_job_guids,
+            sage_pending_job_guids,
+        )
         if verbose:
-            log.info('Detection Jobs')
-            log.info('\tCompleted    : %d' % (completed,))
-            log.info('\tFailed       : %d' % (len(failed_jobs),))
-            log.info('\tActive       : %d' % (len(pending_jobs),))
-            log.info('\tFetch Results: %d' % (len(fetch_jobs),))
-            log.info('\tMissing      : %d' % (len(unknown_jobs),))
-            log.info('\tCorrupted    : %d' % (len(corrupt_jobs),))
+            self._log_job_kinds('Detection Jobs', completed, kinds)
 
         # For jobs that have been completed in Sage but the callback failed for some reason, let's send the results to the AGS
-        for asset_group_sighting, job_id in fetch_jobs:
-            response = current_app.sage.request_passthrough_result(
-                'engine.result',
-                'get',
-                target='default',
-                args=job_id,
-            )
+        fetch_jobs = kinds['fetch']
+        responses = self.fetch_job_results([job_id for _, job_id in fetch_jobs])
+        for (guid, job_id), response in zip(fetch_jobs, responses):
+            if response is None:
+                continue
+            asset_group_sighting = AssetGroupSighting.query.get(guid)
+            if asset_group_sighting is None:
+                continue
             if asset_group_sighting.stage != AssetGroupSightingStage.detection:
                 asset_group_sighting.set_stage(AssetGroupSightingStage.detection)
 
             asset_group_sighting.detected(job_id, response)
 
-        active = len(pending_jobs) + len(fetch_jobs)
+        active = len(kinds['pending']) + len(fetch_jobs)
         return active, seen_jobs
 
     def sync_jobs_identification(
@@ -409,73 +692,44 @@ class SageManager(RestManager):
     ):
         from app.modules.asset_groups.models import Sighting, SightingStage
 
-        sightings = Sighting.query.all()
+        # Only the jobs are needed to sort them, the objects are loaded for the results.
+        # The jobs of a sighting are only active (or waiting on their results) while
+        # it is in identification, the finished ones are not loaded
+        jobs_by_guid = (
+            Sighting.query.filter(Sighting.stage == SightingStage.identification)
+            .with_entities(Sighting.guid, Sighting.jobs)
+            .all()
+        )
 
         start_keys = {'annotation', 'active', 'start', 'matching_set', 'algorithm'}
         end_keys = start_keys | {'json_result', 'end'}
 
-        completed = 0
-        fetch_jobs = []
-        failed_jobs = []
-        pending_jobs = []
-        unknown_jobs = []
-        corrupt_jobs = []
-        seen_jobs = []
-        for sighting in tqdm.tqdm(sightings):
-            if sighting.jobs:
-                for job_id in sighting.jobs:
-                    job_metadata = sighting.jobs[job_id]
-                    job_data = (sighting, job_id)
-
-                    seen_jobs.append(job_id)
-
-                    if job_metadata.keys() < start_keys:
-                        corrupt_jobs.append(job_data)
-                    elif job_metadata.get('active'):
-                        if job_id in sage_completed_job_guids:
-                            fetch_jobs.append(job_data)
-                        elif job_id in sage_failed_job_guids:
-                            failed_jobs.append(job_data)
-                        elif job_id in sage_pending_job_guids:
-                            pending_jobs.append(job_data)
-                        else:
-                            unknown_jobs.append(job_data)
-                    else:
-                        if job_metadata.keys() < end_keys:
-                            if job_id in sage_completed_job_guids:
-                                fetch_jobs.append(job_data)
-                            elif job_id in sage_failed_job_guids:
-                                corrupt_jobs.append(job_data)
-                            elif job_id in sage_pending_job_guids:
-                                corrupt_jobs.append(job_data)
-                            else:
-                                corrupt_jobs.append(job_data)
-                        else:
-                            completed += 1
-
+        completed, kinds, seen_jobs = self._classify_jobs(
+            jobs_by_guid,
+            start_keys,
+            end_keys,
+            sage_completed_job_guids,
+            sage_failed_job_guids,
+            sage_pending_job_guids,
+        )
         if verbose:
-            log.info('Identification Jobs')
-            log.info('\tCompleted    : %d' % (completed,))
-            log.info('\tFailed       : %d' % (len(failed_jobs),))
-            log.info('\tActive       : %d' % (len(pending_jobs),))
-            log.info('\tFetch Results: %d' % (len(fetch_jobs),))
-            log.info('\tMissing      : %d' % (len(unknown_jobs),))
-            log.info('\tCorrupted    : %d' % (len(corrupt_jobs),))
+            self._log_job_kinds('Identification Jobs', completed, kinds)
 
         # For jobs that have been completed in Sage but the callback failed for some reason, let's send the results to the AGS
-        for sighting, job_id in fetch_jobs:
-            response = current_app.sage.request_passthrough_result(
-                'engine.result',
-                'get',
-                target='default',
-                args=job_id,
-            )
+        fetch_jobs = kinds['fetch']
+        responses = self.fetch_job_results([job_id for _, job_id in fetch_jobs])
+        for (guid, job_id), response in zip(fetch_jobs, responses):
+            if response is None:
+                continue
+            sighting = Sighting.query.get(guid)
+            if sighting is None:
+                continue
             if sighting.stage != SightingStage.identification:
                 sighting.set_stage(SightingStage.identification)
 
             sighting.identified(job_id, response)
 
-        active = len(pending_jobs) + len(fetch_jobs)
+        active = len(kinds['pending']) + len(fetch_jobs)
         return active, seen_jobs
 
     def get_status(self):
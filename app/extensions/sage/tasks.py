@@ -1,12 +1,29 @@
 # -*- coding: utf-8 -*-
 import logging
+import threading
+import time
+import uuid
 
 from flask import current_app
 
 from app.extensions.celery import celery
 
+# The data sync is incremental, only objects changed since their last sync are pushed,
+# objects deleted on the Sage side are only re-uploaded by a full sync with ensure
+# (sage_task_data_sync(incremental=False)), and pruning is a separate task
 SAGE_DATA_SYNC_FREQUENCY = None  # 60 * 60
-SAGE_JOBS_SYNC_FREQUENCY = 60 * 5
+SAGE_DATA_PRUNE_FREQUENCY = None  # 60 * 60 * 24 * 7
+# The jobs sync task is checked every minute, but only syncs once its period is over,
+# which depends on whether there were active jobs during the last sync
+SAGE_JOBS_SYNC_FREQUENCY = 60
+SAGE_JOBS_SYNC_ACTIVE_PERIOD = 60
+SAGE_JOBS_SYNC_IDLE_PERIOD = 60 * 5
+SAGE_JOBS_SYNC_NEXT_KEY = 'sage.jobs_sync.next'
+# Held while a jobs sync runs, the lock expires unless it is refreshed so a crashed
+# worker never blocks the sync for long
+SAGE_JOBS_SYNC_LOCK_KEY = 'sage.jobs_sync.lock'
+SAGE_JOBS_SYNC_LOCK_TIMEOUT = 60 * 5
+SAGE_JOBS_SYNC_LOCK_REFRESH = 60
 
 
 log = logging.getLogger(__name__)
@@ -18,7 +35,13 @@ def sage_task_setup_periodic_tasks(sender, **kwargs):
         sender.add_periodic_task(
             SAGE_DATA_SYNC_FREQUENCY,
             sage_task_data_sync.s(),
-            name='Sync and Prune Sage Data',
+            name='Sync Sage Data',
+        )
+    if SAGE_DATA_PRUNE_FREQUENCY is not None:
+        sender.add_periodic_task(
+            SAGE_DATA_PRUNE_FREQUENCY,
+            sage_task_data_prune.s(),
+            name='Prune Sage Data',
         )
     if SAGE_JOBS_SYNC_FREQUENCY is not None:
         sender.add_periodic_task(
@@ -29,21 +52,109 @@ def sage_task_setup_periodic_tasks(sender, **kwargs):
 
 
 @celery.task
-def sage_task_data_sync():
+def sage_task_data_sync(incremental=True):
     from app.modules.annotations.models import Annotation
     from app.modules.assets.models import Asset
 
-    # Sync all Assets
-    Asset.sync_all_with_sage(ensure=True)
+    # Sync all outdated Assets
+    Asset.sync_all_with_sage(ensure=True, incremental=incremental)
 
-    # Sync all Annotations
-    Annotation.sync_all_with_sage(ensure=True)
+    # Sync all outdated Annotations, their Assets have just been synced
+    Annotation.sync_all_with_sage(ensure=True, incremental=incremental, skip_asset=True)
 
     # Get status of Sage
     current_app.sage.get_status()
 
 
 @celery.task
-def sage_task_jobs_sync():
-    # Sync all job results
-    current_app.sage.sync_jobs()
+def sage_task_data_prune():
+    from app.modules.annotations.models import Annotation
+    from app.modules.assets.models import Asset
+
+    # Prune Annotations before the Assets they belong to
+    Annotation.prune_with_sage()
+    Asset.prune_with_sage()
+
+
+def _lock_call(conn, token, action):
+    # Only act on the lock if it is still ours, it may have expired and been taken
+    def call(pipeline):
+        if pipeline.get(SAGE_JOBS_SYNC_LOCK_KEY) != token:
+            return False
+        pipeline.multi()
+        action(pipeline)
+        return True
+
+    return conn.transaction(call, SAGE_JOBS_SYNC_LOCK_KEY, value_from_callable=True)
+
+
+def _refresh_lock(conn, token, done):
+    # Keep the lock alive for as long as the sync runs, however long that takes
+    def refresh(pipeline):
+        pipeline.expire(SAGE_JOBS_SYNC_LOCK_KEY, SAGE_JOBS_SYNC_LOCK_TIMEOUT)
+
+    while not done.wait(SAGE_JOBS_SYNC_LOCK_REFRESH):
+        try:
+            refreshed = _lock_call(conn, token, refresh)
+        except Exception:
+            refreshed = False
+        if not refreshed:
+            log.warning('Unable to refresh the Sage jobs sync lock')
+            return
+
+
+@celery.task
+def sage_task_jobs_sync(force=False):
+    from app.utils import get_redis_connection
+
+    # The lock keeps other workers from starting a sync while this one runs, the next
+    # sync time is a separate key that only exists until the next sync is due
+    token = str(uuid.uuid4()).encode('utf-8')
+    try:
+        conn = get_redis_connection()
+        locked = conn.set(
+            SAGE_JOBS_SYNC_LOCK_KEY, token, nx=True, ex=SAGE_JOBS_SYNC_LOCK_TIMEOUT
+        )
+        if not locked:
+            return
+        if not force and conn.exists(SAGE_JOBS_SYNC_NEXT_KEY):
+            conn.delete(SAGE_JOBS_SYNC_LOCK_KEY)
+            return
+        # Until it succeeds, a failing sync is retried after the idle period
+        conn.set(
+            SAGE_JOBS_SYNC_NEXT_KEY,
+            time.time() + SAGE_JOBS_SYNC_IDLE_PERIOD,
+            ex=SAGE_JOBS_SYNC_IDLE_PERIOD,
+        )
+    except Exception:
+        log.warning('Unable to lock the Sage jobs sync, syncing anyway')
+        conn = None
+
+    done = threading.Event()
+    if conn is not None:
+        refresh = threading.Thread(
+            target=_refresh_lock, args=(conn, token, done), daemon=True
+        )
+        refresh.start()
+
+    try:
+        # Sync all job results
+        active = current_app.sage.sync_jobs()
+    finally:
+        done.set()
+        if conn is not None:
+            refresh.join()
+            try:
+                _lock_call(
+                    conn, token, lambda pipeline: pipeline.delete(SAGE_JOBS_SYNC_LOCK_KEY)
+                )
+            except Exception:
+                log.warning('Unable to release the Sage jobs sync lock')
+
+    period = SAGE_JOBS_SYNC_ACTIVE_PERIOD if active else SAGE_JOBS_SYNC_IDLE_PERIOD
+    if conn is None:
+        return
+    try:
+        conn.set(SAGE_JOBS_SYNC_NEXT_KEY, time.time() + period, ex=period)
+    except Exception:
+        log.warning('Unable to store the next Sage jobs sync time')
@@ -4,18 +4,34 @@ Annotations database models
 --------------------
 """
 
+import hashlib
+import json
 import logging
 import uuid
 
+import utool as ut
 from flask import current_app
 
 import app.extensions.logging as AuditLog
 from app.extensions import HoustonModel, SageModel, db
 from app.modules import is_module_enabled
-from app.utils import HoustonException
+from app.utils import (
+    HoustonException,
+    bump_shared_generation,
+    get_redis_connection,
+    get_shared_generation,
+)
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+# Matching sets are shared through Redis, under a generation that is bumped once a
+# change that can alter a matching set is committed
+MATCHING_SET_CACHE_PREFIX = 'annotation.matching_set'
+MATCHING_SET_CACHE_GENERATION_KEY = f'{MATCHING_SET_CACHE_PREFIX}.generation'
+MATCHING_SET_CACHE_TIMEOUT = 60 * 10
+# The annotation columns that matching set queries filter on
+MATCHING_SET_CACHE_COLUMNS = {'encounter_guid', 'viewpoint'}
+
 
 class AnnotationKeywords(db.Model, HoustonModel):
     annotation_guid = db.Column(
@@ -40,6 +56,7 @@ class Annotation(db.Model, HoustonModel, SageModel):
     )  # pylint: disable=invalid-name
     version = db.Column(db.BigInteger, default=None, nullable=True)
     content_guid = db.Column(db.GUID, nullable=True)
+    sage_synced = db.Column(db.DateTime, index=True, nullable=True)
 
     asset_guid = db.Column(
         db.GUID,
@@ -159,6 +176,16 @@ class Annotation(db.Model, HoustonModel, SageModel):
     def get_sage_sync_tags(cls):
         return 'annotation', 'annot'
 
+    def is_synced_with_sage(self):
+        if self.asset is None:
+            return False
+        # Unsupported MIME types are never sent to Sage, so there is nothing to retry
+        if self.asset.mime_type not in current_app.config.get(
+            'SAGE_MIME_TYPE_WHITELIST_EXTENSIONS', []
+        ):
+            return True
+        return self.content_guid is not None
+
     def sync_with_sage(
         self, ensure=False, force=False, bulk_sage_uuids=None, skip_asset=False, **kwargs
     ):
@@ -262,6 +289,141 @@ class Annotation(db.Model, HoustonModel, SageModel):
             db.session.merge(self)
         db.session.refresh(self)
 
+    @classmethod
+    def sync_many_with_sage(
+        cls,
+        annotations,
+        ensure=False,
+        force=False,
+        bulk_sage_uuids=None,
+        skip_asset=False,
+        batch_size=None,
+        **kwargs,
+    ):
+        """
+        Bulk version of sync_with_sage(), the assets are synced in bulk first and the
+        missing annotations of each batch are created on Sage with a single request
+        """
+        from app.extensions.sage import SAGE_UNKNOWN_NAME, from_sage_uuid, to_sage_uuid
+        from app.modules.assets.models import Asset
+
+        if batch_size is None:
+            batch_size = current_app.config.get('SAGE_UPLOAD_BATCH_SIZE', 50)
+
+        whitelist = current_app.config.get('SAGE_MIME_TYPE_WHITELIST_EXTENSIONS', [])
+        supported = []
+        for annotation in annotations:
+            if annotation.asset is None:
+                message = f'Annotation {annotation} has no asset, cannot send annotation to Sage'
+                AuditLog.audit_log_object_error(log, annotation, message)
+                log.error(message)
+                continue
+            if annotation.asset.mime_type not in whitelist:
+                log.info(
+                    'Cannot sync Annotation %r with unsupported SAGE MIME type %r on Asset, skipping'
+                    % (
+                        annotation,
+                        annotation.asset.mime_type,
+                    )
+                )
+                continue
+            supported.append(annotation)
+
+        # First, ensure that the annotations' assets have been synced with Sage
+        if not skip_asset:
+            assets = {annotation.asset.guid: annotation.asset for annotation in supported}
+            Asset.sync_many_with_sage(
+                list(assets.values()),
+                ensure=ensure,
+                force=force,
+                bulk_sage_uuids=bulk_sage_uuids,
+                batch_size=batch_size,
+                **kwargs,
+            )
+
+        ready = []
+        for annotation in supported:
+            if annotation.asset.content_guid is None:
+                message = f'Asset for Annotation {annotation} failed to send, cannot send annotation to Sage'
+                AuditLog.audit_log_object_error(log, annotation, message)
+                log.error(message)
+                continue
+            ready.append(annotation)
+
+        if ensure and not force:
+            if bulk_sage_uuids is None or 'annotation' not in bulk_sage_uuids:
+                content_guids = [annotation.content_guid for annotation in ready]
+                bulk_sage_uuids = {
+                    'annotation': cls.get_sage_existing_uuids(content_guids),
+                }
+
+        pending = []
+        for annotation in ready:
+            if force or annotation.content_guid is None:
+                pending.append(annotation)
+            elif ensure and annotation.content_guid not in bulk_sage_uuids['annotation']:
+                # A non-NULL content guid that isn't on the Sage instance
+                pending.append(annotation)
+
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start : start + batch_size]
+
+            creates = []
+            for annotation in batch:
+                try:
+                    annotation.validate_bounds(annotation.bounds)
+                except Exception:
+                    message = f'Annotation {annotation} failed to pass validate_bounds(), cannot send annotation to Sage'
+                    AuditLog.audit_log_object_error(log, annotation, message)
+                    log.error(message)
+                    continue
+                creates.append(annotation)
+
+            sage_guids = []
+            if creates:
+                sage_request = {
+                    'image_uuid_list': [],
+                    'annot_species_list': [],
+                    'annot_bbox_list': [],
+                    'annot_name_list': [],
+                    'annot_theta_list': [],
+                }
+                for annotation in creates:
+                    if annotation.encounter and annotation.encounter.individual:
+                        annot_name = str(annotation.encounter.individual.guid)
+                    else:
+                        annot_name = SAGE_UNKNOWN_NAME
+
+                    sage_request['image_uuid_list'].append(
+                        to_sage_uuid(annotation.asset.content_guid)
+                    )
+                    sage_request['annot_species_list'].append(annotation.ia_class)
+                    sage_request['annot_bbox_list'].append(annotation.bounds['rect'])
+                    sage_request['annot_name_list'].append(annot_name)
+                    sage_request['annot_theta_list'].append(
+                        annotation.bounds.get('theta', 0)
+                    )
+
+                try:
+                    sage_response = current_app.sage.request_passthrough_result(
+                        'annotation.create', 'post', {'json': sage_request}, target='sync'
+                    )
+                    sage_guids = [
+                        from_sage_uuid(sage_uuid) for sage_uuid in sage_response
+                    ]
+                except Exception as ex:
+                    # Left without content GUIDs, the batch is retried on the next sync
+                    log.error(
+                        f'Failed to create {len(creates)} annotations on Sage: {ex}'
+                    )
+
+            created = dict(zip([annotation.guid for annotation in creates], sage_guids))
+
+            with db.session.begin(subtransactions=True):
+                for annotation in batch:
+                    annotation.content_guid = created.get(annotation.guid, None)
+                    db.session.merge(annotation)
+
     def init_progress_identification(self, parent=None, overwrite=False):
         from app.modules.progress.models import Progress
 
@@ -378,6 +540,23 @@ class Annotation(db.Model, HoustonModel, SageModel):
         # i think this technically might save a db hit vs get_individual() if only guid is needed
         return self.encounter.individual_guid if self.encounter else None
 
+    # Bulk version of get_individual_guid(), by annotation guid, one query per chunk
+    @classmethod
+    def get_individual_guids(cls, annotation_guids, chunk_size=10000):
+        from app.modules.encounters.models import Encounter
+
+        annotation_guids = sorted(set(annotation_guids))
+        individual_guids = {}
+        for chunk in ut.ichunks(annotation_guids, chunk_size):
+            rows = (
+                db.session.query(cls.guid, Encounter.individual_guid)
+                .outerjoin(Encounter, cls.encounter_guid == Encounter.guid)
+                .filter(cls.guid.in_(chunk))
+                .all()
+            )
+            individual_guids.update(rows)
+        return individual_guids
+
     def get_individual(self):
         individual = None
         if self.encounter and self.encounter.individual:
@@ -397,19 +576,91 @@ class Annotation(db.Model, HoustonModel, SageModel):
             assset_src = self.asset.src
         return assset_src
 
-    def get_matching_set(self, query=None, load=True):
+    def get_matching_set(self, query=None, load=True, use_cache=True):
         if not self.encounter_guid:
             raise ValueError(f'{self} has no Encounter so cannot be matched against')
         if not query or not isinstance(query, dict):
             query = self.get_matching_set_default_query()
         else:
             query = self.resolve_matching_set_query(query)
-        matching_set = self.elasticsearch(query, load=load, limit=None)
+
+        # Annotations with the same resolved query share the same matching set.  The
+        # key is taken before searching, so a search that races an index change is
+        # stored under the previous generation, where it is never read
+        cache_key = self.get_matching_set_cache_key(query) if use_cache else None
+        matching_set_guids = self.get_cached_matching_set(cache_key)
+        cached = matching_set_guids is not None
+        if not cached:
+            matching_set_guids = self.elasticsearch(query, load=False, limit=None)
+            self.set_cached_matching_set(cache_key, matching_set_guids)
+
+        if load:
+            matching_set = (
+                Annotation.query.filter(Annotation.guid.in_(matching_set_guids))
+                .order_by(Annotation.guid)
+                .all()
+            )
+        else:
+            matching_set = list(matching_set_guids)
+
+        cached_str = ' (cached)' if cached else ''
         log.info(
-            f'annot.get_matching_set(): finding matching set for {self} using (resolved) query {query} => {len(matching_set)} annots'
+            f'annot.get_matching_set(): finding matching set for {self} using (resolved) query {query} => {len(matching_set)} annots{cached_str}'
         )
         return matching_set
 
+    @classmethod
+    def get_matching_set_cache_key(cls, query):
+        # None when Redis is unavailable, the matching sets are not cached then
+        generation = get_shared_generation(MATCHING_SET_CACHE_GENERATION_KEY)
+        if generation is None:
+            return None
+
+        query_str = json.dumps(query, sort_keys=True, default=str)
+        digest = hashlib.sha256(query_str.encode('utf-8')).hexdigest()
+        return f'{MATCHING_SET_CACHE_PREFIX}.{generation}.{digest}'
+
+    @classmethod
+    def get_cached_matching_set(cls, cache_key):
+        if cache_key is None:
+            return None
+        try:
+            value = get_redis_connection().get(cache_key)
+        except Exception as ex:
+            log.debug(f'Unable to read the cached matching set: {ex}')
+            return None
+        if value is None:
+            return None
+        return [uuid.UUID(guid) for guid in json.loads(value)]
+
+    @classmethod
+    def set_cached_matching_set(cls, cache_key, matching_set_guids):
+        if cache_key is None:
+            return
+        value = json.dumps([str(guid) for guid in matching_set_guids])
+        try:
+            get_redis_connection().set(cache_key, value, ex=MATCHING_SET_CACHE_TIMEOUT)
+        except Exception as ex:
+            log.debug(f'Unable to cache the matching set: {ex}')
+
+    @classmethod
+    def invalidate_matching_set_cache(cls):
+        # A new generation makes every previously cached matching set unreachable
+        return bump_shared_generation(MATCHING_SET_CACHE_GENERATION_KEY) is not None
+
+    @classmethod
+    def invalidate_matching_set_cache_on_commit(cls, target=None, columns=None):
+        """
+        Invalidate the cached matching sets once the current transaction is committed,
+        if given a changed object, only when one of ``columns`` changed
+        """
+        if target is not None:
+            state = db.inspect(target)
+            if not any(state.attrs[key].history.has_changes() for key in columns):
+                return
+        if not db.has_on_commit(cls.invalidate_matching_set_cache):
+            db.on_commit(cls.invalidate_matching_set_cache)
+
     def get_matching_set_default_query(self):
         # n.b. default will not take any locationId or ownership into consideration
         parts = {'filter': []}
@@ -658,6 +909,21 @@ class Annotation(db.Model, HoustonModel, SageModel):
 
         return AnnotationElasticsearchSchema
 
+    @classmethod
+    def get_elasticsearch_load_options(cls):
+        keyword_refs = db.selectinload(Annotation.keyword_refs)
+        options = [keyword_refs.joinedload(AnnotationKeywords.keyword)]
+        if is_module_enabled('encounters'):
+            from app.modules.encounters.models import Encounter
+
+            encounter = db.joinedload(Annotation.encounter)
+            options += [
+                encounter.joinedload(Encounter.owner),
+                encounter.joinedload(Encounter.time),
+                encounter.joinedload(Encounter.sighting),
+            ]
+        return options
+
     def send_to_identification(self, matching_set_query=None):
         sighting = self.get_sighting()
         if not sighting:
@@ -669,3 +935,14 @@ class Annotation(db.Model, HoustonModel, SageModel):
         sighting.validate_id_configs()
         job_count = sighting.send_annotation_for_identification(self, matching_set_query)
         return job_count
+
+
+@db.event.listens_for(Annotation, 'after_insert')
+@db.event.listens_for(Annotation, 'after_delete')
+def annotation_invalidate_matching_set_cache(mapper, connection, target):
+    Annotation.invalidate_matching_set_cache_on_commit()
+
+
+@db.event.listens_for(Annotation, 'after_update')
+def annotation_update_invalidate_matching_set_cache(mapper, connection, target):
+    Annotation.invalidate_matching_set_cache_on_commit(target, MATCHING_SET_CACHE_COLUMNS)
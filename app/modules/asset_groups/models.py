@@ -886,9 +886,9 @@ class AssetGroupSighting(db.Model, HoustonModel):
         asset_sage_data = []
 
         if preload:
-            # Ensure that the assets exist on Sage
+            # Ensure that the assets exist on Sage, uploading the missing ones in bulk
+            Asset.sync_many_with_sage(assets, ensure=True)
             for asset in assets:
-                asset.sync_with_sage(ensure=True)
                 asset_sage_data.append(
                     (
                         to_sage_uuid(asset.content_guid),
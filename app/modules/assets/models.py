@@ -3,6 +3,8 @@
 Assets database models
 --------------------
 """
+import datetime
+import json
 import logging
 import os
 import pathlib
@@ -21,6 +23,75 @@ from app.utils import HoustonException
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+ASSET_BULK_CHUNK_SIZE = 1000
+# Fewer images than this are read in the calling thread, a pool is not worth starting
+ASSET_META_PARALLEL_MIN = 16
+
+# EXIF tags and IFDs
+EXIF_ORIENTATION = 0x0112
+EXIF_DATETIME = 0x0132
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+EXIF_GPS_IFD = 0x8825
+
+
+def _exif_gps_degrees(value, ref):
+    degrees, minutes, seconds = (float(part) for part in value)
+    degrees = degrees + minutes / 60.0 + seconds / 3600.0
+    if ref in ('S', 'W'):
+        degrees = -degrees
+    return degrees
+
+
+def extract_image_meta(filepath):
+    """
+    Read the dimensions, and the EXIF orientation, capture time and GPS location of
+    an image, only the headers are read (PIL opens lazily, the pixels are not decoded)
+    """
+    dmeta = {}
+    with Image.open(filepath) as im:
+        dmeta['width'] = im.size[0]
+        dmeta['height'] = im.size[1]
+
+        try:
+            exif = im.getexif()
+        except Exception:
+            return dmeta
+
+        orientation = exif.get(EXIF_ORIENTATION, None)
+        if orientation is not None:
+            dmeta['orientation'] = int(orientation)
+
+        try:
+            capture_time = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL, None)
+            capture_time = capture_time or exif.get(EXIF_DATETIME, None)
+            if capture_time:
+                capture_time = str(capture_time).strip('\x00 ')
+                capture_time = datetime.datetime.strptime(
+                    capture_time, '%Y:%m:%d %H:%M:%S'
+                )
+                dmeta['time'] = capture_time.isoformat()
+        except Exception:
+            pass
+
+        try:
+            gps = exif.get_ifd(EXIF_GPS_IFD)
+            if 2 in gps and 4 in gps:
+                latitude = _exif_gps_degrees(gps[2], gps.get(1, 'N'))
+                longitude = _exif_gps_degrees(gps[4], gps.get(3, 'E'))
+                if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+                    dmeta['gps'] = {'latitude': latitude, 'longitude': longitude}
+                    if 6 in gps:
+                        altitude = float(gps[6])
+                        # Reference 1 is below sea level
+                        if gps.get(5, 0) in (1, b'\x01'):
+                            altitude = -altitude
+                        dmeta['gps']['altitude'] = altitude
+        except Exception:
+            pass
+
+    return dmeta
+
 
 class AssetTags(db.Model, HoustonModel):
     asset_guid = db.Column(db.GUID, db.ForeignKey('asset.guid'), primary_key=True)
@@ -56,6 +127,7 @@ class Asset(db.Model, HoustonModel, SageModel):
         db.GUID, nullable=False, unique=True
     )  # must be unique for (AssetGroup.guid, asset.filesystem_guid)
     content_guid = db.Column(db.GUID, nullable=True)
+    sage_synced = db.Column(db.DateTime, index=True, nullable=True)
 
     title = db.Column(db.String(length=128), nullable=True)
     description = db.Column(db.String(length=255), nullable=True)
@@ -98,6 +170,10 @@ class Asset(db.Model, HoustonModel, SageModel):
         'abox': [1024, 1024],
     }
 
+    # Formats built ahead of time by make_derived_formats(); abox is drawn from the
+    # current annotations, so it is left to be generated on demand
+    PREGENERATED_FORMATS = ['master', 'mid', 'thumb']
+
     def __repr__(self):
         return (
             '<{class_name}('
@@ -295,9 +371,15 @@ class Asset(db.Model, HoustonModel, SageModel):
     def get_sage_sync_tags(cls):
         return 'asset', 'image'
 
-    def sync_with_sage(self, ensure=False, force=False, bulk_sage_uuids=None, **kwargs):
-        from app.extensions.sage import from_sage_uuid
+    def is_synced_with_sage(self):
+        # Unsupported MIME types are never sent to Sage, so there is nothing to retry
+        if self.mime_type not in current_app.config.get(
+            'SAGE_MIME_TYPE_WHITELIST_EXTENSIONS', []
+        ):
+            return True
+        return self.content_guid is not None
 
+    def sync_with_sage(self, ensure=False, force=False, bulk_sage_uuids=None, **kwargs):
         if self.mime_type not in current_app.config.get(
             'SAGE_MIME_TYPE_WHITELIST_EXTENSIONS', []
         ):
@@ -347,19 +429,12 @@ class Asset(db.Model, HoustonModel, SageModel):
         image_filepath = symlink.resolve()
         if os.path.exists(image_filepath):
             try:
-                with open(image_filepath, 'rb') as image_file:
-                    files = {
-                        'image': image_file,
-                    }
-                    sage_response = current_app.sage.request_passthrough_result(
-                        'asset.upload', 'post', {'files': files}, target='sync'
-                    )
-                    sage_guid = from_sage_uuid(sage_response)
+                sage_guid = current_app.sage.upload_image(image_filepath)
 
-                    with db.session.begin(subtransactions=True):
-                        self.content_guid = sage_guid
-                        db.session.merge(self)
-                    db.session.refresh(self)
+                with db.session.begin(subtransactions=True):
+                    self.content_guid = sage_guid
+                    db.session.merge(self)
+                db.session.refresh(self)
             except Exception:
                 message = f'Asset {self} is corrupted or an incompatible type, cannot send to Sage'
                 AuditLog.audit_log_object_error(log, self, message)
@@ -370,6 +445,84 @@ class Asset(db.Model, HoustonModel, SageModel):
             AuditLog.audit_log_object_error(log, self, message)
             log.error(message)
 
+    @classmethod
+    def sync_many_with_sage(
+        cls,
+        assets,
+        ensure=False,
+        force=False,
+        bulk_sage_uuids=None,
+        workers=None,
+        batch_size=None,
+        **kwargs,
+    ):
+        """
+        Bulk version of sync_with_sage(), the existence of the assets on Sage is checked
+        with one request per batch, and the missing images of each batch are uploaded
+        concurrently.  The content GUIDs are stored after every batch, so a sync that
+        failed part way only uploads the remaining assets when it is run again
+        """
+        if batch_size is None:
+            batch_size = current_app.config.get('SAGE_UPLOAD_BATCH_SIZE', 50)
+
+        whitelist = current_app.config.get('SAGE_MIME_TYPE_WHITELIST_EXTENSIONS', [])
+        supported = []
+        for asset in assets:
+            if asset.mime_type not in whitelist:
+                log.info(
+                    'Cannot sync Asset %r with unsupported SAGE MIME type %r, skipping'
+                    % (
+                        asset,
+                        asset.mime_type,
+                    )
+                )
+                continue
+            supported.append(asset)
+
+        if ensure and not force:
+            if bulk_sage_uuids is None or 'asset' not in bulk_sage_uuids:
+                content_guids = [asset.content_guid for asset in supported]
+                bulk_sage_uuids = {'asset': cls.get_sage_existing_uuids(content_guids)}
+
+        pending = []
+        for asset in supported:
+            if force or asset.content_guid is None:
+                pending.append(asset)
+            elif ensure and asset.content_guid not in bulk_sage_uuids['asset']:
+                # A non-NULL content guid that isn't on the Sage instance
+                pending.append(asset)
+
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start : start + batch_size]
+
+            uploads, image_filepaths, messages = [], [], []
+            for asset in batch:
+                image_filepath = asset.get_symlink().resolve()
+                if os.path.exists(image_filepath):
+                    uploads.append(asset)
+                    image_filepaths.append(image_filepath)
+                else:
+                    messages.append(
+                        (asset, f'Asset {asset} is missing on disk, cannot send to Sage')
+                    )
+
+            sage_guids = current_app.sage.upload_images(image_filepaths, workers=workers)
+            uploaded = dict(zip([asset.guid for asset in uploads], sage_guids))
+
+            with db.session.begin(subtransactions=True):
+                for asset in batch:
+                    asset.content_guid = uploaded.get(asset.guid, None)
+                    db.session.merge(asset)
+
+            for asset in uploads:
+                if asset.content_guid is None:
+                    message = f'Asset {asset} is corrupted or an incompatible type, cannot send to Sage'
+                    messages.append((asset, message))
+
+            for asset, message in messages:
+                AuditLog.audit_log_object_error(log, asset, message)
+                log.error(message)
+
     # this property is so that schema can output { "filename": "original_filename.jpg" }
     @property
     def filename(self):
@@ -438,26 +591,26 @@ class Asset(db.Model, HoustonModel, SageModel):
     # This relates to if the user can access to viewing an asset if it was specifically in a sighting's ID result that the user has access to view
     def user_can_access(self, user=None):
         from app.modules.annotations.models import Annotation
+        from app.modules.sightings.models import Sighting
         from app.modules.users.permissions.rules import ObjectActionRule
         from app.modules.users.permissions.types import AccessOperation
 
         if user is None:
             user = current_user
 
-        users = []
-        users.append(user)
+        user_guids = [user.guid]
         for collaboration in user.get_collaboration_associations():
-            users.append(collaboration.get_other_user())
+            user_guids.append(collaboration.get_other_user().guid)
 
-        sightings = []
-        for user in users:
-            sightings += user.get_sightings()
+        # Only load the sightings of these users that the user can read
+        sightings = Sighting.query.filter(Sighting.get_owned_by_filter(user_guids))
+        sightings = ObjectActionRule.filter_query(
+            Sighting, user, AccessOperation.READ, sightings
+        )
 
         annotation_guids = []
         for sighting in sightings:
-            rule = ObjectActionRule(sighting, AccessOperation.READ, user)
-            if rule.check():
-                annotation_guids += sighting.get_matched_annotation_guids()
+            annotation_guids += sighting.get_matched_annotation_guids()
 
         annotation_guids = sorted(set(annotation_guids))
 
@@ -477,22 +630,46 @@ class Asset(db.Model, HoustonModel, SageModel):
     #
     #  TODO - this now is a very basic stub -- it is operating on original file and *very* likely fails
     #  due to exif/orientation info
-    def set_derived_meta(self):
+    def set_derived_meta(self, dmeta=None):
         if not self.is_mime_type_major('image'):
             return None
-        dmeta = {}
-        source_path = self.get_symlink()
-        assert source_path.exists()
-        with Image.open(source_path) as im:
-            size = im.size
-            dmeta['width'] = size[0]
-            dmeta['height'] = size[1]
+        if dmeta is None:
+            source_path = self.get_symlink()
+            assert source_path.exists()
+            dmeta = extract_image_meta(source_path)
         meta = self.meta if self.meta else {}
         meta['derived'] = dmeta
         self.meta = meta
         log.debug(f'setting meta.derived to {dmeta}')
         return dmeta
 
+    @classmethod
+    def set_derived_meta_many(cls, assets, callback=None):
+        """Bulk version of set_derived_meta(), reading the image headers on a thread pool"""
+        from app.extensions import parallel
+
+        images = {
+            asset.guid: asset for asset in assets if asset.is_mime_type_major('image')
+        }
+        images = list(images.values())
+        source_paths = [str(asset.get_symlink()) for asset in images]
+
+        if len(images) < ASSET_META_PARALLEL_MIN:
+            dmetas = [extract_image_meta(source_path) for source_path in source_paths]
+            if callback is not None:
+                callback(len(images), len(images))
+        else:
+            dmetas = parallel(
+                extract_image_meta,
+                [(source_path,) for source_path in source_paths],
+                thread=True,
+                desc='Image Metadata',
+                callback=callback,
+            )
+
+        for asset, dmeta in zip(images, dmetas):
+            asset.set_derived_meta(dmeta=dmeta)
+
     def get_image_url(self):
         return url_for(
             'api.assets_asset_src_u_by_id_2', asset_guid=self.guid, _external=True
@@ -516,7 +693,12 @@ class Asset(db.Model, HoustonModel, SageModel):
         assert format in self.FORMATS
         target_path = self.get_derived_path(format)
         if target_path.exists():
-            return target_path
+            if format != 'abox':
+                return target_path
+            # Redraw the boxes if the annotations changed since abox was made
+            modified = datetime.datetime.utcfromtimestamp(target_path.stat().st_mtime)
+            if modified >= self.get_format_last_modified(format):
+                return target_path
         log.info(
             'get_or_make_format_path() attempting to create format %r as %r'
             % (
@@ -525,19 +707,108 @@ class Asset(db.Model, HoustonModel, SageModel):
             )
         )
 
+        if format in self.PREGENERATED_FORMATS:
+            # Not yet built in the background, build them all from one decode now
+            return self.make_derived_formats()[format]
+
         # we make all non-master images _from_ master format (where we assume more work will be done?
         source_path = self.get_or_make_master_format_path()
-        if format == 'master':  # if so, we are done!
-            return source_path
 
         with Image.open(source_path) as source_image:
             source_image.thumbnail(self.FORMATS[format])
             if format == 'abox':
                 source_image = self.draw_annotations(source_image)
-            source_image.save(target_path)
+            self._save_derived_image(source_image, target_path)
 
         return target_path
 
+    def get_format_etag(self, format):
+        """
+        Strong ETag for a derived format, built only from database state so a
+        conditional request can be answered without touching the disk
+        """
+        import hashlib
+
+        parts = [self.filesystem_xxhash64, format, self.updated.isoformat()]
+        if format == 'abox':
+            # abox is drawn from the annotations, so their boxes are part of it
+            for annotation in self.annotations:
+                bounds = json.dumps(annotation.bounds, sort_keys=True)
+                parts += [str(annotation.guid), bounds]
+        return hashlib.sha256(':'.join(parts).encode('utf-8')).hexdigest()
+
+    def get_format_last_modified(self, format):
+        last_modified = self.updated
+        if format == 'abox':
+            for annotation in self.annotations:
+                last_modified = max(last_modified, annotation.updated)
+        # HTTP dates have a resolution of seconds
+        return last_modified.replace(microsecond=0)
+
+    def make_derived_formats(self, formats=None, force=False):
+        """
+        Build the derived images for ``formats`` (default: PREGENERATED_FORMATS),
+        decoding the source image once and downscaling from largest to smallest
+
+        Returns a dict of format to path. Existing derived images are kept
+        unless ``force`` is set.
+        """
+        if formats is None:
+            formats = self.PREGENERATED_FORMATS
+        assert (
+            'abox' not in formats
+        ), 'abox depends on annotations, use get_or_make_format_path()'
+
+        paths = {format: self.get_derived_path(format) for format in formats}
+        missing = [format for format in formats if force or not paths[format].exists()]
+        if not missing:
+            return paths
+
+        source_path = self.get_symlink()
+        if not source_path.exists():
+            raise HoustonException(
+                log,
+                'Asset does not have a valid path, needs to be within an AssetGroup',
+                obj=self,
+            )
+        paths['master'] = self.get_derived_path('master')
+        paths['master'].parent.mkdir(parents=True, exist_ok=True)
+
+        # Largest first, so each smaller format is downscaled from the previous one
+        ordered = sorted(
+            missing,
+            key=lambda format: self.FORMATS[format][0] * self.FORMATS[format][1],
+            reverse=True,
+        )
+        log.info('make_derived_formats() creating formats %r for %r' % (ordered, self))
+
+        master_exists = paths['master'].exists() and 'master' not in missing
+        image_path = paths['master'] if master_exists else source_path
+        with Image.open(image_path) as source_image:
+            # Let the JPEG decoder downscale by a power of two where it can, keeping
+            # the same 2x reducing gap thumbnail() uses so the quality is unchanged
+            width, height = self.FORMATS['master']
+            source_image.draft(None, (width * 2, height * 2))
+            source_image.thumbnail(self.FORMATS['master'])
+            image = source_image.convert('RGB')
+
+        for format in ordered:
+            image.thumbnail(self.FORMATS[format])
+            self._save_derived_image(image, paths[format])
+
+        return {format: paths[format] for format in formats}
+
+    def _save_derived_image(self, image, target_path):
+        # Write beside the target and rename, so readers never see a partial file
+        target_path = pathlib.Path(target_path)
+        temp_path = target_path.with_name(f'.{target_path.name}.{uuid.uuid4().hex}')
+        try:
+            image.save(temp_path, format='JPEG')
+            os.replace(temp_path, target_path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+        return target_path
+
     # currently only works with boxy annotations and theta=0
     def draw_annotations(self, image):
         if not self.annotations:
@@ -595,6 +866,8 @@ class Asset(db.Model, HoustonModel, SageModel):
     def reset_derived_images(self):
         # Reset metadata
         self.set_derived_meta()
+        # Derived images are about to change, which also changes their ETag
+        self.updated = datetime.datetime.utcnow()
         # Delete derived images (generated next time they're fetched)
         for format in self.FORMATS:
             self.get_derived_path(format).unlink(missing_ok=True)
@@ -626,25 +899,7 @@ class Asset(db.Model, HoustonModel, SageModel):
     # note: Image seems to *strip exif* sufficiently here (tested with gps, comments, etc) so this may be enough!
     # also note: this fails horribly in terms of exif orientation.  wom-womp
     def get_or_make_master_format_path(self):
-        source_path = self.get_symlink()
-        if not source_path.exists():
-            raise HoustonException(
-                log,
-                'Asset does not have a valid path, needs to be within an AssetGroup',
-                obj=self,
-            )
-        target_path = self.get_derived_path('master')
-        target_path.parent.mkdir(parents=True, exist_ok=True)
-        if target_path.exists():
-            return target_path
-        log.info(
-            'make_master_format() creating master format as {!r}'.format(target_path)
-        )
-        with Image.open(source_path) as source_image:
-            source_image.thumbnail(self.FORMATS['master'])
-            rgb = source_image.convert('RGB')
-            rgb.save(target_path)
-        return target_path
+        return self.make_derived_formats(formats=['master'])['master']
 
     def delete_relationships(self, delete_unreferenced_tags=True):
         for annotation in self.annotations:
@@ -688,6 +943,105 @@ class Asset(db.Model, HoustonModel, SageModel):
             return None
         return cls.query.get(guid)
 
+    # Bulk lookup of the assets keyed on semantic_guid, one query per chunk
+    @classmethod
+    def find_by_semantic_guids(cls, semantic_guids, chunk_size=ASSET_BULK_CHUNK_SIZE):
+        semantic_guids = list(semantic_guids)
+        assets = {}
+        for start in range(0, len(semantic_guids), chunk_size):
+            chunk = semantic_guids[start : start + chunk_size]
+            for asset in cls.query.filter(cls.semantic_guid.in_(chunk)):
+                assets[asset.semantic_guid] = asset
+        return assets
+
+    @classmethod
+    def bulk_upsert(cls, files_data, chunk_size=ASSET_BULK_CHUNK_SIZE):
+        """
+        Create or update the Asset of each file data dict, keyed on its semantic_guid,
+        with one lookup query and one multi-row INSERT per chunk and a single flush of
+        the updates.  Returns the assets in the order of files_data
+        """
+        from sqlalchemy.dialects import postgresql
+
+        # These identify an existing Asset, and an existing Asset keeps its guid
+        search_keys = [
+            'guid',
+            'filesystem_guid',
+            'semantic_guid',
+            'git_store_guid',
+        ]
+
+        # Duplicate files are merged as if they were added one at a time, the first
+        # one creates the Asset and the later ones update it
+        merged = {}
+        for file_data in files_data:
+            semantic_guid = file_data['semantic_guid']
+            if semantic_guid in merged:
+                merged[semantic_guid].update(
+                    {key: value for key, value in file_data.items() if key != 'guid'}
+                )
+            else:
+                merged[semantic_guid] = dict(file_data)
+
+        existing = cls.find_by_semantic_guids(merged.keys(), chunk_size=chunk_size)
+        log.info(
+            'Found %d existing of %d assets by semantic_guid'
+            % (
+                len(existing),
+                len(merged),
+            )
+        )
+
+        rows = []
+        for semantic_guid, file_data in merged.items():
+            if semantic_guid not in existing:
+                row = dict(file_data)
+                if row.get('guid', None) is None:
+                    row['guid'] = uuid.uuid4()
+                rows.append(row)
+
+        with db.session.begin(subtransactions=True):
+            for semantic_guid, asset in existing.items():
+                for key, value in merged[semantic_guid].items():
+                    if key in search_keys:
+                        continue
+                    setattr(asset, key, value)
+
+            if rows:
+                table = cls.__table__
+                if db.engine.dialect.name == 'postgresql':
+                    # Multi-row VALUES, an Asset created concurrently is loaded below
+                    statement = postgresql.insert(table).on_conflict_do_nothing(
+                        index_elements=[table.c.semantic_guid]
+                    )
+                    for start in range(0, len(rows), chunk_size):
+                        db.session.execute(
+                            statement.values(rows[start : start + chunk_size])
+                        )
+                else:
+                    db.session.execute(table.insert(), rows)
+
+        # Load the created assets, the existing ones are already in the session
+        assets = cls.find_by_semantic_guids(
+            [row['semantic_guid'] for row in rows], chunk_size=chunk_size
+        )
+
+        if assets:
+            from app.extensions import elasticsearch as es
+
+            # The Core INSERT skips the ORM hooks, so index the created assets in bulk
+            # and remember them in the GUID cache as an ORM insert would
+            cls._index_all_chunked(
+                [asset.guid for asset in assets.values()],
+                force=True,
+                chunk_size=chunk_size,
+            )
+            for asset in assets.values():
+                es.es_guid_cache_add(asset)
+
+        assets.update(existing)
+        return [assets[file_data['semantic_guid']] for file_data in files_data]
+
     def user_is_owner(self, user: User) -> bool:
         # Asset has no owner, but it has one git_store that has an owner
         return self.git_store.user_is_owner(user)
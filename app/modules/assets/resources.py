@@ -9,7 +9,7 @@ import logging
 from http import HTTPStatus
 
 import werkzeug
-from flask import request, send_file
+from flask import current_app, request, send_file
 
 from app.extensions import db
 from app.extensions.api import Namespace
@@ -169,6 +169,23 @@ class AssetSrcUByID(Resource):
         },
     )
     def get(self, asset, format):
+        if format not in asset.FORMATS:
+            raise werkzeug.exceptions.NotImplemented
+
+        # Answer conditional requests from the database alone, before any disk access
+        etag = asset.get_format_etag(format)
+        last_modified = asset.get_format_last_modified(format)
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            if_modified_since = request.if_modified_since
+            not_modified = if_modified_since is not None and (
+                last_modified <= if_modified_since
+            )
+        if not_modified:
+            response = current_app.response_class(status=HTTPStatus.NOT_MODIFIED)
+            return self._set_cache_headers(response, format, etag, last_modified)
+
         cls = type(asset.git_store)
         cls.ensure_store(asset.git_store_guid)
 
@@ -177,7 +194,24 @@ class AssetSrcUByID(Resource):
         except Exception:
             logging.exception('Got exception from get_or_make_format_path()')
             raise werkzeug.exceptions.NotImplemented
-        return send_file(asset_format_path, asset.DERIVED_MIME_TYPE)
+        response = send_file(asset_format_path, asset.DERIVED_MIME_TYPE, add_etags=False)
+        return self._set_cache_headers(response, format, etag, last_modified)
+
+    @staticmethod
+    def _set_cache_headers(response, format, etag, last_modified):
+        max_age = current_app.config['ASSET_SRC_CACHE_MAX_AGE'].get(format, 0)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        public = current_app.config['ASSET_SRC_CACHE_PUBLIC']
+        response.cache_control.public = public
+        response.cache_control.private = not public
+        response.cache_control.max_age = max_age
+        # send_file() adds its own Expires, max-age above is the single source of truth
+        response.headers.pop('Expires', None)
+        if not max_age:
+            # Always revalidate, which is cheap with the ETag
+            response.cache_control.no_cache = True
+        return response
 
 
 @api.route('/src_raw/<uuid:asset_guid>', doc=False)
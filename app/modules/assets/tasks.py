@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from app.extensions.celery import celery
+
+log = logging.getLogger(__name__)
+
+
+@celery.task
+def make_derived_formats(asset_guids):
+    from .models import Asset
+
+    for asset_guid in asset_guids:
+        asset = Asset.query.get(asset_guid)
+        if asset is None:
+            log.warning(f'Failed to find the asset {asset_guid} to derive formats for')
+            continue
+        if not asset.is_mime_type_major('image'):
+            continue
+        try:
+            asset.make_derived_formats()
+        except Exception:
+            log.exception(f'Failed to derive formats for asset {asset_guid}')
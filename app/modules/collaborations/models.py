@@ -3,6 +3,7 @@
 Collaborations database models
 --------------------
 """
+import json
 import logging
 import uuid
 
@@ -10,10 +11,16 @@ from flask_login import current_user
 
 import app.extensions.logging as AuditLog
 from app.extensions import HoustonModel, db
-from app.utils import HoustonException
+from app.utils import HoustonException, bump_shared_generation, get_shared_generation
 
 log = logging.getLogger(__name__)
 
+# Peers are shared through Redis, under a generation that is bumped every time a
+# collaboration change is committed
+COLLABORATION_PEERS_CACHE_PREFIX = 'collaboration.peers'
+COLLABORATION_PEERS_GENERATION_KEY = f'{COLLABORATION_PEERS_CACHE_PREFIX}.generation'
+COLLABORATION_PEERS_CACHE_TIMEOUT = 60 * 10
+
 
 class CollaborationUserState:
     ALLOWED_STATES = [
@@ -162,37 +169,99 @@ class Collaboration(db.Model, HoustonModel):
 
     @classmethod
     def get_users_for_read(cls, user):
-        return cls.get_users_for_approval_state(
-            user, CollaborationUserAssociations.read_approval_state
-        )
+        return cls.get_users_for_approval_state(user, 'read')
 
     @classmethod
     def get_users_for_write(cls, user):
-        return cls.get_users_for_approval_state(
-            user, CollaborationUserAssociations.edit_approval_state
-        )
+        return cls.get_users_for_approval_state(user, 'edit')
 
     @classmethod
     def get_users_for_approval_state(cls, user, approval_state_field):
-        # First find all the collaborations approved by the user
-        collab_guids = [
-            cua[0]
-            for cua in CollaborationUserAssociations.query.filter(
-                CollaborationUserAssociations.user_guid == user.guid
+        from app.modules.users.models import User
+
+        user_guids = cls.get_peer_guids(user.guid)[approval_state_field]
+        if not user_guids:
+            return []
+        return User.query.filter(User.guid.in_(user_guids)).all()
+
+    @classmethod
+    def get_peer_guids(cls, user_guid):
+        """
+        Return the adjacency of ``user_guid`` in the collaboration graph, as
+        ``{'read': [guid, ...], 'edit': [guid, ...]}``, the users with an approved
+        (on both sides) read or edit collaboration with this user
+
+        Served from the cache, which is invalidated once collaboration changes are
+        committed.  The cache is not used while the current transaction has changes
+        of its own, nor when Redis is unavailable.
+        """
+        from app.utils import get_redis_connection
+
+        generation = None
+        if not db.has_on_commit(cls.invalidate_peer_guids):
+            generation = get_shared_generation(COLLABORATION_PEERS_GENERATION_KEY)
+        if generation is None:
+            return cls._query_peer_guids(user_guid)
+
+        # The generation is read before querying, a query that races a change is
+        # stored under the previous generation, where it is never read
+        cache_key = f'{COLLABORATION_PEERS_CACHE_PREFIX}.{generation}.{user_guid}'
+        try:
+            value = get_redis_connection().get(cache_key)
+        except Exception as ex:
+            log.debug(f'Unable to read the cached collaboration peers: {ex}')
+            return cls._query_peer_guids(user_guid)
+        if value is not None:
+            peers = json.loads(value)
+            return {
+                field: [uuid.UUID(guid) for guid in guids]
+                for field, guids in peers.items()
+            }
+
+        peers = cls._query_peer_guids(user_guid)
+        value = json.dumps(
+            {field: [str(guid) for guid in guids] for field, guids in peers.items()}
+        )
+        try:
+            get_redis_connection().set(
+                cache_key, value, ex=COLLABORATION_PEERS_CACHE_TIMEOUT
             )
-            .filter(approval_state_field == CollaborationUserState.APPROVED)
-            .values(CollaborationUserAssociations.collaboration_guid)
-        ]
-        # Then find all the users associated to the collaborations
-        # approved by the other users
-        return [
-            cua.user
-            for cua in CollaborationUserAssociations.query.filter(
-                CollaborationUserAssociations.collaboration_guid.in_(collab_guids)
+        except Exception as ex:
+            log.debug(f'Unable to cache the collaboration peers: {ex}')
+        return peers
+
+    @classmethod
+    def _query_peer_guids(cls, user_guid):
+        # Pair the user's associations with the other member of the same collaboration
+        mine = db.aliased(CollaborationUserAssociations)
+        other = db.aliased(CollaborationUserAssociations)
+        rows = (
+            db.session.query(
+                other.user_guid,
+                mine.read_approval_state,
+                other.read_approval_state,
+                mine.edit_approval_state,
+                other.edit_approval_state,
             )
-            .filter(CollaborationUserAssociations.user_guid != user.guid)
-            .filter(approval_state_field == CollaborationUserState.APPROVED)
-        ]
+            .join(other, other.collaboration_guid == mine.collaboration_guid)
+            .filter(mine.user_guid == user_guid)
+            .filter(other.user_guid != user_guid)
+            .all()
+        )
+
+        approved = CollaborationUserState.APPROVED
+        peers = {'read': set(), 'edit': set()}
+        for other_guid, my_read, other_read, my_edit, other_edit in rows:
+            if my_read == approved and other_read == approved:
+                peers['read'].add(other_guid)
+            if my_edit == approved and other_edit == approved:
+                peers['edit'].add(other_guid)
+        return {field: sorted(guids) for field, guids in peers.items()}
+
+    @classmethod
+    def invalidate_peer_guids(cls):
+        # A new generation makes the cached peers of every user unreachable
+        bump_shared_generation(COLLABORATION_PEERS_GENERATION_KEY)
 
     def _get_association_for_user(self, user_guid):
         assoc = None
@@ -569,3 +638,17 @@ class Collaboration(db.Model, HoustonModel):
             for assoc in self.collaboration_user_associations:
                 db.session.delete(assoc)
             db.session.delete(self)
+
+
+@db.event.listens_for(CollaborationUserAssociations, 'after_insert')
+@db.event.listens_for(CollaborationUserAssociations, 'after_update')
+@db.event.listens_for(CollaborationUserAssociations, 'after_delete')
+def collaboration_user_association_changed(mapper, connection, target):
+    from app.modules.users.permissions.rules import PermissionContext
+
+    # Also catches changes made without going through the Collaboration methods.
+    # Other processes only see the change once committed, so that is when the cached
+    # peers are invalidated
+    if not db.has_on_commit(Collaboration.invalidate_peer_guids):
+        db.on_commit(Collaboration.invalidate_peer_guids)
+    PermissionContext.clear()
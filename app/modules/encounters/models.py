@@ -110,6 +110,17 @@ class Encounter(db.Model, HoustonModel, CustomFieldMixin):
 
         return ElasticsearchEncounterSchema
 
+    @classmethod
+    def get_elasticsearch_load_options(cls):
+        from app.modules.annotations.models import Annotation
+
+        return [
+            db.joinedload(Encounter.owner),
+            db.joinedload(Encounter.time),
+            db.joinedload(Encounter.sighting),
+            db.selectinload(Encounter.annotations).selectinload(Annotation.keyword_refs),
+        ]
+
     @classmethod
     def patch_elasticsearch_mappings(cls, mappings):
         mappings = super(Encounter, cls).patch_elasticsearch_mappings(mappings)
@@ -270,3 +281,13 @@ class Encounter(db.Model, HoustonModel, CustomFieldMixin):
         else:
             self.delete()
         return True, response
+
+
+@db.event.listens_for(Encounter, 'after_update')
+def encounter_update_invalidate_matching_set_cache(mapper, connection, target):
+    from app.modules.annotations.models import Annotation
+
+    # Matching set queries filter on these through the annotations of the encounter
+    Annotation.invalidate_matching_set_cache_on_commit(
+        target, {'individual_guid', 'location_guid', 'taxonomy_guid', 'owner_guid'}
+    )
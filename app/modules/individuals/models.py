@@ -143,6 +143,13 @@ class Individual(db.Model, HoustonModel, CustomFieldMixin):
     def user_is_owner(self, user):
         return user is not None and user in self.get_owners()
 
+    @classmethod
+    def get_owned_by_filter(cls, user_guids):
+        from app.modules.encounters.models import Encounter
+
+        # SQL version of user_is_owner()
+        return cls.encounters.any(Encounter.owner_guid.in_(list(user_guids)))
+
     @property
     def relationships(self):
         from app.modules.relationships.models import (
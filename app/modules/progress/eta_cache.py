@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Progress ETA cache
+------------------
+
+The ETA statistics of a Progress (its items and the etaprogress rate data) are
+updated by whichever worker runs the task and read by whichever process serves the
+request, so they are shared through Redis.  Each process keeps a bounded LRU copy,
+which is also the fallback store when Redis is not available.
+"""
+import collections
+import json
+import logging
+import threading
+import time
+
+from etaprogress.eta import ETA
+
+log = logging.getLogger(__name__)
+
+
+ETA_CACHE_KEY_PREFIX = 'progress.eta'
+# Entries of progresses that never complete expire after this many seconds without
+# an update, both in Redis and in the local copy
+ETA_CACHE_TTL = 60 * 60 * 24
+ETA_CACHE_MAX_SIZE = 1000
+# After Redis fails, only the local copy is used for this many seconds
+ETA_CACHE_RETRY_INTERVAL = 60
+
+
+def serialize_eta(pgeta):
+    if pgeta is None:
+        return None
+    return {
+        'denominator': pgeta.denominator,
+        'scope': pgeta._timing_data.maxlen,
+        'start_time': pgeta._start_time,
+        'timing_data': list(pgeta._timing_data),
+        'eta_epoch': pgeta.eta_epoch,
+        'rate': pgeta.rate,
+    }
+
+
+def deserialize_eta(data):
+    if data is None:
+        return None
+    pgeta = ETA(data['denominator'], scope=data['scope'])
+    pgeta._start_time = data['start_time']
+    pgeta._timing_data.extend(tuple(point) for point in data['timing_data'])
+    pgeta.eta_epoch = data['eta_epoch']
+    pgeta.rate = data['rate']
+    return pgeta
+
+
+class ETACache(object):
+    """
+    Bounded, process-shared store of the ETA entries of Progress objects, by guid.
+
+    An entry is a dictionary with the progress ``items``, its ``pgeta`` ETA and the
+    ``written`` (time, percentage) of the last database write.  Entries are changed
+    in place locally and shared with ``save``, ``sync`` picks up a newer shared
+    version, if any.
+    """
+
+    def __init__(self, max_size=ETA_CACHE_MAX_SIZE, ttl=ETA_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.unavailable_until = 0
+
+    def _key(self, guid):
+        return f'{ETA_CACHE_KEY_PREFIX}.{guid}'
+
+    def _version_key(self, guid):
+        return f'{self._key(guid)}.version'
+
+    def _connection(self):
+        from app.utils import get_redis_connection
+
+        if time.time() < self.unavailable_until:
+            return None
+        try:
+            return get_redis_connection()
+        except Exception as ex:
+            self._unavailable(ex)
+        return None
+
+    def _unavailable(self, ex):
+        log.debug(f'Progress ETA cache is not shared, Redis is unavailable: {ex}')
+        self.unavailable_until = time.time() + ETA_CACHE_RETRY_INTERVAL
+
+    def _new_entry(self):
+        return {
+            'items': None,
+            'pgeta': None,
+            'written': None,
+            'version': 0,
+            'accessed': time.time(),
+        }
+
+    def _evict(self, now):
+        # Entries are kept in access order, the oldest ones are first
+        while self.entries:
+            guid, entry = next(iter(self.entries.items()))
+            if len(self.entries) <= self.max_size and now - entry['accessed'] < self.ttl:
+                break
+            self.entries.pop(guid)
+
+    def get(self, guid):
+        """
+        Return the entry of this guid, loading it from Redis if it is not known locally
+        """
+        guid = str(guid)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(guid, None)
+            if entry is not None and now - entry['accessed'] >= self.ttl:
+                self.entries.pop(guid)
+                entry = None
+            if entry is not None:
+                entry['accessed'] = now
+                self.entries.move_to_end(guid)
+                return entry
+
+        entry = self._new_entry()
+        self._load(guid, entry)
+        with self.lock:
+            # Another thread may have created it meanwhile
+            entry = self.entries.setdefault(guid, entry)
+            self.entries.move_to_end(guid)
+            self._evict(now)
+        return entry
+
+    def _load(self, guid, entry):
+        conn = self._connection()
+        if conn is None:
+            return False
+        try:
+            value = conn.get(self._key(guid))
+        except Exception as ex:
+            self._unavailable(ex)
+            return False
+        if value is None:
+            return False
+        data = json.loads(value)
+        if data['version'] <= entry['version']:
+            return False
+        entry['items'] = data['items']
+        entry['pgeta'] = deserialize_eta(data['pgeta'])
+        entry['version'] = data['version']
+        return True
+
+    def sync(self, guid):
+        """
+        Replace the local entry by the shared one if another process updated it since
+        """
+        entry = self.get(guid)
+        self._load(str(guid), entry)
+        return entry
+
+    def save(self, guid):
+        """
+        Share the local entry, the items are only kept locally if they are not JSON
+        serializable
+        """
+        guid = str(guid)
+        entry = self.get(guid)
+
+        conn = self._connection()
+        if conn is None:
+            return False
+        data = {
+            'items': entry['items'],
+            'pgeta': serialize_eta(entry['pgeta']),
+        }
+        try:
+            json.dumps(data['items'])
+        except TypeError:
+            data['items'] = None
+
+        key = self._key(guid)
+        version_key = self._version_key(guid)
+
+        def write(pipeline):
+            # Versions rather than timestamps, the processes may not share a clock.  The
+            # version is read and written under WATCH, so concurrent saves get distinct,
+            # increasing versions, and it outlives pop() so a re-created entry is newer
+            version = int(pipeline.get(version_key) or 0) + 1
+            pipeline.multi()
+            pipeline.set(version_key, version, ex=self.ttl)
+            pipeline.set(key, json.dumps(dict(data, version=version)), ex=self.ttl)
+            return version
+
+        try:
+            version = conn.transaction(write, version_key, value_from_callable=True)
+        except Exception as ex:
+            self._unavailable(ex)
+            return False
+        entry['version'] = version
+        return True
+
+    def pop(self, guid):
+        guid = str(guid)
+        with self.lock:
+            self.entries.pop(guid, None)
+        conn = self._connection()
+        if conn is None:
+            return
+        try:
+            conn.delete(self._key(guid))
+        except Exception as ex:
+            self._unavailable(ex)
@@ -5,6 +5,7 @@ Progress database models
 """
 import enum
 import logging
+import time
 import uuid
 
 from etaprogress.eta import ETA
@@ -12,12 +13,17 @@ from sqlalchemy_utils import Timestamp
 
 from app.extensions import db
 
+from .eta_cache import ETACache
+
 log = logging.getLogger(__name__)
 
 
-ETA_CACHE = {}
-BROKER = None
-DEFAULT_CELERY_QUEUE_NAME = 'celery'
+# The ETA statistics are shared by all processes, see eta_cache
+ETA_CACHE = ETACache()
+# Coalesced updates are only written once they move this many percentage points, or
+# once this many seconds have passed since the last write
+PROGRESS_COALESCE_DELTA = 5
+PROGRESS_COALESCE_INTERVAL = 1.0
 
 
 class ProgressStatus(str, enum.Enum):
@@ -80,28 +86,30 @@ class Progress(db.Model, Timestamp):
 
     @property
     def items(self):
-        key = self._eta_cache_key()
-        return ETA_CACHE[key]['items']
+        return ETA_CACHE.get(self.guid)['items']
 
     @items.setter
     def items(self, value):
-        global ETA_CACHE
-        key = self._eta_cache_key()
-        ETA_CACHE[key]['items'] = value
+        ETA_CACHE.get(self.guid)['items'] = value
 
     @property
     def pgeta(self):
-        key = self._eta_cache_key()
-        return ETA_CACHE[key]['pgeta']
+        return ETA_CACHE.get(self.guid)['pgeta']
 
     @pgeta.setter
     def pgeta(self, value):
-        global ETA_CACHE
-        key = self._eta_cache_key()
-        ETA_CACHE[key]['pgeta'] = value
+        ETA_CACHE.get(self.guid)['pgeta'] = value
 
     @property
     def current_eta(self):
+        try:
+            # The progress may be updated by another process
+            ETA_CACHE.sync(self.guid)
+        except Exception:
+            return None
+        return self._eta_seconds()
+
+    def _eta_seconds(self):
         try:
             if self.items is None or self.pgeta is None:
                 return None
@@ -156,64 +164,20 @@ class Progress(db.Model, Timestamp):
         return None
 
     def _attempt_ahead(self):
-        import json
-
-        import redis
-
-        global BROKER
-
-        from flask import current_app
+        from app.extensions import queue_position
 
         if self.celery_guid is None and self.sage_guid is None:
             return None
 
         if self.celery_guid:
-            if BROKER is None:
-                BROKER = redis.Redis(
-                    host=current_app.config['REDIS_HOST'],
-                    port=current_app.config['REDIS_PORT'],
-                    db=current_app.config['REDIS_DATABASE'],
-                    password=current_app.config['REDIS_PASSWORD'],
-                )
-
-            # inspect = current_app.celery.control.inspect()
-            # workers = inspect.ping()
-
-            total = BROKER.llen(DEFAULT_CELERY_QUEUE_NAME)
-            if total is None:
-                total = 0
-
-            for index in range(total):
-                try:
-                    message = BROKER.lindex(DEFAULT_CELERY_QUEUE_NAME, index)
-                    data = json.loads(message)
-                    celery_guid = data.get('headers', {}).get('id', None)
-                    if celery_guid:
-                        celery_guid = uuid.UUID(celery_guid)
-                        if celery_guid == self.celery_guid:
-                            ahead = total - 1 - index
-                            if ahead > 0:
-                                return ahead
-                except Exception:
-                    pass
+            ahead = queue_position.celery_task_ahead(self.celery_guid)
+            if ahead:
+                return ahead
 
         if self.sage_guid:
-            passthrough_kwargs = {'timeout': 15}
-            jobs = current_app.sage.request_passthrough_result(
-                'engine.list',
-                'get',
-                target='default',
-                passthrough_kwargs=passthrough_kwargs,
-            )['json_result']
-            statuses, sage_jobs = current_app.sage.get_job_status(jobs, exclude_done=True)
-
-            total = len(sage_jobs)
-            for index, sage_job in enumerate(sage_jobs):
-                sage_jobid, status = sage_job
-                if sage_jobid == str(self.sage_guid):
-                    ahead = total - 1 - index
-                    if ahead > 0:
-                        return ahead
+            ahead = queue_position.sage_job_ahead(self.sage_guid)
+            if ahead:
+                return ahead
 
         return 0
 
@@ -249,17 +213,6 @@ class Progress(db.Model, Timestamp):
         except (ValueError, IndexError):
             raise StopIteration
 
-    def _eta_cache_key(self):
-        global ETA_CACHE
-        # key = '%s:%s' % (self.guid, id(a), )
-        key = str(self.guid)
-        if key not in ETA_CACHE:
-            ETA_CACHE[key] = {
-                'items': None,
-                'pgeta': None,
-            }
-        return key
-
     def is_public(self):
         return True
 
@@ -292,6 +245,7 @@ class Progress(db.Model, Timestamp):
             self.message = message
             db.session.merge(self)
         db.session.refresh(self)
+        self.reset()
         if self.parent:
             self.parent.notify(self.guid, chain=chain)
 
@@ -304,6 +258,7 @@ class Progress(db.Model, Timestamp):
             self.message = message
             db.session.merge(self)
         db.session.refresh(self)
+        self.reset()
         if self.parent:
             self.parent.notify(self.guid, chain=chain)
 
@@ -312,6 +267,7 @@ class Progress(db.Model, Timestamp):
         guid = self.guid
         with db.session.begin(subtransactions=True):
             db.session.delete(self)
+        self.reset()
         if parent:
             parent.notify(guid, chain=chain)
 
@@ -327,7 +283,27 @@ class Progress(db.Model, Timestamp):
 
         chain.append(self.guid)
 
-        steps = len(self.steps)
+        ETA_CACHE.sync(self.guid)
+
+        # Count the steps in the database, instead of loading or refreshing each step
+        done = db.or_(
+            Progress.status.in_([ProgressStatus.skipped, ProgressStatus.cancelled]),
+            db.and_(
+                Progress.status.in_([ProgressStatus.healthy, ProgressStatus.completed]),
+                Progress.percentage >= 100,
+            ),
+        )
+        failed = Progress.status == ProgressStatus.failed
+        steps, numerator, failures = (
+            Progress.query.filter(Progress.parent_guid == self.guid)
+            .with_entities(
+                db.func.count(Progress.guid),
+                db.func.sum(db.case([(done, 1)], else_=0)),
+                db.func.sum(db.case([(failed, 1)], else_=0)),
+            )
+            .one()
+        )
+
         if steps == 0:
             items = None
         else:
@@ -335,36 +311,25 @@ class Progress(db.Model, Timestamp):
 
         if self.items is None or self.pgeta is None:
             self.config(items)
-        elif self.items != steps or self.pgeta.denominator != steps:
+        elif len(self.items) != steps or self.pgeta.denominator != steps:
             self.config(items)
 
+        step = None
         try:
-            numerator = 0
-            for step in self.steps:
-                db.session.refresh(step)
-
-                if step is None:
-                    continue
-                elif step.skipped:
-                    numerator += 1
-                elif step.cancelled:
-                    numerator += 1
-                elif step.completed:
-                    numerator += 1
-                elif step.failed:
-                    message = 'Step {!r} failure: {!r}'.format(
-                        step,
-                        step.message,
-                    )
-                    return self.fail(message, chain=chain)
-                else:
-                    # The update was a step set progress percentage notification
-                    # Currently, do nothing because we only want to track steps that are complete
-                    pass
+            if failures:
+                step = Progress.query.filter(
+                    Progress.parent_guid == self.guid, failed
+                ).first()
+                message = 'Step {!r} failure: {!r}'.format(
+                    step,
+                    step.message,
+                )
+                return self.fail(message, chain=chain)
 
-            self.pgeta.numerator = numerator
+            # Steps still running are not counted, only the completed steps are tracked
+            self.pgeta.numerator = numerator or 0
             log.debug(
-                f'notify() step_guid={step_guid} using numerator={numerator} for {len(self.items)} items on {self}'
+                f'notify() step_guid={step_guid} using numerator={self.pgeta.numerator} for {len(self.items)} items on {self}'
             )
             self.set(100.0 * self.pgeta.numerator / len(self.items), chain=chain)
         except Exception:
@@ -403,9 +368,7 @@ class Progress(db.Model, Timestamp):
         return self
 
     def reset(self):
-        global ETA_CACHE
-        key = self._eta_cache_key()
-        ETA_CACHE.pop(key, None)
+        ETA_CACHE.pop(self.guid)
 
     def item(self, autoiterate=False):
         if self.items is None or self.pgeta is None:
@@ -430,14 +393,40 @@ class Progress(db.Model, Timestamp):
 
     def iterate(self, amount=1, chain=None):
         self.pgeta.numerator += amount
-        self.set(100.0 * self.pgeta.numerator / len(self.items), chain=chain)
+        self.set(
+            100.0 * self.pgeta.numerator / len(self.items), chain=chain, coalesce=True
+        )
 
     def increment(self, amount=1, chain=None):
         self.set(self.percentage + amount, chain=chain)
 
-    def set(self, value, items=None, force=False, chain=None):
+    def _is_coalesced(self, new_percentage):
+        written = ETA_CACHE.get(self.guid)['written']
+        if written is None or new_percentage >= 100:
+            return False
+        written_time, written_percentage = written
+        if new_percentage < written_percentage:
+            return False
+        if new_percentage - written_percentage >= PROGRESS_COALESCE_DELTA:
+            return False
+        return time.time() - written_time < PROGRESS_COALESCE_INTERVAL
+
+    def set(self, value, items=None, force=False, chain=None, coalesce=False):
+        """
+        Set the percentage, with coalesce=True (for frequent updates, e.g. per file)
+        the update is only written to the database once it has moved enough, or enough
+        time has passed since the last write.  The parent is only notified when the
+        status changes, it only tracks the steps that are done
+        """
         new_percentage = int(max(0, min(100, value)))
 
+        if coalesce and not force and self._is_coalesced(new_percentage):
+            if self.pgeta is not None and int(self.pgeta.percent) < new_percentage:
+                self.pgeta.numerator = int(
+                    self.pgeta.denominator * (new_percentage / 100.0)
+                )
+            return 'coalesced'
+
         db.session.refresh(self)
 
         if self.status not in [
@@ -468,6 +457,8 @@ class Progress(db.Model, Timestamp):
                 )
                 return 'ignored'
 
+        ETA_CACHE.sync(self.guid)
+
         if self.items is None or self.pgeta is None:
             self = self.config(items=items)
 
@@ -482,17 +473,19 @@ class Progress(db.Model, Timestamp):
                 pass
             # assert int(self.pgeta.percent) >= new_percentage
 
+        status = self.status
         with db.session.begin(subtransactions=True):
             self.percentage = new_percentage
-            self.eta = self.current_eta
+            self.eta = self._eta_seconds()
             if self.percentage >= 100:
                 self.status = ProgressStatus.completed
                 self.reset()
             else:
                 self.status = ProgressStatus.healthy
+                ETA_CACHE.get(self.guid)['written'] = (time.time(), new_percentage)
+                ETA_CACHE.save(self.guid)
             db.session.merge(self)
-        db.session.refresh(self)
-        if self.parent:
+        if self.status != status and self.parent:
             self.parent.notify(self.guid, chain=chain)
 
         return 'set'
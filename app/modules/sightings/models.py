@@ -148,6 +148,19 @@ class Sighting(db.Model, HoustonModel, CustomFieldMixin):
 
         return ElasticsearchSightingSchema
 
+    @classmethod
+    def get_elasticsearch_load_options(cls):
+        return [
+            db.joinedload(Sighting.time),
+            db.selectinload(Sighting.taxonomy_joins),
+            db.selectinload(Sighting.encounters).joinedload(Encounter.owner),
+        ]
+
+    @classmethod
+    def get_elasticsearch_search_load_options(cls):
+        # The search API returns the Elasticsearch schema
+        return cls.get_elasticsearch_load_options()
+
     # when we index this sighting, lets (re-)index annotations
     def index_hook_obj(self, *args, **kwargs):
         kwargs['force'] = True
@@ -352,6 +365,34 @@ class Sighting(db.Model, HoustonModel, CustomFieldMixin):
     def user_is_owner(self, user):
         return user is not None and user in self.get_owners()
 
+    @classmethod
+    def get_owned_by_filter(cls, user_guids):
+        # SQL version of user_is_owner()
+        return cls.encounters.any(Encounter.owner_guid.in_(list(user_guids)))
+
+    @classmethod
+    def get_permitted_filter(cls, user_guids, action):
+        from app.modules.users.permissions.types import AccessOperation
+
+        if action == AccessOperation.READ:
+            return cls.get_owned_by_filter(user_guids)
+
+        # SQL version of user_owns_all_encounters(), for any one of the users
+        return db.or_(
+            *[
+                db.and_(
+                    cls.encounters.any(Encounter.owner_guid == user_guid),
+                    ~cls.encounters.any(
+                        db.and_(
+                            Encounter.owner_guid.isnot(None),
+                            Encounter.owner_guid != user_guid,
+                        )
+                    ),
+                )
+                for user_guid in user_guids
+            ]
+        )
+
     def set_stage(self, stage, refresh=True):
         with db.session.begin(subtransactions=True):
             self.stage = stage
@@ -885,6 +926,10 @@ class Sighting(db.Model, HoustonModel, CustomFieldMixin):
         )
 
         timer = ElapsedTime()
+        # Resolve every individual in one pass rather than walking each annot's encounter
+        individual_guids = annotation.get_individual_guids(
+            annot.guid for annot in matching_set_annotations
+        )
         matching_set_individual_uuids = []
         matching_set_annot_uuids = []
         unique_set = set()  # just to prevent duplication
@@ -905,7 +950,7 @@ class Sighting(db.Model, HoustonModel, CustomFieldMixin):
             if annot.encounter_guid and annot.content_guid not in unique_set:
                 unique_set.add(annot.content_guid)
 
-                individual_guid = annot.get_individual_guid()
+                individual_guid = individual_guids.get(annot.guid)
                 if individual_guid:
                     individual_guid = str(individual_guid)
                 else:
@@ -999,11 +1044,10 @@ class Sighting(db.Model, HoustonModel, CustomFieldMixin):
         annotation_guids = sorted(
             {annotation_guid[0] for annotation_guid in annotation_guids}
         )
-        for annotation_guid in annotation_guids:
-            annot = Annotation.query.get(annotation_guid)
-
-            annot.sync_with_sage(ensure=True)
+        annots = [Annotation.query.get(guid) for guid in annotation_guids]
+        Annotation.sync_many_with_sage(annots, ensure=True)
 
+        for annot in annots:
             annot.init_progress_identification(
                 parent=self.progress_identification, overwrite=True
             )
@@ -1847,3 +1891,9 @@ class Sighting(db.Model, HoustonModel, CustomFieldMixin):
 
     def _get_algorithm_name(self, config_id, algorithm_id):
         return self.id_configs[config_id]['algorithms'][algorithm_id]
+
+
+@db.event.listens_for(Sighting, 'after_update')
+def sighting_update_invalidate_matching_set_cache(mapper, connection, target):
+    # The location is the fallback of the locationId of the encounters without one
+    Annotation.invalidate_matching_set_cache_on_commit(target, {'location_guid'})
@@ -4,9 +4,11 @@ Site Settings database models
 --------------------
 """
 import logging
+import threading
+import time
 import uuid
 
-from flask import current_app
+from flask import _request_ctx_stack, current_app
 from flask_login import current_user  # NOQA
 
 from app.extensions import Timestamp, db, is_extension_enabled
@@ -16,6 +18,20 @@ from .helpers import SiteSettingCustomFields, SiteSettingModules, SiteSettingSpe
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+# Shared (redis) counter bumped on every site setting change, workers compare it with
+# the generation of their in-process copy of the settings
+SITE_SETTINGS_GENERATION_KEY = 'site_settings.generation'
+# Seconds during which a generation read outside of a request is trusted
+SITE_SETTINGS_GENERATION_CHECK_INTERVAL = 1
+
+_site_settings_cache = {
+    'generation': None,
+    'checked': None,
+    'values': None,
+    'derived': {},
+}
+_site_settings_cache_lock = threading.RLock()
+
 
 class SiteSetting(db.Model, Timestamp):
     """
@@ -532,6 +548,7 @@ class SiteSetting(db.Model, Timestamp):
                 db.session.add(setting)
             else:
                 db.session.merge(setting)
+        cls.bump_generation()
         if is_public:
             log.debug(f'updating Houston Setting key={key} value={value}')
         else:
@@ -569,6 +586,7 @@ class SiteSetting(db.Model, Timestamp):
             raise ValueError(f'read-only key {key}')
         if 'set_function' in key_data:
             key_data['set_function'](key, value)
+            cls.bump_generation()
             setting = cls.query.get(key)
         else:
             setting = cls.set_after_validation(key, value)
@@ -591,26 +609,152 @@ class SiteSetting(db.Model, Timestamp):
         if setting:
             with db.session.begin(subtransactions=True):
                 db.session.delete(setting)
+            cls.bump_generation()
 
             if 'update_function' in key_data:
                 key_data['update_function']()
 
     @classmethod
     def get_value(cls, key, default=None, **kwargs):
+        """
+        Return the value of the site setting ``key``, or its default when not set
+
+        The value is shared with every other caller through the settings cache, so it
+        must not be modified, copy it first.
+        """
         if not key:
             raise ValueError('key must not be None')
         if not cls.is_valid_setting(key):
             raise HoustonException(log, f'Key {key} Not supported')
 
-        setting = cls.query.get(key)
-        if not setting:
+        values = cls._get_cached_values()
+        if values is None:
+            setting = cls.query.get(key)
+            value = setting.get_val() if setting else None
+            found = setting is not None
+        else:
+            found = key in values
+            value = values.get(key)
+        if not found:
             setting_default = cls._get_default_value(key)
             if default is None and setting_default is not None:
                 if callable(setting_default):
                     setting_default = setting_default()
                 return setting_default
             return default
-        return setting.get_val()
+        return value
+
+    @classmethod
+    def _get_generation(cls):
+        from app.utils import get_shared_generation
+
+        return get_shared_generation(SITE_SETTINGS_GENERATION_KEY)
+
+    @classmethod
+    def _get_cached_values(cls):
+        """
+        Return the ``{key: value}`` dictionary of all stored site settings, from the
+        in-process cache when it is still current, or ``None`` when the generation
+        cannot be checked or the current transaction changed settings
+
+        The shared generation is checked once per request, and at most once every
+        ``SITE_SETTINGS_GENERATION_CHECK_INTERVAL`` seconds outside of a request
+        (celery tasks, CLI).
+        """
+        if db.has_on_commit(cls._bump_generation):
+            # The current transaction changed settings, which are not committed yet
+            return None
+
+        ctx = _request_ctx_stack.top
+        generation = getattr(ctx, 'site_settings_generation', None)
+        if generation is None and ctx is None:
+            with _site_settings_cache_lock:
+                checked = _site_settings_cache['checked']
+                if (
+                    checked is not None
+                    and time.monotonic() - checked
+                    < SITE_SETTINGS_GENERATION_CHECK_INTERVAL
+                ):
+                    generation = _site_settings_cache['generation']
+        if generation is None:
+            generation = cls._get_generation()
+            if generation is None:
+                return None
+            if ctx is None:
+                with _site_settings_cache_lock:
+                    _site_settings_cache['checked'] = time.monotonic()
+
+        with _site_settings_cache_lock:
+            if (
+                _site_settings_cache['values'] is None
+                or _site_settings_cache['generation'] != generation
+            ):
+                _site_settings_cache['values'] = {
+                    setting.key: setting.get_val() for setting in cls.query
+                }
+                _site_settings_cache['derived'] = {}
+                _site_settings_cache['generation'] = generation
+            values = _site_settings_cache['values']
+        if ctx is not None:
+            ctx.site_settings_generation = generation
+        return values
+
+    @classmethod
+    def get_derived_value(cls, key, builder):
+        """
+        Return ``builder(value)`` for the value of ``key``, kept with the cached
+        settings so it is only rebuilt when the site settings change
+
+        Used for lookup structures (indexes) derived from a setting, the returned
+        object is shared and must not be modified.
+        """
+        values = cls._get_cached_values()
+        if values is None:
+            return builder(cls.get_value(key))
+
+        derived_key = (key, builder)
+        with _site_settings_cache_lock:
+            if _site_settings_cache['values'] is values:
+                derived = _site_settings_cache['derived']
+                if derived_key in derived:
+                    return derived[derived_key]
+
+        derived_value = builder(cls.get_value(key))
+        with _site_settings_cache_lock:
+            # Only keep it if the settings were not reloaded in the meantime
+            if _site_settings_cache['values'] is values:
+                _site_settings_cache['derived'][derived_key] = derived_value
+        return derived_value
+
+    @classmethod
+    def clear_cache(cls):
+        """
+        Drop this process's copy of the site settings
+        """
+        with _site_settings_cache_lock:
+            _site_settings_cache['values'] = None
+            _site_settings_cache['derived'] = {}
+            _site_settings_cache['checked'] = None
+        ctx = _request_ctx_stack.top
+        if ctx is not None:
+            ctx.site_settings_generation = None
+
+    @classmethod
+    def bump_generation(cls):
+        """
+        Invalidate the site settings cache of every worker once the current
+        transaction is committed (right away outside of a transaction), so that no
+        worker caches the previous values again
+        """
+        if not db.has_on_commit(cls._bump_generation):
+            db.on_commit(cls._bump_generation)
+
+    @classmethod
+    def _bump_generation(cls):
+        from app.utils import bump_shared_generation
+
+        cls.clear_cache()
+        bump_shared_generation(SITE_SETTINGS_GENERATION_KEY)
 
     def get_val(self):
         if self.file_upload_guid:
@@ -776,6 +920,15 @@ class SiteSetting(db.Model, Timestamp):
         return val
 
 
+@db.event.listens_for(SiteSetting, 'after_insert')
+@db.event.listens_for(SiteSetting, 'after_update')
+@db.event.listens_for(SiteSetting, 'after_delete')
+def site_setting_changed(mapper, connection, target):
+    # Changes made directly on the session (not through set_key_value) are at least
+    # seen by this process, other workers pick them up on the next bump_generation()
+    SiteSetting.clear_cache()
+
+
 # most find-based methods reference *ids* which will be guids in new-world data
 # to search on name, try find_fuzzy()
 class Regions(dict):
@@ -793,13 +946,84 @@ class Regions(dict):
             raise ValueError('no region data available')
         super().__init__(*args, **kwargs)
 
+    @classmethod
+    def get_site_regions(cls):
+        """
+        Return the Regions of the ``site.custom.regions`` setting, shared and indexed
+        until the setting changes (so do not modify it)
+        """
+        regions = SiteSetting.get_derived_value('site.custom.regions', cls._from_value)
+        if regions is None:
+            raise ValueError('no region data available')
+        return regions
+
+    @classmethod
+    def _from_value(cls, data):
+        if not data or not isinstance(data, dict):
+            return None
+        regions = cls(data=data)
+        regions._get_index()
+        return regions
+
+    def _get_index(self):
+        """
+        Index of the tree built on first use: the nodes (in tree order) for each id,
+        the path to the first node with each id and the descendants of each id
+        """
+        index = self.__dict__.get('_index')
+        if index is not None:
+            return index
+
+        index = {'nodes': {}, 'paths': {}, 'children': {}, 'traverse': []}
+        position = 0
+        # Depth first, in the same order as the recursive walks
+        stack = [(self, [])]
+        while stack:
+            node, path = stack.pop()
+            if not isinstance(node, dict):
+                continue
+            if 'id' in node:
+                index['traverse'].append(node)
+            node_id = node.get('id')
+            if node_id:
+                index['nodes'].setdefault(node_id, []).append((position, node))
+                position += 1
+                for ancestor in path:
+                    index['children'][ancestor['id']].add(node_id)
+                index['children'].setdefault(node_id, set())
+                path = path + [node]
+                index['paths'].setdefault(node_id, path)
+            sub_nodes = node.get('locationID')
+            if isinstance(sub_nodes, list):
+                stack.extend((sub, path) for sub in reversed(sub_nodes))
+
+        self._index = index
+        return index
+
+    @classmethod
+    def _node_data(cls, node, full_tree=False):
+        node_data = node.copy()
+        if not full_tree and node_data.get('locationID'):
+            del node_data['locationID']
+        return node_data
+
     def full_path(self, loc, id_only=True):
-        return self._find_path(self, loc, [], id_only)
+        if not loc:
+            raise ValueError('must pass loc')
+        path = self._get_index()['paths'].get(loc)
+        if path is None:
+            return None
+        if id_only:
+            return [node['id'] for node in path]
+        path_data = [node.copy() for node in path]
+        for node_data in path_data:
+            node_data.pop('locationID', None)
+        return path_data
 
     @classmethod
     def is_region_guid_valid(cls, guid):
         try:
-            regions = Regions()
+            regions = cls.get_site_regions()
         except ValueError:
             # No regions so this guid (and all others) are not valid
             return False
@@ -812,7 +1036,7 @@ class Regions(dict):
         region_name = None
 
         try:
-            regions = Regions()
+            regions = cls.get_site_regions()
             region_data = regions.find(guid, id_only=False)
             if region_data:
                 region_name = region_data[0].get('name', guid)
@@ -861,12 +1085,13 @@ class Regions(dict):
     def with_children(self, loc_list):
         if not loc_list or not isinstance(loc_list, list):
             return set()
-        found = self.find(loc_list, id_only=False, full_tree=True)
+        index = self._get_index()
+        found = [loc for loc in set(loc_list) if loc in index['nodes']]
         if not found:
             return set()
         children = set(loc_list)
-        for match in found:
-            children = set.union(children, self.node_children(match))
+        for loc in found:
+            children.update(index['children'][loc])
         return children
 
     @classmethod
@@ -890,8 +1115,22 @@ class Regions(dict):
         return children
 
     def find(self, locs=None, id_only=True, full_tree=False):
-        found = self._find(self, locs, id_only, full_tree)
-        return set(found) if id_only else found
+        if not locs:
+            locs = None
+        elif isinstance(locs, str):
+            locs = [locs]
+        elif not isinstance(locs, list):
+            raise ValueError('must pass string, list, or None')
+
+        nodes = self._get_index()['nodes']
+        if locs is None:
+            matches = [match for loc_nodes in nodes.values() for match in loc_nodes]
+        else:
+            matches = [match for loc in set(locs) for match in nodes.get(loc, [])]
+        if id_only:
+            return {node['id'] for _, node in matches}
+        matches.sort(key=lambda match: match[0])
+        return [self._node_data(node, full_tree) for _, node in matches]
 
     @classmethod
     # full_tree only matters when id_only=False -- it will not prune subtree from node
@@ -918,7 +1157,7 @@ class Regions(dict):
 
     def traverse(self, node=None):
         if not node:
-            return self.traverse(self)
+            return list(self._get_index()['traverse'])
         nodes = []
         if 'id' in node:
             nodes.append(node)
@@ -937,27 +1176,30 @@ class Regions(dict):
                 return reg
         return None
 
-    def find_fuzzy(self, match):
-        from app.utils import fuzzy_match
+    def _get_fuzzy_index(self):
+        from app.utils import FuzzyMatchIndex
 
-        candidates = {}
-        nodes = self.traverse()
-        for reg in nodes:
-            candidates[reg['id']] = reg.get('name', reg['id'])
-        fzm = fuzzy_match(match, candidates)
+        fuzzy_index = self.__dict__.get('_fuzzy_index')
+        if fuzzy_index is None:
+            candidates = {}
+            for reg in self.traverse():
+                candidates[reg['id']] = reg.get('name', reg['id'])
+            fuzzy_index = self._fuzzy_index = FuzzyMatchIndex(candidates)
+        return fuzzy_index
+
+    def _find_fuzzy_many(self, possible):
         # cutoff may need some tweakage here based on experience
-        if not fzm or fzm[0]['score'] < 150:
-            return None
-        return fzm[0]
+        results = self._get_fuzzy_index().match_many(possible, limit=1, score_cutoff=150)
+        return [result[0] if result else None for result in results]
+
+    def find_fuzzy(self, match):
+        return self._find_fuzzy_many([match])[0]
 
     # pass a list, returns ordered by score all fuzzy-matches
     def find_fuzzy_list(self, possible):
-        matches = []
         # reduces to unique (and lowercase first)
-        for p in {a.lower() for a in possible}:
-            fz = self.find_fuzzy(p)
-            if fz:
-                matches.append(fz)
+        possible = list({a.lower() for a in possible})
+        matches = [fz for fz in self._find_fuzzy_many(possible) if fz]
         if not matches:
             return []
         # this way highest score (of duplicates) gets put in as only one
@@ -1006,7 +1248,7 @@ class Taxonomy:
             return
         import uuid
 
-        conf = self.get_configuration_value()
+        index = self.get_index()
         match_value = id
         match_key = 'scientificName'
         try:
@@ -1021,14 +1263,13 @@ class Taxonomy:
             match_key = 'id'
         except Exception:
             pass
-        for tx in conf:
-            if tx.get(match_key) == match_value:
-                self.guid = tx.get('id')
-                self.scientificName = tx.get('scientificName')
-                self.itisTsn = tx.get('itisTsn')
-                self.commonNames = tx.get('commonNames', [])
-                return
-        raise ValueError('unknown id')
+        tx = index[match_key].get(match_value)
+        if tx is None:
+            raise ValueError('unknown id')
+        self.guid = tx.get('id')
+        self.scientificName = tx.get('scientificName')
+        self.itisTsn = tx.get('itisTsn')
+        self.commonNames = tx.get('commonNames', [])
 
     @classmethod
     def get_configuration_value(cls):
@@ -1040,32 +1281,80 @@ class Taxonomy:
         return conf
 
     @classmethod
-    def find_fuzzy(cls, match):
-        conf = cls.get_configuration_value()
-        from app.utils import fuzzy_match
+    def get_index(cls):
+        """
+        Return the ``site.species`` entries by id, itisTsn and scientificName, shared
+        until the setting changes
+        """
+        index = SiteSetting.get_derived_value('site.species', cls._build_index)
+        if index is None:
+            raise ValueError('site.species not configured')
+        return index
 
+    @classmethod
+    def _build_index(cls, conf):
+        if not conf or not isinstance(conf, list):
+            return None
+        index = {'id': {}, 'itisTsn': {}, 'scientificName': {}}
+        for tx in conf:
+            for match_key, tx_index in index.items():
+                match_value = tx.get(match_key)
+                # First match wins, as when scanning the list
+                if match_value is not None and match_value not in tx_index:
+                    tx_index[match_value] = tx
+        return index
+
+    @classmethod
+    def get_fuzzy_index(cls):
+        """
+        Return the fuzzy match index of the ``site.species`` names, shared until the
+        setting changes
+        """
+        fuzzy_index = SiteSetting.get_derived_value(
+            'site.species', cls._build_fuzzy_index
+        )
+        if fuzzy_index is None:
+            raise ValueError('site.species not configured')
+        return fuzzy_index
+
+    @classmethod
+    def _build_fuzzy_index(cls, conf):
+        from app.utils import FuzzyMatchIndex
+
+        if not conf or not isinstance(conf, list):
+            return None
         candidates = {}
         for tx in conf:
             candidates[tx['id']] = ' '.join(
                 tx.get('commonNames', []) + [tx.get('scientificName')]
             )
-        fzm = fuzzy_match(match, candidates)
+        return FuzzyMatchIndex(candidates)
+
+    @classmethod
+    def _find_fuzzy_many(cls, possible):
         # cutoff may need some tweakage here based on experience
-        if not fzm or fzm[0]['score'] < 120:
-            return None
-        tx = Taxonomy(fzm[0]['id'])
-        tx._fuzz_score = fzm[0]['score']
-        return tx
+        results = cls.get_fuzzy_index().match_many(possible, limit=1, score_cutoff=120)
+        matches = []
+        for result in results:
+            tx = None
+            if result:
+                tx = Taxonomy(result[0]['id'])
+                tx._fuzz_score = result[0]['score']
+            matches.append(tx)
+        return matches
+
+    @classmethod
+    def find_fuzzy(cls, match):
+        return cls._find_fuzzy_many([match])[0]
 
     # pass a list, returns ordered by score all fuzzy-matches
     @classmethod
     def find_fuzzy_list(cls, possible):
-        matches = []
         # reduces to unique (and lowercase first)
-        for p in {a.lower() for a in possible}:
-            fz = cls.find_fuzzy(p)
-            if fz:
-                matches.append(fz)
+        possible = list({a.lower() for a in possible})
+        if not possible:
+            return []
+        matches = [fz for fz in cls._find_fuzzy_many(possible) if fz]
         if not matches:
             return []
         # this way highest score (of duplicates) gets put in as only one
@@ -8,6 +8,7 @@ import logging
 from http import HTTPStatus
 from typing import Any, Type
 
+from flask import _request_ctx_stack, after_this_request
 from flask_login import current_user
 from permission import Rule as BaseRule
 
@@ -212,6 +213,140 @@ else:
     }
 
 
+# Models whose owner is held directly in an owner_guid column
+OWNER_GUID_MODELS = (
+    'AssetGroup',
+    'Encounter',
+    'Mission',
+    'MissionCollection',
+    'MissionTask',
+    'Project',
+)
+
+
+def get_object_owner_guids(obj):
+    """
+    Return the set of user GUIDs that own ``obj``, mirroring ``User.owns_object()``,
+    or ``None`` if ownership of this kind of object cannot be read from its columns
+    """
+
+    def _owner_guid(owned):
+        # Objects not yet flushed may only have the relationship set
+        if owned.owner_guid is None and owned.owner is not None:
+            return owned.owner.guid
+        return owned.owner_guid
+
+    class_name = obj.__class__.__name__
+    if class_name in OWNER_GUID_MODELS:
+        owner_guids = {_owner_guid(obj)}
+    elif class_name == 'User':
+        owner_guids = {obj.guid}
+    elif class_name == 'Asset':
+        owner_guids = {_owner_guid(obj.git_store)} if obj.git_store is not None else set()
+    elif class_name == 'Sighting':
+        owner_guids = set()
+    elif class_name == 'Individual':
+        owner_guids = {_owner_guid(encounter) for encounter in obj.get_encounters()}
+    else:
+        return None
+    owner_guids.discard(None)
+    return owner_guids
+
+
+class PermissionContext(object):
+    """
+    Request-scoped cache of the collaborators of one user, so that checking many
+    objects in one request only looks up each collaboration set once
+
+    Outside of a request there is no context and the rules query as before.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.hits = 0
+        self.misses = 0
+        self._collaborators = {}
+
+    @classmethod
+    def get(cls, user):
+        request_context = _request_ctx_stack.top
+        if request_context is None or user is None or user.is_anonymous:
+            return None
+
+        contexts = getattr(request_context, 'permission_contexts', None)
+        if contexts is None:
+            contexts = request_context.permission_contexts = {}
+
+            @after_this_request
+            def _report(response):
+                for context in contexts.values():
+                    log.debug(
+                        'Permission context for %r: %d hits, %d misses'
+                        % (context.user, context.hits, context.misses)
+                    )
+                return response
+
+        context = contexts.get(user.guid)
+        if context is None:
+            context = contexts[user.guid] = cls(user)
+        return context
+
+    @classmethod
+    def clear(cls):
+        # Collaborations changed, so anything cached for this request is stale
+        request_context = _request_ctx_stack.top
+        contexts = getattr(request_context, 'permission_contexts', None)
+        if contexts:
+            for context in contexts.values():
+                context._collaborators = {}
+
+    @module_required('collaborations', resolve='warn', default=([], set()))
+    def get_collaborators(self, action):
+        """
+        Return the list of collaborating users for ``action`` and the set of their GUIDs
+        """
+        from app.modules.collaborations.models import Collaboration
+
+        collaborators = self._collaborators.get(action)
+        if collaborators is not None:
+            self.hits += 1
+            return collaborators
+
+        self.misses += 1
+        if action == AccessOperation.READ:
+            users = Collaboration.get_users_for_read(self.user)
+        elif action == AccessOperation.WRITE:
+            users = Collaboration.get_users_for_write(self.user)
+        else:
+            users = []
+        collaborators = self._collaborators[action] = (
+            users,
+            {user.guid for user in users},
+        )
+        return collaborators
+
+
+@module_required('collaborations', resolve='warn', default=([], set()))
+def get_collaborators(user, action):
+    """
+    Return the users collaborating with ``user`` for ``action``, and their GUIDs,
+    from the request's PermissionContext when there is one
+    """
+    from app.modules.collaborations.models import Collaboration
+
+    context = PermissionContext.get(user)
+    if context is not None:
+        return context.get_collaborators(action)
+
+    if action == AccessOperation.READ:
+        users = Collaboration.get_users_for_read(user)
+    elif action == AccessOperation.WRITE:
+        users = Collaboration.get_users_for_write(user)
+    else:
+        users = []
+    return users, {user_.guid for user_ in users}
+
+
 class DenyAbortMixin(object):
     """
     A helper permissions mixin raising an HTTP Error (specified in
@@ -516,6 +651,61 @@ class ObjectActionRule(Rule):
 
         return has_permission
 
+    @classmethod
+    def filter_query(cls, model, user=None, action=AccessOperation.READ, query=None):
+        """
+        Restrict ``query`` (default ``model.query``) to the rows of ``model`` that
+        ``user`` may perform ``action`` on, mirroring ``check()`` as one SQL predicate
+
+        Covers public data, ownership, the ``OBJECT_USER_MAP`` roles and approved
+        collaborations. ``model`` provides the ownership predicates through
+        ``get_owned_by_filter()`` and ``get_permitted_filter()``.
+        """
+        from sqlalchemy import false, or_
+
+        from app.modules.users.models import User
+
+        if action not in (
+            AccessOperation.READ,
+            AccessOperation.WRITE,
+            AccessOperation.DELETE,
+        ):
+            raise ValueError(f'filter_query() does not support {action}')
+
+        if user is None:
+            user = current_user
+        if query is None:
+            query = model.query
+
+        is_active = user and not user.is_anonymous and user.is_active
+        if is_active:
+            # Privileged users and table driven roles see every row
+            if user.is_privileged:
+                return query
+            roles = OBJECT_USER_MAP.get((model.__name__, action), [])
+            if any(getattr(user, role, False) for role in roles):
+                return query
+
+        clauses = []
+        # Anyone can read public data, researchers and admins can also edit it
+        if action == AccessOperation.READ or (
+            is_active
+            and action == AccessOperation.WRITE
+            and (user.is_researcher or user.is_admin)
+        ):
+            public_user_guids = {User.get_public_user().guid}
+            clauses.append(model.get_owned_by_filter(public_user_guids))
+
+        if is_active:
+            _, user_guids = get_collaborators(user, action)
+            clauses.append(model.get_permitted_filter(user_guids | {user.guid}, action))
+
+        if any(clause is None for clause in clauses):
+            raise NotImplementedError(f'{model.__name__} does not support filter_query()')
+        if not clauses:
+            return query.filter(false())
+        return query.filter(or_(*clauses))
+
     def _permitted_as_public_data(self):
         # All public data can be read/edited by researchers and data managers as decreed
         # https://wildme.atlassian.net/browse/DEX-1281
@@ -571,25 +761,25 @@ class ObjectActionRule(Rule):
 
     @module_required('collaborations', resolve='warn', default=False)
     def _permitted_via_collaboration(self, action):
-        from app.modules.collaborations.models import Collaboration
-
         tried_users = [self._user]
         object_user_methods = OBJECT_USER_METHOD_MAP.get(
             (self._obj.__class__.__name__, self._action)
         )
 
-        if action == AccessOperation.READ:
-            collab_users = Collaboration.get_users_for_read(self._user)
-        elif action == AccessOperation.WRITE:
-            collab_users = Collaboration.get_users_for_write(self._user)
-        else:
-            collab_users = []
+        collab_users, collab_user_guids = get_collaborators(self._user, action)
+
+        # Ownership is usually a column, so test every collaborator at once
+        owner_guids = get_object_owner_guids(self._obj)
+        if owner_guids is not None and owner_guids & (
+            collab_user_guids - {self._user.guid}
+        ):
+            return True
 
         for other_user in collab_users:
             if other_user not in tried_users:
                 tried_users.append(other_user)
 
-                if other_user.owns_object(self._obj):
+                if owner_guids is None and other_user.owns_object(self._obj):
                     return True
 
             if object_user_methods is not None:
@@ -709,4 +899,9 @@ class PartialPermissionDeniedRule(Rule):
 
 # Helpers to have one place that defines what users are privileged in all cases
 def owner_or_privileged(user, obj):
-    return user.owns_object(obj) or user.is_privileged
+    if user.is_privileged:
+        return True
+    owner_guids = get_object_owner_guids(obj)
+    if owner_guids is not None:
+        return user.guid in owner_guids
+    return user.owns_object(obj)
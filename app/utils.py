@@ -12,6 +12,11 @@ import app.extensions.logging as AuditLog  # NOQA
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+SHARED_GENERATION_RETRY_INTERVAL = 60
+# rapidfuzz's partial_ratio searches every window for needles up to this length
+FUZZY_MATCH_EXACT_NEEDLE = 64
+_shared_generation_state = {'retry': 0}
+
 
 # Patches may fail due to cascade delete issue. These are not faults as such so not HoustonExceptions
 # but need to be passed between the parameters file and resources file
@@ -234,16 +239,128 @@ def nlp_parse_complex_date_time(
 # this will return a list (ordered by best match to worst) of how well match fuzzy-matched the candidates.
 #   the list contains dicts like: { id: xxx, text: yyy, score: zzz } (id will be omitted if only a list is passed in)
 def fuzzy_match(match, candidates):
-    from fuzzywuzzy import fuzz
-
-    lmatch = match.lower()
-    if isinstance(candidates, list):
-        res = [{'text': i.lower()} for i in candidates]
-    else:
-        res = [{'id': i, 'text': candidates[i].lower()} for i in candidates]
-    for c in res:
-        c['score'] = fuzz.partial_ratio(lmatch, c['text']) + fuzz.ratio(lmatch, c['text'])
-    return sorted(res, key=lambda d: -d['score'])
+    return FuzzyMatchIndex(candidates).match_many([match])[0]
+
+
+class FuzzyMatchIndex:
+    """
+    Candidates of fuzzy_match() prepared once, so they can be matched against many
+    strings in one call
+
+    The score is fuzzywuzzy's partial_ratio + ratio, between 0 and 200.  With a
+    cutoff or a limit, the candidates are pruned with upper bounds of the score
+    first, and only the few that can still make it are scored with fuzzywuzzy:
+
+    * fuzzywuzzy's ratio is python-Levenshtein's, which is rapidfuzz's InDel
+      similarity 1 - distance / lensum.  It is computed exactly, for all the
+      candidates at once, from rapidfuzz's Indel.distance
+    * fuzzywuzzy's partial_ratio is the best InDel ratio of the shorter string s
+      (of length m) against some windows of the longer one, each of length k <= m.
+      A window has at most C = min(k, LCS(s, longer)) characters in common with s,
+      so its ratio 2 * C / (m + k) is at most 2 * C / (m + C), and the LCS comes
+      with the InDel distance, (m + n - distance) / 2
+    * rapidfuzz's partial_ratio is the best InDel ratio over every window, a
+      superset of fuzzywuzzy's, so it is a tighter bound, only computed for the
+      candidates left (rapidfuzz searches every window for needles of up to
+      FUZZY_MATCH_EXACT_NEEDLE characters)
+    """
+
+    def __init__(self, candidates):
+        if isinstance(candidates, list):
+            self.ids = None
+            self.texts = [text.lower() for text in candidates]
+        else:
+            self.ids = list(candidates)
+            self.texts = [candidates[id_].lower() for id_ in self.ids]
+        self.lengths = [len(text) for text in self.texts]
+
+    def _ratios(self, queries):
+        """
+        Return fuzzywuzzy's ratio of every (query, candidate) pair, and an upper
+        bound of their partial_ratio
+        """
+        import numpy as np
+        from rapidfuzz import process
+        from rapidfuzz.distance import Indel
+
+        distances = process.cdist(queries, self.texts, scorer=Indel.distance)
+        query_lengths = [len(query) for query in queries]
+        lensums = np.add.outer(query_lengths, self.lengths)
+        shortest = np.minimum.outer(query_lengths, self.lengths)
+        common = (lensums - distances) / 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # The same float operations as Indel.normalized_similarity, and the same
+            # round half to even as fuzzywuzzy's intr(100 * ratio)
+            ratios = np.rint(100 * (1 - distances / lensums))
+            # One point of slack for the rounding
+            partial_bounds = np.floor(100 * 2 * common / (shortest + common)) + 1
+
+        # fuzzywuzzy scores equal strings 100 and empty strings 0
+        empty = shortest == 0
+        ratios[empty] = 0
+        ratios[distances == 0] = 100
+        partial_bounds[empty] = 100
+        partial_bounds = np.minimum(partial_bounds, 100)
+        return ratios.astype(int), partial_bounds.astype(int)
+
+    def match_many(self, matches, limit=None, score_cutoff=0):
+        """
+        Return, for each string in ``matches``, the list of results of fuzzy_match(),
+        keeping at most ``limit`` results scoring at least ``score_cutoff``
+        """
+        import numpy as np
+        from fuzzywuzzy import fuzz
+        from rapidfuzz import fuzz as rapidfuzz_fuzz
+
+        queries = [match.lower() for match in matches]
+        if not queries or not self.texts:
+            return [[] for _ in queries]
+
+        prune = score_cutoff > 0 or limit is not None
+        ratios, partial_bounds = self._ratios(queries)
+        bounds = ratios + partial_bounds
+
+        results = []
+        for row, query in enumerate(queries):
+            # Best bounds first, stable so ties keep the order of the candidates
+            order = (
+                np.argsort(-bounds[row], kind='stable')
+                if prune
+                else range(len(self.texts))
+            )
+            scored = []
+            for column in order:
+                ratio, text = ratios[row, column], self.texts[column]
+                # Once the results are full, only candidates that can score at least
+                # as much as the worst one kept can make it
+                floor = score_cutoff
+                if limit is not None and len(scored) >= limit:
+                    floor = max(floor, scored[limit - 1][0])
+                if prune:
+                    if bounds[row, column] < floor:
+                        break
+                    if min(len(query), len(text)) <= FUZZY_MATCH_EXACT_NEEDLE:
+                        partial = rapidfuzz_fuzz.partial_ratio(query, text)
+                        if ratio + min(int(partial) + 1, 100) < floor:
+                            continue
+
+                score = fuzz.partial_ratio(query, text) + ratio
+                if score >= floor:
+                    scored.append((score, column))
+                    if limit is not None:
+                        # Ties keep the order of the candidates
+                        scored.sort(key=lambda item: (-item[0], item[1]))
+                        del scored[limit:]
+            scored.sort(key=lambda item: (-item[0], item[1]))
+
+            result = []
+            for score, column in scored[:limit]:
+                res = {'text': self.texts[column], 'score': int(score)}
+                if self.ids is not None:
+                    res['id'] = self.ids[column]
+                result.append(res)
+            results.append(result)
+        return results
 
 
 def get_redis_connection():
@@ -286,6 +403,41 @@ def get_persisted_value(key):
     return val.decode('utf-8') if val else None
 
 
+def get_shared_generation(key):
+    """
+    Return the generation counter ``key`` shared by all processes through Redis, to be
+    used in cache keys, or None if Redis is unavailable (nothing should be cached then)
+
+    Once Redis failed, it is not tried again for ``SHARED_GENERATION_RETRY_INTERVAL``
+    seconds, so that reads do not each wait for a connection error.
+    """
+    import time
+
+    if time.time() < _shared_generation_state['retry']:
+        return None
+    try:
+        value = get_redis_connection().get(key)
+    except Exception as ex:
+        log.warning(
+            f'Unable to read the shared generation {key!r}, caches disabled: {ex}'
+        )
+        _shared_generation_state['retry'] = time.time() + SHARED_GENERATION_RETRY_INTERVAL
+        return None
+    return int(value or 0)
+
+
+def bump_shared_generation(key):
+    """
+    Increment the shared generation counter ``key``, which makes everything cached
+    under the previous generation unreachable in every process
+    """
+    try:
+        return get_redis_connection().incr(key)
+    except Exception as ex:
+        log.warning(f'Unable to bump the shared generation {key!r}: {ex}')
+    return None
+
+
 def sizeof(num, suffix='B'):
     for unit in ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
         if abs(num) < 1024.0:
@@ -135,6 +135,17 @@ class BaseConfig(FlaskConfigOverrides, RedisConfig):
 
     FILEUPLOAD_BASE_PATH = str(DATA_ROOT / 'fileuploads')
 
+    # Cache-Control max-age (seconds) per format for /assets/src; derived images of an
+    # asset only change with a new ETag, so browsers revalidate cheaply after expiry
+    ASSET_SRC_CACHE_MAX_AGE = {
+        'master': 60 * 60,
+        'mid': 60 * 60 * 24,
+        'thumb': 60 * 60 * 24,
+        'abox': 0,
+    }
+    # Responses need a login, so only allow shared caches (CDN) when explicitly enabled
+    ASSET_SRC_CACHE_PUBLIC = bool(_getenv('ASSET_SRC_CACHE_PUBLIC', False, empty_ok=True))
+
     @property
     def SQLALCHEMY_DATABASE_URI(self):
         try:
@@ -316,6 +327,30 @@ def get_env_rest_config(interface):
     return uris, authns
 
 
+def get_env_rest_transport_config(interface):
+    """Parse the Sage/EDM connection pool, retry, timeout and circuit breaker settings"""
+    return {
+        # Pooled connections kept per target, also bounds the concurrent requests
+        # (e.g. fetching Sage job results), which wait on I/O rather than on the CPU
+        'pool_maxsize': int(
+            _getenv(f'{interface}_POOL_MAXSIZE', max(8, multiprocessing.cpu_count()))
+        ),
+        # Retries of connection errors, and of idempotent requests (read errors, 502-504)
+        'retries': int(_getenv(f'{interface}_RETRIES', 3)),
+        'backoff_factor': float(_getenv(f'{interface}_RETRY_BACKOFF_FACTOR', 0.5)),
+        # Seconds
+        'connect_timeout': float(_getenv(f'{interface}_CONNECT_TIMEOUT', 10)),
+        'read_timeout': float(_getenv(f'{interface}_READ_TIMEOUT', 300)),
+        # Consecutive failures opening the circuit of a target, and seconds it stays open
+        'circuit_breaker_threshold': int(
+            _getenv(f'{interface}_CIRCUIT_BREAKER_THRESHOLD', 5)
+        ),
+        'circuit_breaker_timeout': float(
+            _getenv(f'{interface}_CIRCUIT_BREAKER_TIMEOUT', 30)
+        ),
+    }
+
+
 class SageConfig(object):
     # Read the config from the environment but ensure that there is always a default URI
     # Sage doesn't currently support authentications but no reason to not use the same function to read
@@ -323,6 +358,11 @@ class SageConfig(object):
     SAGE_URIS, SAGE_AUTHENTICATIONS = get_env_rest_config('SAGE')
     if 'default' not in SAGE_URIS:
         SAGE_URIS['default'] = 'https://sandbox.tier2.dyn.wildme.io'
+    SAGE_TRANSPORT = get_env_rest_transport_config('SAGE')
+    # Images uploaded concurrently (bounded by the pool size), and the number of assets
+    # or annotations per batch, the Sage content GUIDs are stored after every batch
+    SAGE_UPLOAD_WORKERS = int(_getenv('SAGE_UPLOAD_WORKERS', 4))
+    SAGE_UPLOAD_BATCH_SIZE = int(_getenv('SAGE_UPLOAD_BATCH_SIZE', 50))
 
 
 class EDMConfig(object):
@@ -330,6 +370,7 @@ class EDMConfig(object):
     EDM_URIS, EDM_AUTHENTICATIONS = get_env_rest_config('EDM')
     if 'default' not in EDM_URIS:
         EDM_URIS['default'] = 'https://nextgen.dev-wildbook.org/'
+    EDM_TRANSPORT = get_env_rest_transport_config('EDM')
 
 
 class AssetGroupConfig(object):
@@ -342,6 +383,10 @@ class AssetGroupConfig(object):
     GITLAB_REMOTE_LOGIN_PAT = _getenv('GITLAB_REMOTE_LOGIN_PAT')
     # FIXME: Note, if you change the SSH key, you should also delete the ssh_id file (see GIT_SSH_KEY_FILEPATH)
     GIT_SSH_KEY = _getenv('GIT_SSH_KEY')
+    # Hash uploads through a memory map instead of buffered reads (large video files)
+    GIT_STORE_DIGEST_USE_MMAP = bool(
+        _getenv('GIT_STORE_DIGEST_USE_MMAP', False, empty_ok=True)
+    )
 
     #: using lowercase so Flask won't pick it up as a legit setting
     default_git_ssh_key_filepath = DATA_ROOT / 'id_ssh_key'
@@ -396,6 +441,11 @@ class ElasticsearchConfig:
         _getenv('ELASTICSEARCH_BUILD_INDEX_ON_STARTUP', False, empty_ok=True)
     )
     ELASTICSEARCH_BLOCKING = bool(_getenv('ELASTICSEARCH_BLOCKING', False, empty_ok=True))
+    # Keep an in-process cache of GUIDs known to exist in the database, used to avoid
+    # re-verifying Elasticsearch hits against the database on every search
+    ELASTICSEARCH_GUID_CACHE = bool(
+        _getenv('ELASTICSEARCH_GUID_CACHE', False, empty_ok=True)
+    )
 
     CACHE_TYPE = 'SimpleCache'
     CACHE_DEFAULT_TIMEOUT = 60
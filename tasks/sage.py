@@ -56,26 +56,28 @@ def results(context):
 @app_context_task(
     help={
         'model': 'The name of the model to index',
+        'incremental': 'Only sync the records changed since their last sync',
     }
 )
-def sync(context, model=None):
+def sync(context, model=None, incremental=False):
     """
     Sync (push to Sage) the records for a given model, if specified, otherwise all models
     """
-    _sync_worker(model=model)
+    _sync_worker(model=model, incremental=incremental)
     status(context)
 
 
 @app_context_task(
     help={
         'model': 'The name of the model to index',
+        'incremental': 'Only sync the records changed since their last sync',
     }
 )
-def ensure(context, model=None):
+def ensure(context, model=None, incremental=False):
     """
     Check the records for a given model, if specified, otherwise all models
     """
-    _sync_worker(model=model, ensure=True)
+    _sync_worker(model=model, ensure=True, incremental=incremental)
     status(context)
 
 
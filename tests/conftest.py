@@ -3,6 +3,7 @@ import logging
 import os
 import pathlib
 import shutil
+import sys
 import tempfile
 import time
 import uuid
@@ -784,6 +785,25 @@ def contributor_1_login(flask_app, contributor_1):
         logout_user()
 
 
+@pytest.fixture()
+def fake_redis(monkeypatch):
+    # Shared caches and counters use an in-memory Redis instead of the real one
+    import fakeredis
+
+    from app import utils as app_utils
+
+    conn = fakeredis.FakeRedis()
+    get_redis_connection = app_utils.get_redis_connection
+    # Also replace it where it was imported by name
+    for module in list(sys.modules.values()):
+        name = getattr(module, '__name__', '')
+        if name == 'app' or name.startswith('app.'):
+            if getattr(module, 'get_redis_connection', None) is get_redis_connection:
+                monkeypatch.setattr(module, 'get_redis_connection', lambda: conn)
+    monkeypatch.setitem(app_utils._shared_generation_state, 'retry', 0)
+    return conn
+
+
 @pytest.fixture()
 def public_encounter():
     import tests.utils as test_utils
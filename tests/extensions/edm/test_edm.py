@@ -70,3 +70,35 @@ def test_reauthentication_fails(flask_app):
         random_id = uuid.uuid4()
         result = flask_app.edm.get_dict('encounter.data', random_id)
         assert result.status_code == 401
+
+
+@pytest.mark.skipif(extension_unavailable('edm'), reason='EDM extension disabled')
+def test_circuit_breaker(flask_app):
+    import requests
+
+    from app.extensions.restManager.RestManager import CircuitOpenError
+
+    flask_app.edm._ensure_initialized()
+    circuit_breaker = flask_app.edm._get_circuit_breaker('default')
+
+    def mock_get(url, *args, **kwargs):
+        # Requests are always sent with (connect, read) timeouts
+        assert len(kwargs['timeout']) == 2
+        raise requests.exceptions.ConnectionError('Connection refused')
+
+    with mock.patch.object(
+        flask_app.edm.sessions['default'], 'get', side_effect=mock_get
+    ) as edm_get:
+        for _ in range(circuit_breaker.threshold):
+            with pytest.raises(requests.exceptions.ConnectionError):
+                flask_app.edm.get_dict('encounter.data', uuid.uuid4())
+        # Refused without sending the request
+        with pytest.raises(CircuitOpenError):
+            flask_app.edm.get_dict('encounter.data', uuid.uuid4())
+        assert edm_get.call_count == circuit_breaker.threshold
+
+    # A successful trial request closes the circuit
+    circuit_breaker.opened -= circuit_breaker.timeout
+    result = flask_app.edm.get_dict('encounter.data', uuid.uuid4())
+    assert result.status_code == 404
+    assert circuit_breaker.opened is None
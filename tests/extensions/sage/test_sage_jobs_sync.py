@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+from unittest import mock
+
+import pytest
+
+from tests.utils import extension_unavailable, module_unavailable
+
+
+def test_classify_jobs():
+    from app.extensions.sage import SageManager
+
+    start_keys = {'model', 'active', 'start'}
+    end_keys = start_keys | {'json_result', 'end'}
+    started = {'model': 'm', 'start': 0}
+    jobs_by_guid = [
+        (
+            'guid-1',
+            {
+                'sage-completed': dict(started, active=True),
+                'sage-failed': dict(started, active=True),
+                'sage-pending': dict(started, active=True),
+                'sage-unknown': dict(started, active=True),
+            },
+        ),
+        (
+            'guid-2',
+            {
+                'missing-start': {'active': True},
+                'done': dict(started, active=False, json_result={}, end=1),
+                'no-result-completed': dict(started, active=False),
+                'no-result': dict(started, active=False),
+            },
+        ),
+        ('guid-3', None),
+    ]
+
+    completed, kinds, seen_jobs = SageManager._classify_jobs(
+        None,
+        jobs_by_guid,
+        start_keys,
+        end_keys,
+        {'sage-completed', 'no-result-completed'},
+        {'sage-failed'},
+        {'sage-pending'},
+    )
+    assert completed == 1
+    assert kinds == {
+        'fetch': [('guid-1', 'sage-completed'), ('guid-2', 'no-result-completed')],
+        'failed': [('guid-1', 'sage-failed')],
+        'pending': [('guid-1', 'sage-pending')],
+        'unknown': [('guid-1', 'sage-unknown')],
+        'corrupt': [('guid-2', 'missing-start'), ('guid-2', 'no-result')],
+    }
+    assert seen_jobs == [
+        'sage-completed',
+        'sage-failed',
+        'sage-pending',
+        'sage-unknown',
+        'missing-start',
+        'done',
+        'no-result-completed',
+        'no-result',
+    ]
+
+
+@pytest.mark.skipif(extension_unavailable('sage'), reason='Sage extension disabled')
+def test_jobs_sync_claim_and_period(flask_app, fake_redis):
+    from app.extensions.sage import tasks
+
+    key = tasks.SAGE_JOBS_SYNC_NEXT_KEY
+    with mock.patch.object(flask_app.sage, 'sync_jobs', return_value=2) as sync_jobs:
+        # Only one of two ticks claims the sync
+        tasks.sage_task_jobs_sync()
+        tasks.sage_task_jobs_sync()
+        assert sync_jobs.call_count == 1
+        # Active jobs, the next sync is due after the active period
+        assert 0 < fake_redis.ttl(key) <= tasks.SAGE_JOBS_SYNC_ACTIVE_PERIOD
+
+        # Forced syncs ignore the claim
+        sync_jobs.return_value = 0
+        tasks.sage_task_jobs_sync(force=True)
+        assert sync_jobs.call_count == 2
+        # No active jobs, the next sync is due after the idle period
+        assert (
+            tasks.SAGE_JOBS_SYNC_ACTIVE_PERIOD
+            < fake_redis.ttl(key)
+            <= tasks.SAGE_JOBS_SYNC_IDLE_PERIOD
+        )
+
+        # Once the period is over the next tick syncs again
+        fake_redis.delete(key)
+        tasks.sage_task_jobs_sync()
+        assert sync_jobs.call_count == 3
+
+    # A sync in progress holds the claim, a concurrent tick does not start another
+    fake_redis.delete(key)
+
+    def sync_jobs():
+        tasks.sage_task_jobs_sync()
+        return 0
+
+    with mock.patch.object(
+        flask_app.sage, 'sync_jobs', side_effect=sync_jobs
+    ) as sync_jobs_mock:
+        tasks.sage_task_jobs_sync()
+        assert sync_jobs_mock.call_count == 1
+
+
+@pytest.mark.skipif(extension_unavailable('sage'), reason='Sage extension disabled')
+def test_jobs_sync_lock_is_refreshed(flask_app, fake_redis, monkeypatch):
+    import time
+
+    from app.extensions.sage import tasks
+
+    # A sync running for longer than the lock timeout keeps the lock
+    monkeypatch.setattr(tasks, 'SAGE_JOBS_SYNC_LOCK_TIMEOUT', 1)
+    monkeypatch.setattr(tasks, 'SAGE_JOBS_SYNC_LOCK_REFRESH', 0.1)
+    held = []
+
+    def sync_jobs():
+        time.sleep(1.5)
+        held.append(fake_redis.exists(tasks.SAGE_JOBS_SYNC_LOCK_KEY))
+        # Not even a forced sync starts while this one runs
+        tasks.sage_task_jobs_sync(force=True)
+        return 0
+
+    with mock.patch.object(
+        flask_app.sage, 'sync_jobs', side_effect=sync_jobs
+    ) as sync_jobs_mock:
+        tasks.sage_task_jobs_sync()
+    assert sync_jobs_mock.call_count == 1
+    assert held == [1]
+    # Released once done, the next sync time is kept separately
+    assert not fake_redis.exists(tasks.SAGE_JOBS_SYNC_LOCK_KEY)
+    assert fake_redis.exists(tasks.SAGE_JOBS_SYNC_NEXT_KEY)
+
+
+@pytest.mark.skipif(
+    extension_unavailable('sage') or module_unavailable('asset_groups', 'sightings'),
+    reason='Sage extension, AssetGroups or Sightings module disabled',
+)
+def test_sync_jobs_in_progress_objects(flask_app, db):
+    import sqlalchemy
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, *args):
+        statements.append((statement, parameters))
+
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        flask_app.sage.sync_jobs_detection(set(), set(), set(), verbose=False)
+        flask_app.sage.sync_jobs_identification(set(), set(), set(), verbose=False)
+    finally:
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute', record)
+
+    # Only the objects that can have active jobs are loaded, by stage
+    assert len(statements) == 2
+    for (statement, parameters), table, stage in zip(
+        statements,
+        ['asset_group_sighting', 'sighting'],
+        ['detection', 'identification'],
+    ):
+        assert f'FROM {table} \nWHERE {table}.stage = ' in statement
+        assert stage in repr(parameters)
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+import json
+import uuid
+from unittest import mock
+
+import pytest
+
+import tests.utils as test_utils
+from tests.utils import extension_unavailable, module_unavailable
+
+
+def _create_assets(db, owner, count):
+    asset_group = test_utils.generate_asset_group_instance(owner)
+    assets = [test_utils.generate_asset_instance(asset_group.guid) for _ in range(count)]
+    for asset in assets:
+        asset.mime_type = 'image/jpeg'
+    with db.session.begin():
+        db.session.add(asset_group)
+        for asset in assets:
+            db.session.add(asset)
+    return asset_group, assets
+
+
+def _delete(db, objs):
+    with db.session.begin():
+        for obj in objs:
+            db.session.delete(obj)
+
+
+@pytest.mark.skipif(
+    extension_unavailable('sage') or module_unavailable('asset_groups'),
+    reason='Sage extension or AssetGroups module disabled',
+)
+def test_sage_outdated_guids_and_watermark(db, researcher_1):
+    from app.modules.assets.models import Asset
+
+    asset_group, assets = _create_assets(db, researcher_1, 3)
+    guids = {asset.guid for asset in assets}
+    try:
+        # Never synced objects are outdated
+        assert set(Asset.get_sage_outdated_guids()) >= guids
+
+        # Stamping the watermark does not bump `updated`
+        updated = {asset.guid: asset.updated for asset in assets}
+        Asset.mark_synced_with_sage(updated)
+        for asset in assets:
+            db.session.refresh(asset)
+            assert asset.sage_synced == updated[asset.guid]
+            assert asset.updated == updated[asset.guid]
+        assert not set(Asset.get_sage_outdated_guids()) & guids
+
+        # An object changed after its last sync is outdated again
+        with db.session.begin():
+            assets[0].path = 'changed.jpg'
+            db.session.merge(assets[0])
+        assert assets[0].updated > assets[0].sage_synced
+        assert set(Asset.get_sage_outdated_guids()) & guids == {assets[0].guid}
+
+        Asset.mark_synced_with_sage({})
+    finally:
+        _delete(db, assets + [asset_group])
+
+
+@pytest.mark.skipif(
+    extension_unavailable('sage') or module_unavailable('asset_groups'),
+    reason='Sage extension or AssetGroups module disabled',
+)
+def test_sage_incremental_sync(db, researcher_1):
+    from app.modules.assets.models import Asset
+
+    asset_group, assets = _create_assets(db, researcher_1, 3)
+    guids = {asset.guid for asset in assets}
+    try:
+        Asset.mark_synced_with_sage({assets[2].guid: assets[2].updated})
+        db.session.refresh(assets[2])
+        watermark = assets[2].sage_synced
+        with db.session.begin():
+            assets[2].path = 'changed.jpg'
+            db.session.merge(assets[2])
+
+        # The first object is uploaded, the other two fail
+        def sync_many_with_sage(objs, **kwargs):
+            synced.append({obj.guid for obj in objs} & guids)
+            for obj in objs:
+                if obj.guid == assets[0].guid and obj.content_guid is None:
+                    obj.content_guid = uuid.uuid4()
+
+        synced = []
+        with mock.patch.object(
+            Asset, 'sync_many_with_sage', side_effect=sync_many_with_sage
+        ), mock.patch.object(Asset, 'prune_with_sage') as prune_with_sage, mock.patch(
+            'flask.current_app.sage.request_passthrough_result'
+        ) as request_passthrough_result:
+            Asset.sync_all_with_sage(incremental=True, chunk_size=2)
+
+            # Few outdated objects, nothing is listed on Sage and nothing is pruned
+            request_passthrough_result.assert_not_called()
+            prune_with_sage.assert_not_called()
+            assert set.union(*synced) == guids
+
+            for asset in assets:
+                db.session.refresh(asset)
+            assert assets[0].sage_synced is not None
+            # Failed objects keep their old watermark, and are retried next time
+            assert assets[1].sage_synced is None
+            assert assets[2].sage_synced == watermark
+            # The watermark is the state that was pushed, the sync setting the
+            # content guid is a change that is checked (without uploading) once more
+            assert assets[0].updated > assets[0].sage_synced
+            assert set(Asset.get_sage_outdated_guids()) & guids == guids
+
+            synced.clear()
+            Asset.sync_all_with_sage(incremental=True)
+            assert set.union(*synced) == guids
+            assert set(Asset.get_sage_outdated_guids()) & guids == guids - {
+                assets[0].guid
+            }
+
+            synced.clear()
+            Asset.sync_all_with_sage(incremental=True)
+            assert set.union(*synced) == guids - {assets[0].guid}
+    finally:
+        _delete(db, assets + [asset_group])
+
+
+@pytest.mark.skipif(
+    extension_unavailable('sage') or module_unavailable('asset_groups'),
+    reason='Sage extension or AssetGroups module disabled',
+)
+def test_sage_incremental_sync_modified_mid_chunk(db, researcher_1):
+    import datetime
+
+    from app.modules.assets.models import Asset
+
+    asset_group, assets = _create_assets(db, researcher_1, 2)
+    guids = {asset.guid for asset in assets}
+    try:
+        with db.session.begin():
+            for asset in assets:
+                asset.content_guid = uuid.uuid4()
+                db.session.merge(asset)
+
+        # The second object is changed by someone else while its chunk is synced
+        def sync_many_with_sage(objs, **kwargs):
+            with db.session.begin():
+                db.session.execute(
+                    Asset.__table__.update()
+                    .values(path='changed.jpg', updated=datetime.datetime.utcnow())
+                    .where(Asset.guid == assets[1].guid)
+                )
+
+        with mock.patch.object(
+            Asset, 'sync_many_with_sage', side_effect=sync_many_with_sage
+        ), mock.patch.object(Asset, 'prune_with_sage'):
+            Asset.sync_all_with_sage(incremental=True)
+
+        for asset in assets:
+            db.session.refresh(asset)
+        # Both were pushed, but only the unchanged one is up to date
+        assert assets[0].sage_synced == assets[0].updated
+        assert assets[1].sage_synced < assets[1].updated
+        assert set(Asset.get_sage_outdated_guids()) & guids == {assets[1].guid}
+    finally:
+        _delete(db, assets + [asset_group])
+
+
+@pytest.mark.skipif(
+    extension_unavailable('sage') or module_unavailable('asset_groups'),
+    reason='Sage extension or AssetGroups module disabled',
+)
+def test_sage_prune_is_separate(flask_app, db, researcher_1):
+    from app.extensions.sage import tasks, to_sage_uuid
+    from app.modules.annotations.models import Annotation
+    from app.modules.assets.models import Asset
+
+    # The periodic data sync never prunes
+    with mock.patch.object(Asset, 'sync_all_with_sage'), mock.patch.object(
+        Annotation, 'sync_all_with_sage'
+    ), mock.patch.object(flask_app.sage, 'get_status'), mock.patch.object(
+        Asset, 'prune_with_sage'
+    ) as asset_prune, mock.patch.object(
+        Annotation, 'prune_with_sage'
+    ) as annotation_prune:
+        tasks.sage_task_data_sync()
+        asset_prune.assert_not_called()
+        annotation_prune.assert_not_called()
+
+        tasks.sage_task_data_prune()
+        asset_prune.assert_called_once_with()
+        annotation_prune.assert_called_once_with()
+
+    # Only the Sage records that no Houston object refers to are deleted
+    asset_group, assets = _create_assets(db, researcher_1, 1)
+    try:
+        with db.session.begin():
+            assets[0].content_guid = uuid.uuid4()
+            db.session.merge(assets[0])
+        orphan_guid = uuid.uuid4()
+        with mock.patch(
+            'flask.current_app.sage.request_passthrough_result', return_value=True
+        ) as request_passthrough_result:
+            Asset.prune_with_sage(sage_uuids={assets[0].content_guid, orphan_guid})
+        request_passthrough_result.assert_called_once_with(
+            'asset.delete',
+            'delete',
+            {'json': {'image_uuid_list': [to_sage_uuid(orphan_guid)]}},
+            target='sync',
+        )
+    finally:
+        _delete(db, assets + [asset_group])
+
+
+@pytest.mark.skipif(extension_unavailable('sage'), reason='Sage extension disabled')
+def test_sage_upload_images(flask_app, tmp_path):
+    filepaths = [tmp_path / f'{index}.jpg' for index in range(6)]
+    sage_guids = {filepath: uuid.uuid4() for filepath in filepaths}
+
+    def upload_image(filepath, target='sync'):
+        if filepath.name in ('1.jpg', '4.jpg'):
+            raise ValueError('Upload failed')
+        return sage_guids[filepath]
+
+    with mock.patch.object(flask_app.sage, 'upload_image', side_effect=upload_image):
+        results = flask_app.sage.upload_images(filepaths, workers=3)
+    # In order, failed uploads are None
+    assert results == [
+        None if index in (1, 4) else sage_guids[filepath]
+        for index, filepath in enumerate(filepaths)
+    ]
+    assert flask_app.sage.upload_images([]) == []
+
+
+@pytest.mark.skipif(
+    extension_unavailable('sage') or module_unavailable('asset_groups'),
+    reason='Sage extension or AssetGroups module disabled',
+)
+def test_sage_existing_uuids_order(flask_app):
+    from app.extensions.sage import from_sage_uuid
+    from app.modules.assets.models import Asset
+
+    guids = [uuid.uuid4() for _ in range(5)]
+    on_sage = {guids[0], guids[3], guids[4]}
+    requested = []
+
+    def exists_list(tag, method, args=None, target=None):
+        chunk = [from_sage_uuid(sage_uuid) for sage_uuid in json.loads(args)]
+        requested.append(chunk)
+        # Sage answers with a row id, or None, for each UUID in the order requested
+        return [
+            index + 1 if guid in on_sage else None for index, guid in enumerate(chunk)
+        ]
+
+    with mock.patch.object(
+        flask_app.sage, 'request_passthrough_result', side_effect=exists_list
+    ):
+        existing = Asset.get_sage_existing_uuids(
+            [guids[4], None, guids[1], guids[0], guids[3], guids[2], guids[4]],
+            batch_size=2,
+        )
+    assert existing == on_sage
+    # Duplicates and missing content guids are dropped, the chunks are sorted
+    assert [guid for chunk in requested for guid in chunk] == sorted(guids)
+    assert [len(chunk) for chunk in requested] == [2, 2, 1]
+
+
+@pytest.mark.skipif(
+    extension_unavailable('sage') or module_unavailable('asset_groups'),
+    reason='Sage extension or AssetGroups module disabled',
+)
+def test_asset_sync_many_with_sage(flask_app, db, researcher_1, tmp_path):
+    from app.extensions.sage import to_sage_uuid
+    from app.modules.assets.models import Asset
+
+    asset_group, assets = _create_assets(db, researcher_1, 5)
+    try:
+        filepaths = {asset.guid: tmp_path / f'{asset.guid}.jpg' for asset in assets}
+        # The last asset is missing on disk
+        for asset in assets[:-1]:
+            filepaths[asset.guid].write_bytes(b'')
+        failed = {filepaths[assets[1].guid]}
+        uploads = []
+
+        def upload_images(image_filepaths, workers=None):
+            uploads.append(list(image_filepaths))
+            return [
+                None if filepath in failed else uuid.uuid4()
+                for filepath in image_filepaths
+            ]
+
+        with mock.patch.object(
+            Asset, 'get_symlink', lambda asset: filepaths[asset.guid]
+        ), mock.patch.object(flask_app.sage, 'upload_images', side_effect=upload_images):
+            Asset.sync_many_with_sage(assets, batch_size=2)
+            assert uploads == [
+                [filepaths[assets[0].guid], filepaths[assets[1].guid]],
+                [filepaths[assets[2].guid], filepaths[assets[3].guid]],
+                [],
+            ]
+
+            # Only the failed and the missing assets are left unsynced
+            for asset in assets:
+                db.session.refresh(asset)
+            assert [asset.is_synced_with_sage() for asset in assets] == [
+                True,
+                False,
+                True,
+                True,
+                False,
+            ]
+
+            # A re-run only sends those
+            uploads.clear()
+            failed.clear()
+            filepaths[assets[-1].guid].write_bytes(b'')
+            Asset.sync_many_with_sage(assets, batch_size=2)
+            assert uploads == [[filepaths[assets[1].guid], filepaths[assets[-1].guid]]]
+            for asset in assets:
+                db.session.refresh(asset)
+            assert all(asset.is_synced_with_sage() for asset in assets)
+
+            # With ensure, only the assets that are no longer on Sage are sent again
+            uploads.clear()
+            on_sage = [to_sage_uuid(asset.content_guid) for asset in assets[1:]]
+            with mock.patch.object(
+                flask_app.sage,
+                'request_passthrough_result',
+                side_effect=lambda tag, method, args=None, target=None: [
+                    1 if sage_uuid in on_sage else None for sage_uuid in json.loads(args)
+                ],
+            ):
+                Asset.sync_many_with_sage(assets, ensure=True)
+            assert uploads == [[filepaths[assets[0].guid]]]
+    finally:
+        _delete(db, assets + [asset_group])
+
+
+@pytest.mark.skipif(
+    extension_unavailable('sage') or module_unavailable('asset_groups', 'annotations'),
+    reason='Sage extension, AssetGroups or Annotations module disabled',
+)
+def test_annotation_sync_many_with_sage(flask_app, db, researcher_1):
+    from app.extensions.sage import from_sage_uuid, to_sage_uuid
+    from app.modules.annotations.models import Annotation
+
+    asset_group, assets = _create_assets(db, researcher_1, 2)
+    annotations = [
+        Annotation(
+            asset_guid=assets[index % 2].guid,
+            ia_class='test',
+            viewpoint='test',
+            bounds={'rect': [index, 0, 10, 10]},
+        )
+        for index in range(5)
+    ]
+    with db.session.begin():
+        assets[0].content_guid = uuid.uuid4()
+        db.session.merge(assets[0])
+        for annotation in annotations:
+            db.session.add(annotation)
+    try:
+        # The annotations of the second asset have no image on Sage and the third
+        # annotation fails validation, so only the first and the fifth are sent
+        annotations[2].bounds = {'rect': [2, 0, 10]}
+        creates = []
+
+        def annotation_create(tag, method, data, target=None):
+            assert tag == 'annotation.create'
+            sage_request = data['json']
+            creates.append(sage_request)
+            # Sage returns the new annotation UUIDs in the order of the request
+            return [
+                to_sage_uuid(uuid.UUID(int=rect[0] + 1))
+                for rect in sage_request['annot_bbox_list']
+            ]
+
+        with mock.patch.object(
+            flask_app.sage, 'request_passthrough_result', side_effect=annotation_create
+        ):
+            Annotation.sync_many_with_sage(annotations, skip_asset=True)
+            assert len(creates) == 1
+            assert creates[0]['annot_bbox_list'] == [
+                [0, 0, 10, 10],
+                [4, 0, 10, 10],
+            ]
+            assert [
+                from_sage_uuid(sage_uuid) for sage_uuid in creates[0]['image_uuid_list']
+            ] == [assets[0].content_guid] * 2
+
+            # Each annotation gets the Sage UUID created for its own bounding box
+            for annotation in annotations:
+                db.session.refresh(annotation)
+            assert [annotation.content_guid for annotation in annotations] == [
+                uuid.UUID(int=1),
+                None,
+                None,
+                None,
+                uuid.UUID(int=5),
+            ]
+
+            # A re-run only sends the annotations that are still missing
+            creates.clear()
+            with db.session.begin():
+                annotations[2].bounds = {'rect': [2, 0, 10, 10]}
+                db.session.merge(annotations[2])
+            Annotation.sync_many_with_sage(annotations, skip_asset=True)
+            assert [create['annot_bbox_list'] for create in creates] == [[[2, 0, 10, 10]]]
+            db.session.refresh(annotations[2])
+            assert annotations[2].content_guid == uuid.UUID(int=3)
+    finally:
+        _delete(db, annotations + assets + [asset_group])
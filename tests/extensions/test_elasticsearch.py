@@ -172,6 +172,17 @@ def test_elasticsearch_utilities(
         User.index_all(update=False)
         User.index_all(force=True)
 
+    # Stream the index in small chunks, both for outdated and forced objects
+    with es.session.begin(blocking=True):
+        User.index_all(chunked=True, chunk_size=2)
+        User.index_all(force=True, chunked=True, chunk_size=2)
+
+    chunks = list(es.es_iter_chunks(User, chunk_size=2))
+    assert all(0 < len(chunk) <= 2 for chunk in chunks)
+    guids = [user.guid for chunk in chunks for user in chunk]
+    assert guids == sorted(guids)
+    assert admin_user.guid in guids
+
     # Ensure context managers are working correctly
     assert not es.session.in_bulk_mode()
     assert not es.session.in_skip_mode()
@@ -717,6 +728,297 @@ def test_elasticsearch_utilities(
     es_tasks.es_task_invalidate_indexed_timestamps(True)
 
 
+@pytest.mark.skipif(
+    extension_unavailable('elasticsearch'),
+    reason='Elasticsearch extension or module disabled',
+)
+def test_existing_guids(flask_app, admin_user, staff_user):
+    import uuid
+
+    from app.extensions import elasticsearch as es
+    from app.modules.users.models import User
+
+    missing_guid = uuid.uuid4()
+    guids = [admin_user.guid, staff_user.guid, missing_guid]
+    expected = {admin_user.guid, staff_user.guid}
+
+    # Only the given GUIDs are verified against the database
+    assert es.es_existing_guids(User, guids) == expected
+    assert es.es_existing_guids(User, guids, chunk_size=1) == expected
+    assert es.es_existing_guids(User, []) == set()
+
+    # The GUID cache only ever remembers GUIDs that are known to exist
+    enabled = flask_app.config.get('ELASTICSEARCH_GUID_CACHE', False)
+    try:
+        flask_app.config['ELASTICSEARCH_GUID_CACHE'] = True
+        es.es_guid_cache_clear()
+        assert es.es_existing_guids(User, guids) == expected
+        assert set(es.GUID_CACHE[User]) == expected
+        assert es.es_existing_guids(User, guids) == expected
+
+        es.es_guid_cache_discard(staff_user)
+        assert set(es.GUID_CACHE[User]) == {admin_user.guid}
+        assert es.es_existing_guids(User, guids) == expected
+    finally:
+        flask_app.config['ELASTICSEARCH_GUID_CACHE'] = enabled
+        es.es_guid_cache_clear()
+
+
+@pytest.mark.skipif(
+    extension_unavailable('elasticsearch'),
+    reason='Elasticsearch extension or module disabled',
+)
+def test_guid_cache_commit_and_expiry(flask_app, db, admin_user):
+    import uuid
+
+    from app.extensions import elasticsearch as es
+    from app.modules.users.models import User
+
+    deleted_guid = uuid.uuid4()
+    enabled = flask_app.config.get('ELASTICSEARCH_GUID_CACHE', False)
+    try:
+        flask_app.config['ELASTICSEARCH_GUID_CACHE'] = True
+        es.es_guid_cache_clear()
+        cache = es.GUID_CACHE.setdefault(User, {})
+
+        # GUIDs are only cached once the transaction that saw them is committed
+        with db.session.begin():
+            es.es_guid_cache_add(admin_user)
+            assert admin_user.guid not in cache
+        assert admin_user.guid in cache
+
+        # and not at all if it is rolled back
+        es.es_guid_cache_discard(admin_user)
+        with pytest.raises(ValueError):
+            with db.session.begin():
+                es.es_guid_cache_add(admin_user)
+                raise ValueError()
+        assert admin_user.guid not in cache
+
+        # A GUID deleted by another process is reported until its entry expires
+        cache[deleted_guid] = time.time() + es.GUID_CACHE_TTL
+        assert es.es_existing_guids(User, [deleted_guid]) == {deleted_guid}
+        cache[deleted_guid] = time.time() - 1
+        assert es.es_existing_guids(User, [deleted_guid]) == set()
+        assert deleted_guid in cache
+
+        # Expired entries are purged as new GUIDs are stored
+        es.GUID_CACHE_PURGE['next'] = 0
+        assert es.es_existing_guids(User, [admin_user.guid]) == {admin_user.guid}
+        assert set(cache) == {admin_user.guid}
+    finally:
+        flask_app.config['ELASTICSEARCH_GUID_CACHE'] = enabled
+        es.es_guid_cache_clear()
+
+
+@pytest.mark.skipif(
+    extension_unavailable('elasticsearch'),
+    reason='Elasticsearch extension or module disabled',
+)
+def test_search_load_queries(
+    flask_app, db, monkeypatch, admin_user, staff_user, researcher_1
+):
+    import sqlalchemy
+
+    from app.extensions import elasticsearch as es
+    from app.modules.users.models import User
+
+    users = [researcher_1, admin_user, staff_user]
+    hits = [{'_id': str(user.guid)} for user in users]
+    monkeypatch.setattr(es, 'es_index_name', lambda *args, **kwargs: 'testing.user')
+    monkeypatch.setattr(es, 'es_search', lambda *args, **kwargs: hits)
+    monkeypatch.setattr(
+        User,
+        'get_elasticsearch_search_load_options',
+        classmethod(lambda cls: [db.joinedload(User.profile_fileupload)]),
+    )
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    enabled = flask_app.config.get('ELASTICSEARCH_GUID_CACHE', False)
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        flask_app.config['ELASTICSEARCH_GUID_CACHE'] = False
+        for sort, reverse_after, expected in (
+            # Pre-sorted, the page keeps the Elasticsearch order
+            ('elasticsearch.guid', False, users),
+            ('elasticsearch.guid', True, users[::-1]),
+            # Sorted by the database
+            ('guid', True, sorted(users, key=lambda user: user.guid, reverse=True)),
+        ):
+            db.session.expunge_all()
+            statements.clear()
+            results = es.es_elasticsearch(
+                flask_app, User, {}, sort=sort, reverse_after=reverse_after
+            )
+            # One query to verify the hits exist, one to load the page
+            assert len(statements) == 2
+            assert [user.guid for user in results] == [user.guid for user in expected]
+            # with the load options applied, nothing is lazy loaded afterwards
+            for user in results:
+                assert 'profile_fileupload' in user.__dict__
+                assert user.profile_fileupload is None
+            assert len(statements) == 2
+    finally:
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count)
+        flask_app.config['ELASTICSEARCH_GUID_CACHE'] = enabled
+
+
+@pytest.mark.skipif(
+    extension_unavailable('elasticsearch'),
+    reason='Elasticsearch extension or module disabled',
+)
+def test_cursor_search(flask_app_client, staff_user):
+    from app.extensions import elasticsearch as es
+    from app.modules.users.models import User
+    from tests.extensions.elasticsearch.resources.utils import get_cursor_path
+
+    if es.is_disabled():
+        pytest.skip('Elasticsearch disabled (via command-line)')
+
+    with es.session.begin(blocking=True):
+        User.index_all(force=True)
+    wait_for_elasticsearch_status(flask_app_client, staff_user)
+
+    reference = User.elasticsearch(None, load=False, limit=None)
+    assert len(reference) > 1
+
+    # Page through the index one item at a time
+    for reverse in [False, True]:
+        guids, cursor = [], None
+        while True:
+            cursor, page = User.elasticsearch_cursor(
+                None, cursor=cursor, load=False, limit=1, reverse=reverse
+            )
+            assert len(page) <= 1
+            guids += page
+            if cursor is None:
+                break
+        assert guids == sorted(reference, key=str, reverse=reverse)
+
+    # Loaded results are returned in the same order
+    cursor, users = User.elasticsearch_cursor(None, limit=100)
+    assert [user.guid for user in users] == sorted(reference, key=str)
+
+    # Invalid cursors are rejected
+    with pytest.raises(ValueError):
+        User.elasticsearch_cursor(None, cursor='not-a-cursor')
+
+    # Check the API
+    path = get_cursor_path('user')
+    guids, cursor = [], None
+    with flask_app_client.login(staff_user, auth_scopes=('search:read',)):
+        while True:
+            query = {'limit': 2}
+            if cursor is not None:
+                query['cursor'] = cursor
+            response = flask_app_client.get(path, query_string=query)
+            assert response.status_code == 200
+            assert len(response.json) <= 2
+            guids += response.json
+            cursor = response.headers.get('X-Next-Cursor', None)
+            if cursor is None:
+                break
+
+        response = flask_app_client.get(path, query_string={'cursor': 'invalid'})
+        assert response.status_code == 400
+
+        response = flask_app_client.get(
+            '/api/v1/search/testing.app.modules.doesnotexist/cursor'
+        )
+        assert response.status_code == 404
+
+    assert guids == [str(guid) for guid in sorted(reference, key=str)]
+
+
+@pytest.mark.skipif(
+    extension_unavailable('elasticsearch'),
+    reason='Elasticsearch extension or module disabled',
+)
+def test_cursor_signature(flask_app):
+    import base64
+    import json
+
+    from app.extensions import elasticsearch as es
+
+    data = {
+        'index': 'testing.app.modules.users.models.user',
+        'pit': 'pit-id',
+        'search_after': ['guid'],
+    }
+    cursor = es.es_encode_cursor(data)
+    assert es.es_decode_cursor(cursor, index=data['index']) == data
+
+    # Cursors are bound to the index they were issued for
+    with pytest.raises(ValueError):
+        es.es_decode_cursor(cursor, index='testing.app.modules.assets.models.asset')
+
+    # A cursor with another PIT (or index) fails the signature check
+    cursor_ = json.loads(base64.urlsafe_b64decode(cursor))
+    forged = dict(data, pit='other-pit-id')
+    forged = json.dumps(forged, sort_keys=True, separators=(',', ':'))
+    cursor_['data'] = base64.urlsafe_b64encode(forged.encode('utf-8')).decode('ascii')
+    cursor_ = base64.urlsafe_b64encode(json.dumps(cursor_).encode('utf-8'))
+    with pytest.raises(ValueError):
+        es.es_decode_cursor(cursor_.decode('ascii'), index=data['index'])
+
+    # So do unsigned cursors
+    unsigned = base64.urlsafe_b64encode(json.dumps(data).encode('utf-8'))
+    with pytest.raises(ValueError):
+        es.es_decode_cursor(unsigned.decode('ascii'))
+
+
+@pytest.mark.skipif(
+    extension_unavailable('elasticsearch'),
+    reason='Elasticsearch extension or module disabled',
+)
+def test_cursor_expired(flask_app):
+    from unittest import mock
+
+    import elasticsearch as elasticsearch_
+
+    from app.extensions import elasticsearch as es
+    from app.modules.users.models import User
+
+    index = 'testing.app.modules.users.models.user'
+    cursor = es.es_encode_cursor(
+        {'index': index, 'pit': 'expired-pit-id', 'search_after': ['guid']}
+    )
+    expired = elasticsearch_.exceptions.NotFoundError(404, 'not found')
+    client = mock.Mock()
+    client.search.side_effect = expired
+    client.open_point_in_time.return_value = {'id': 'private-pit-id'}
+
+    with mock.patch.object(es, 'es_index_name', return_value=index), mock.patch.object(
+        es, 'es_index_exists', return_value=True
+    ), mock.patch.object(flask_app, 'es', client, create=True), mock.patch.dict(
+        es.REGISTERED_MODELS, {User: {'pit': 'registered-pit-id'}}
+    ):
+        with mock.patch.object(User, 'pit') as pit:
+            # A resumed search with an expired PIT has to be restarted
+            with pytest.raises(es.ElasticsearchCursorExpired):
+                es.es_elasticsearch_cursor(flask_app, User, {}, cursor)
+            assert client.search.call_count == 1
+            assert client.open_point_in_time.call_count == 0
+
+            # A new search uses a private PIT when the registered one is gone
+            client.search.side_effect = [expired, {'hits': {'hits': []}}]
+            next_cursor, results = es.es_elasticsearch_cursor(
+                flask_app, User, {}, load=False
+            )
+            assert (next_cursor, results) == (None, [])
+            assert client.open_point_in_time.call_count == 1
+            body = client.search.call_args[1]['body']
+            assert body['pit']['id'] == 'private-pit-id'
+
+            # The shared, registered PIT is never re-opened (closed)
+            assert pit.call_count == 0
+            assert client.close_point_in_time.call_count == 0
+
+
 @pytest.mark.skipif(
     extension_unavailable('elasticsearch'),
     reason='Elasticsearch extension or module disabled',
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from unittest import mock
+
+import magic
+
+
+def test_inspect_upload_filepath(test_root):
+    from app.extensions import parallel
+    from app.extensions.git_store import _get_magic_instances, inspect_upload_filepath
+
+    filepaths = sorted(str(filepath) for filepath in test_root.glob('*.jpg'))
+    assert len(filepaths) > 0
+
+    expected = [
+        (
+            magic.from_file(filepath, mime=True),
+            magic.from_file(filepath),
+            os.path.getsize(filepath),
+        )
+        for filepath in filepaths
+    ]
+    assert {mime_type for mime_type, _, _ in expected} == {'image/jpeg'}
+
+    # Inspected concurrently, results are in order
+    results = parallel(
+        inspect_upload_filepath,
+        [(filepath, ['image/jpeg']) for filepath in filepaths],
+        workers=4,
+    )
+    assert results == expected
+
+    # Signatures and sizes are only read for white-listed MIME types
+    assert inspect_upload_filepath(filepaths[0], ['image/png']) == (
+        'image/jpeg',
+        None,
+        None,
+    )
+
+    # Every thread uses its own libmagic handles
+    instances = []
+    thread = threading.Thread(target=lambda: instances.append(_get_magic_instances()))
+    thread.start()
+    thread.join()
+    assert instances[0] is not _get_magic_instances()
+    assert _get_magic_instances() is _get_magic_instances()
+
+
+def test_parallel_callback():
+    from app.extensions import parallel
+
+    calls = []
+    results = parallel(
+        lambda value: value * 2,
+        [(value,) for value in range(5)],
+        callback=lambda completed, total: calls.append((completed, total)),
+    )
+    assert results == [0, 2, 4, 6, 8]
+    # Called once per collected result, in order
+    assert calls == [(1, 5), (2, 5), (3, 5), (4, 5), (5, 5)]
+
+
+def test_progress_preparation_callback():
+    from app.extensions.git_store import GitStore
+
+    git_store = mock.Mock(spec=['progress_preparation'])
+    callback = GitStore._progress_preparation_callback(git_store, 10, 50)
+
+    for completed in range(201):
+        callback(completed, 200)
+
+    # Mapped onto the [10, 50] range, only written when the percentage moves
+    values = [call.args[0] for call in git_store.progress_preparation.set.call_args_list]
+    assert values == list(range(10, 51))
+
+    # Nothing to report on, or no progress to report to
+    git_store.progress_preparation.reset_mock()
+    callback(0, 0)
+    git_store.progress_preparation.set.assert_not_called()
+    git_store.progress_preparation = None
+    callback(1, 2)
+
+
+def test_compute_xxhash64_digest_filepath(tmp_path):
+    import xxhash
+
+    from app.extensions.git_store import compute_xxhash64_digest_filepath
+
+    data = os.urandom(1000)
+    filepath = tmp_path / 'data.bin'
+    filepath.write_bytes(data)
+    empty_filepath = tmp_path / 'empty.bin'
+    empty_filepath.write_bytes(b'')
+
+    for path, expected in (
+        (filepath, xxhash.xxh64(data).hexdigest()),
+        (empty_filepath, xxhash.xxh64(b'').hexdigest()),
+    ):
+        # Chunked reads and memory maps agree, whatever the chunk size
+        for chunk_size in (7, 1000, 2 ** 20):
+            for use_mmap in (False, True):
+                digest = compute_xxhash64_digest_filepath(
+                    str(path), chunk_size=chunk_size, use_mmap=use_mmap
+                )
+                assert digest == expected
+
+
+def test_compute_xxhash64_digests_cached(tmp_path):
+    from app.extensions import git_store
+
+    filepaths = []
+    for index in range(3):
+        filepath = tmp_path / f'file-{index}.bin'
+        filepath.write_bytes(os.urandom(100))
+        filepaths.append(str(filepath))
+    cache_filepath = str(tmp_path / git_store.DIGEST_CACHE_FILENAME)
+
+    hashed = []
+    compute = git_store.compute_xxhash64_digest_filepath
+
+    def compute_digest(filepath, *args, **kwargs):
+        hashed.append(filepath)
+        return compute(filepath, *args, **kwargs)
+
+    with mock.patch.object(git_store, 'compute_xxhash64_digest_filepath', compute_digest):
+        expected = [compute(filepath) for filepath in filepaths]
+        digests = git_store.compute_xxhash64_digests_cached(filepaths, cache_filepath)
+        assert digests == expected
+        assert sorted(hashed) == filepaths
+
+        # Unchanged files (same inode, size and mtime) re-use the cached digest
+        hashed.clear()
+        digests = git_store.compute_xxhash64_digests_cached(filepaths, cache_filepath)
+        assert digests == expected
+        assert hashed == []
+
+        # A rewritten file is hashed again, even with the same size
+        with open(filepaths[0], 'wb') as file_:
+            file_.write(os.urandom(100))
+        # and so is a file with only a new modification time
+        stat = os.stat(filepaths[1])
+        os.utime(filepaths[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        digests = git_store.compute_xxhash64_digests_cached(filepaths, cache_filepath)
+        assert digests == [compute(filepaths[0])] + expected[1:]
+        assert sorted(hashed) == filepaths[:2]
+
+    # Removed files are dropped from the cache
+    cached = git_store.load_digest_cache(cache_filepath)
+    assert len(cached) == 3
+    git_store.compute_xxhash64_digests_cached(filepaths[:1], cache_filepath)
+    cached = git_store.load_digest_cache(cache_filepath)
+    assert list(cached.values()) == [compute(filepaths[0])]
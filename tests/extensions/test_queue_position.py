@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+import types
+import uuid
+from unittest import mock
+
+import pytest
+
+from tests.utils import extension_unavailable
+
+
+@pytest.fixture()
+def queue_redis(monkeypatch, fake_redis):
+    from app.extensions import queue_position
+
+    monkeypatch.setattr(queue_position, '_get_connection', lambda url=None: fake_redis)
+    return fake_redis
+
+
+def test_celery_queue_position(monkeypatch, queue_redis):
+    from celery import signals
+
+    from app.extensions import queue_position
+
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(queue_position.time, 'time', lambda: clock.now)
+    published = {}
+
+    def publish(task_id, routing_key='celery'):
+        clock.now += 1
+        published[task_id] = clock.now
+        signals.before_task_publish.send(
+            sender='app.tasks.test', headers={'id': task_id}, routing_key=routing_key
+        )
+        # What the broker does with the message
+        queue_redis.rpush(routing_key, task_id)
+
+    task_ids = [str(uuid.uuid4()) for _ in range(4)]
+
+    # Published on the default queue, in order
+    for task_id in task_ids[:3]:
+        publish(task_id)
+    # Other queues are not indexed
+    publish(task_ids[3], routing_key='other')
+    assert [queue_position.celery_task_ahead(task_id) for task_id in task_ids] == [
+        0,
+        1,
+        2,
+        None,
+    ]
+
+    # Started tasks leave the index
+    queue_redis.lpop('celery')
+    signals.task_prerun.send(sender=None, task_id=task_ids[0], task=None)
+    assert [queue_position.celery_task_ahead(task_id) for task_id in task_ids] == [
+        None,
+        0,
+        1,
+        None,
+    ]
+
+    # and so do revoked tasks
+    signals.task_revoked.send(
+        sender=None, request=types.SimpleNamespace(id=task_ids[1]), terminated=False
+    )
+    assert queue_position.celery_task_ahead(task_ids[2]) == 0
+    assert queue_redis.zcard(queue_position.CELERY_QUEUE_INDEX_KEY) == 1
+
+    # Tasks lost from the broker queue never count for more than the queue length
+    queue_redis.delete('celery')
+    publish(task_ids[0])
+    assert queue_position.celery_task_ahead(task_ids[0]) == 1
+    queue_redis.delete('celery')
+    assert queue_position.celery_task_ahead(task_ids[0]) == 0
+
+    # and are dropped once they are older than the maximum queue age
+    clock.now = published[task_ids[2]] + queue_position.CELERY_QUEUE_INDEX_MAX_AGE
+    publish(task_ids[1])
+    assert queue_position.celery_task_ahead(task_ids[2]) is None
+    assert queue_position.celery_task_ahead(task_ids[0]) == 0
+    assert queue_position.celery_task_ahead(task_ids[1]) == 1
+
+
+def test_queue_position_handlers_never_raise(monkeypatch):
+    from app.extensions import queue_position
+
+    def unavailable(url=None):
+        raise ConnectionError('Redis is unavailable')
+
+    monkeypatch.setattr(queue_position, '_get_connection', unavailable)
+    task_id = str(uuid.uuid4())
+    queue_position.queue_position_task_published(
+        headers={'id': task_id}, routing_key='celery'
+    )
+    queue_position.queue_position_task_started(task_id=task_id)
+    queue_position.queue_position_task_revoked(request=types.SimpleNamespace(id=task_id))
+
+
+def test_sage_queue_snapshot(queue_redis):
+    from app.extensions import queue_position
+
+    job_ids = [str(uuid.uuid4()) for _ in range(3)]
+    queue_position.set_sage_queue(job_ids)
+    assert [queue_position.sage_job_ahead(job_id) for job_id in job_ids] == [0, 1, 2]
+    assert queue_position.sage_job_ahead(uuid.uuid4()) is None
+    assert queue_redis.ttl(queue_position.SAGE_QUEUE_SNAPSHOT_KEY) > 0
+    assert not queue_redis.exists(f'{queue_position.SAGE_QUEUE_SNAPSHOT_KEY}.staging')
+
+    # A new snapshot replaces the old one
+    queue_position.set_sage_queue(job_ids[2:])
+    assert [queue_position.sage_job_ahead(job_id) for job_id in job_ids] == [
+        None,
+        None,
+        0,
+    ]
+    queue_position.set_sage_queue([])
+    assert not queue_redis.exists(queue_position.SAGE_QUEUE_SNAPSHOT_KEY)
+
+
+@pytest.mark.skipif(extension_unavailable('sage'), reason='Sage extension disabled')
+def test_sage_queue_order(flask_app, queue_redis):
+    from app.extensions import queue_position
+    from app.modules.progress.models import Progress
+
+    job_ids = [str(uuid.uuid4()) for _ in range(5)]
+    jobs = {
+        job_ids[0]: {'jobcounter': 3, 'status': 'queued'},
+        job_ids[1]: {'jobcounter': 1, 'status': 'working'},
+        job_ids[2]: {'jobcounter': 2, 'status': 'completed'},
+        job_ids[3]: {'jobcounter': 5, 'status': 'received'},
+        job_ids[4]: {'jobcounter': 4, 'status': 'exception'},
+    }
+    with mock.patch.object(
+        flask_app.sage, 'request_passthrough_result', return_value={'json_result': jobs}
+    ), mock.patch.object(
+        flask_app.sage, 'sync_jobs_detection', return_value=(0, [])
+    ), mock.patch.object(
+        flask_app.sage, 'sync_jobs_identification', return_value=(0, [])
+    ):
+        flask_app.sage.sync_jobs(verbose=False)
+
+    # Sage runs its jobs in jobcounter order, the jobs ahead are the pending jobs
+    # received before, the most recent job has the most jobs ahead
+    assert [queue_position.sage_job_ahead(job_id) for job_id in job_ids] == [
+        1,
+        0,
+        None,
+        2,
+        None,
+    ]
+
+    progress = Progress(description='Test', sage_guid=uuid.UUID(job_ids[3]))
+    assert progress.ahead == 2
+    progress = Progress(description='Test', sage_guid=uuid.UUID(job_ids[1]))
+    assert progress.ahead == 0
@@ -54,3 +54,205 @@ def test_viewpoint_utils():
         assert vp in n
         n = annot.get_neighboring_viewpoints(include_self=False)
         assert vp not in n
+
+
+@pytest.mark.skipif(
+    module_unavailable('annotations'), reason='Annotations module disabled'
+)
+def test_matching_set_cache_key(flask_app, fake_redis):
+    from app.modules.annotations.models import Annotation
+
+    query_a = {'bool': {'filter': [{'match': {'taxonomy_guid': 'abc'}}], 'x': 1}}
+    query_b = {'bool': {'x': 1, 'filter': [{'match': {'taxonomy_guid': 'abc'}}]}}
+    query_c = {'bool': {'filter': [{'match': {'taxonomy_guid': 'xyz'}}]}}
+
+    key = Annotation.get_matching_set_cache_key(query_a)
+    # Key ordering within the query does not matter, the content does
+    assert Annotation.get_matching_set_cache_key(query_b) == key
+    assert Annotation.get_matching_set_cache_key(query_c) != key
+
+    # Invalidation moves every query onto a new cache generation
+    assert Annotation.invalidate_matching_set_cache()
+    assert Annotation.get_matching_set_cache_key(query_a) != key
+
+
+@pytest.mark.skipif(
+    module_unavailable('annotations'), reason='Annotations module disabled'
+)
+def test_matching_set_cache_invalidation(flask_app, fake_redis, monkeypatch):
+    import uuid
+    from unittest import mock
+
+    from app.modules.annotations.models import Annotation
+
+    searches = []
+    indexed = [uuid.uuid4(), uuid.uuid4()]
+
+    def search(cls, query, *args, **kwargs):
+        searches.append(query)
+        return list(indexed)
+
+    monkeypatch.setattr(Annotation, 'elasticsearch', classmethod(search))
+    query = {'bool': {'filter': [{'match': {'taxonomy_guid': 'abc'}}]}}
+    bounds = {'rect': [0, 1, 2, 3]}
+    annot_1 = Annotation(guid=uuid.uuid4(), encounter_guid=uuid.uuid4(), bounds=bounds)
+    annot_2 = Annotation(guid=uuid.uuid4(), encounter_guid=uuid.uuid4(), bounds=bounds)
+
+    # Annotations sharing a query share the cached matching set
+    expected = list(indexed)
+    assert annot_1.get_matching_set(query, load=False) == expected
+    assert annot_2.get_matching_set(query, load=False) == expected
+    assert len(searches) == 1
+
+    # The invalidation is deferred until the transaction is committed
+    with mock.patch.object(
+        Annotation, 'invalidate_matching_set_cache'
+    ) as invalidate_matching_set_cache:
+        from app.extensions import db
+
+        with db.session.begin():
+            Annotation.invalidate_matching_set_cache_on_commit()
+            invalidate_matching_set_cache.assert_not_called()
+        invalidate_matching_set_cache.assert_called_once_with()
+
+    # The invalidation moves the queries onto a new cache generation
+    indexed.pop()
+    assert Annotation.invalidate_matching_set_cache()
+    assert annot_1.get_matching_set(query, load=False) == indexed
+    assert annot_2.get_matching_set(query, load=False) == indexed
+    assert len(searches) == 2
+
+    # Without Redis nothing is cached
+    monkeypatch.setattr(fake_redis, 'get', mock.Mock(side_effect=ConnectionError))
+    assert annot_1.get_matching_set(query, load=False) == indexed
+    assert annot_1.get_matching_set(query, load=False) == indexed
+    assert len(searches) == 4
+
+
+@pytest.mark.skipif(
+    module_unavailable('annotations'), reason='Annotations module disabled'
+)
+def test_matching_set_cache_invalidation_on_commit(db, researcher_1, fake_redis):
+    import tests.utils as test_utils
+    from app.modules.annotations.models import (
+        MATCHING_SET_CACHE_GENERATION_KEY,
+        Annotation,
+    )
+    from app.modules.individuals.models import Individual
+    from app.utils import get_shared_generation
+
+    def generation():
+        return get_shared_generation(MATCHING_SET_CACHE_GENERATION_KEY)
+
+    asset_group = test_utils.generate_asset_group_instance(researcher_1)
+    asset = test_utils.generate_asset_instance(asset_group.guid)
+    encounter = test_utils.generate_owned_encounter(researcher_1)
+    individual = Individual()
+    with db.session.begin():
+        for obj in (asset_group, asset, encounter, individual):
+            db.session.add(obj)
+    objs = [asset_group, asset, encounter, individual]
+
+    try:
+        # Creating an annotation invalidates once committed
+        before = generation()
+        with db.session.begin():
+            annot = Annotation(
+                asset_guid=asset.guid,
+                encounter=encounter,
+                ia_class='test',
+                viewpoint='test',
+                bounds={'rect': [0, 1, 2, 3]},
+            )
+            objs.append(annot)
+            db.session.add(annot)
+            db.session.flush()
+            assert generation() == before
+        assert generation() != before
+
+        # Changes that cannot alter a matching set keep it
+        before = generation()
+        with db.session.begin():
+            annot.ia_class = 'other'
+            db.session.merge(annot)
+        assert generation() == before
+
+        # Viewpoint changes invalidate
+        with db.session.begin():
+            annot.viewpoint = 'left'
+            db.session.merge(annot)
+        assert generation() != before
+
+        # So do individual changes on the encounter
+        before = generation()
+        with db.session.begin():
+            encounter.individual_guid = individual.guid
+            db.session.merge(encounter)
+        assert generation() != before
+
+        # Rolled back changes do not
+        before = generation()
+        db.session.begin()
+        annot.viewpoint = 'right'
+        db.session.merge(annot)
+        db.session.flush()
+        db.session.rollback()
+        assert generation() == before
+    finally:
+        with db.session.begin():
+            for obj in reversed(objs):
+                db.session.delete(obj)
+
+
+@pytest.mark.skipif(
+    module_unavailable('annotations', 'encounters', 'individuals', 'asset_groups'),
+    reason='Annotations module disabled',
+)
+def test_get_individual_guids(db, researcher_1):
+    import uuid
+
+    import tests.utils as test_utils
+    from app.modules.annotations.models import Annotation
+    from app.modules.individuals.models import Individual
+
+    asset_group = test_utils.generate_asset_group_instance(researcher_1)
+    asset = test_utils.generate_asset_instance(asset_group.guid)
+    encounter_1 = test_utils.generate_owned_encounter(researcher_1)
+    encounter_2 = test_utils.generate_owned_encounter(researcher_1)
+    individual = Individual()
+    individual.add_encounter(encounter_1)
+
+    # Annotations of the same content on different encounters
+    content_guid = uuid.uuid4()
+    bounds = {'rect': [0, 1, 2, 3]}
+    annots = [
+        Annotation(
+            asset_guid=asset.guid,
+            encounter=encounter,
+            content_guid=content_guid,
+            ia_class='test',
+            viewpoint='test',
+            bounds=bounds,
+        )
+        for encounter in (encounter_1, encounter_2, None)
+    ]
+    objs = [asset_group, asset, encounter_1, encounter_2, individual] + annots
+    with db.session.begin():
+        for obj in objs:
+            db.session.add(obj)
+
+    try:
+        # Each annotation gets the individual of its own encounter
+        individual_guids = Annotation.get_individual_guids(
+            [annot.guid for annot in annots], chunk_size=2
+        )
+        assert individual_guids == {
+            annots[0].guid: individual.guid,
+            annots[1].guid: None,
+            annots[2].guid: None,
+        }
+        assert Annotation.get_individual_guids([]) == {}
+    finally:
+        with db.session.begin():
+            for obj in reversed(objs):
+                db.session.delete(obj)
@@ -61,6 +61,43 @@ def test_find_asset(
             src_response.close()
 
 
+@pytest.mark.skipif(
+    module_unavailable('asset_groups'), reason='AssetGroups module disabled'
+)
+def test_asset_src_conditional_get(
+    flask_app_client,
+    researcher_1,
+    request,
+    test_root,
+):
+    uuids = asset_group_utils.create_simple_asset_group_uuids(
+        flask_app_client, researcher_1, request, test_root
+    )
+    asset_guid = uuids['assets'][0]
+
+    src_response = asset_utils.read_src_asset(flask_app_client, researcher_1, asset_guid)
+    src_response.close()
+    etag = src_response.headers['ETag']
+    last_modified = src_response.headers['Last-Modified']
+    assert etag
+    assert 'private' in src_response.headers['Cache-Control']
+
+    # A matching ETag or an unchanged modification date short-circuits with a 304
+    for headers in ({'If-None-Match': etag}, {'If-Modified-Since': last_modified}):
+        response = asset_utils.read_src_asset(
+            flask_app_client, researcher_1, asset_guid, 304, headers=headers
+        )
+        assert response.headers['ETag'] == etag
+        assert response.data == b''
+
+    # A stale ETag gets the full image again
+    src_response = asset_utils.read_src_asset(
+        flask_app_client, researcher_1, asset_guid, headers={'If-None-Match': '"stale"'}
+    )
+    src_response.close()
+    assert src_response.content_type == 'image/jpeg'
+
+
 @pytest.mark.skipif(
     module_unavailable('asset_groups'), reason='AssetGroups module disabled'
 )
@@ -49,11 +49,13 @@ def patch_asset_bulk(flask_app_client, user, data, expected_status_code=200):
     return response
 
 
-def read_src_asset(flask_app_client, user, asset_guid, expected_status_code=200):
+def read_src_asset(
+    flask_app_client, user, asset_guid, expected_status_code=200, headers=None
+):
     with flask_app_client.login(user, auth_scopes=('assets:read',)):
-        response = flask_app_client.get(f'{SRC_PATH}{asset_guid}')
+        response = flask_app_client.get(f'{SRC_PATH}{asset_guid}', headers=headers)
 
-    if expected_status_code == 200:
+    if expected_status_code in (200, 304):
         assert response.status_code == expected_status_code
     else:
         test_utils.validate_dict_response(
@@ -205,3 +205,177 @@ def test_derived_images_and_rotation(test_asset_group_uuid, request):
     # The original should be still the same
     with Image.open(zebra.get_original_path()) as im:
         assert im.size == (1000, 664)
+
+
+@pytest.mark.skipif(
+    module_unavailable('asset_groups'), reason='AssetGroups module disabled'
+)
+def test_make_derived_formats(test_asset_group_uuid):
+    from app.modules.asset_groups.models import AssetGroup
+
+    asset_group = AssetGroup.query.get(test_asset_group_uuid)
+    zebra = [
+        asset
+        for asset in asset_group.assets
+        if asset.get_original_filename() == 'zebra.jpg'
+    ][0]
+
+    zebra.reset_derived_images()
+    for format in zebra.FORMATS:
+        assert not zebra.get_derived_path(format).exists()
+
+    paths = zebra.make_derived_formats()
+    assert sorted(paths) == sorted(zebra.PREGENERATED_FORMATS)
+    sizes = {}
+    for format, path in paths.items():
+        with Image.open(path) as im:
+            sizes[format] = im.size
+    assert sizes == {'master': (1000, 664), 'mid': (1000, 664), 'thumb': (256, 170)}
+
+    # abox is drawn from the annotations so is only made when requested
+    assert not zebra.get_derived_path('abox').exists()
+    # No temporary files are left behind
+    derived_files = zebra.get_derived_path('master').parent.glob(f'.{zebra.guid}*')
+    assert list(derived_files) == []
+
+
+@pytest.mark.skipif(
+    module_unavailable('asset_groups'), reason='AssetGroups module disabled'
+)
+def test_bulk_upsert(db, test_empty_asset_group_uuid, request):
+    from app.modules.assets.models import Asset
+
+    def file_data(path, filesystem_guid):
+        return {
+            'path': path,
+            'mime_type': 'image/jpeg',
+            'magic_signature': 'JPEG image data',
+            'size_bytes': 1,
+            'git_store_guid': test_empty_asset_group_uuid,
+            'filesystem_xxhash64': str(filesystem_guid),
+            'filesystem_guid': filesystem_guid,
+            'semantic_guid': uuid.uuid5(
+                test_empty_asset_group_uuid, str(filesystem_guid)
+            ),
+        }
+
+    duplicate_guid = uuid.uuid4()
+    recycle_guid = uuid.uuid4()
+    files = [
+        file_data('a.jpg', uuid.uuid4()),
+        file_data('b.jpg', duplicate_guid),
+        file_data('c.jpg', duplicate_guid),
+    ]
+    files[0]['guid'] = recycle_guid
+
+    assets = Asset.bulk_upsert([dict(data) for data in files])
+    request.addfinalizer(
+        lambda: Asset.query.filter(
+            Asset.guid.in_([asset.guid for asset in assets])
+        ).delete(synchronize_session=False)
+    )
+    assert len(assets) == 3
+    assert assets[0].guid == recycle_guid
+    # Duplicate files share an Asset, updated by the last file
+    assert assets[1] is assets[2]
+    assert assets[1].path == 'c.jpg'
+
+    # Existing Assets are updated and keep their guid
+    files[0]['path'] = 'renamed.jpg'
+    files[0]['guid'] = uuid.uuid4()
+    updated = Asset.bulk_upsert([dict(data) for data in files])
+    assert [asset.guid for asset in updated] == [asset.guid for asset in assets]
+    assert updated[0].guid == recycle_guid
+    assert updated[0].path == 'renamed.jpg'
+
+
+@pytest.mark.skipif(
+    module_unavailable('asset_groups'), reason='AssetGroups module disabled'
+)
+def test_bulk_upsert_indexes(db, test_empty_asset_group_uuid, request):
+    from app.extensions import elasticsearch as es
+    from app.modules.assets.models import Asset
+
+    filesystem_guid = uuid.uuid4()
+    file_data = {
+        'path': 'notes.txt',
+        'mime_type': 'text/plain',
+        'magic_signature': 'ASCII text',
+        'size_bytes': 1,
+        'git_store_guid': test_empty_asset_group_uuid,
+        'filesystem_xxhash64': str(filesystem_guid),
+        'filesystem_guid': filesystem_guid,
+        'semantic_guid': uuid.uuid5(test_empty_asset_group_uuid, str(filesystem_guid)),
+    }
+
+    with mock.patch.object(Asset, '_index_all_chunked') as index_all_chunked:
+        with mock.patch.object(es, 'es_guid_cache_add') as guid_cache_add:
+            (asset,) = Asset.bulk_upsert([dict(file_data)])
+    request.addfinalizer(
+        lambda: Asset.query.filter(Asset.guid == asset.guid).delete(
+            synchronize_session=False
+        )
+    )
+
+    # The created (non-image) Asset is indexed and cached like an ORM insert
+    assert index_all_chunked.call_count == 1
+    assert index_all_chunked.call_args[0][0] == [asset.guid]
+    assert index_all_chunked.call_args[1]['force']
+    guid_cache_add.assert_called_once_with(asset)
+
+    # An existing Asset is indexed by the ORM update hook instead
+    with mock.patch.object(Asset, '_index_all_chunked') as index_all_chunked:
+        assert Asset.bulk_upsert([dict(file_data)]) == [asset]
+    assert index_all_chunked.call_count == 0
+
+
+def test_extract_image_meta(tmp_path):
+    from app.modules.assets.models import extract_image_meta
+
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    exif.get_ifd(0x8769)[0x9003] = '2021:06:05 14:03:22'
+    gps = exif.get_ifd(0x8825)
+    gps.update({1: 'S', 2: (12.0, 30.0, 0.0), 3: 'E', 4: (45.0, 15.0, 36.0)})
+    filepath = tmp_path / 'exif.jpg'
+    Image.new('RGB', (640, 480)).save(filepath, exif=exif)
+
+    assert extract_image_meta(filepath) == {
+        'width': 640,
+        'height': 480,
+        'orientation': 6,
+        'time': '2021-06-05T14:03:22',
+        'gps': {'latitude': -12.5, 'longitude': 45.26},
+    }
+
+    filepath = tmp_path / 'plain.png'
+    Image.new('RGB', (10, 20)).save(filepath)
+    assert extract_image_meta(filepath) == {'width': 10, 'height': 20}
+
+
+def test_set_derived_meta_many(tmp_path):
+    from app import extensions
+    from app.modules.assets import models
+
+    assets, filepaths = [], {}
+    for index in range(4):
+        asset = test_utils.generate_asset_instance(uuid.uuid4())
+        asset.mime_type = 'image/jpeg'
+        filepaths[asset.guid] = tmp_path / f'{index}.jpg'
+        Image.new('RGB', (10 + index, 20)).save(filepaths[asset.guid])
+        assets.append(asset)
+
+    calls = []
+    with mock.patch.object(models, 'ASSET_META_PARALLEL_MIN', 2), mock.patch.object(
+        models.Asset, 'get_symlink', lambda asset: filepaths[asset.guid]
+    ), mock.patch.object(extensions, 'parallel', wraps=extensions.parallel) as parallel:
+        models.Asset.set_derived_meta_many(
+            assets, callback=lambda completed, total: calls.append((completed, total))
+        )
+        # Read on threads, forking the worker is not safe
+        assert parallel.call_args.kwargs['thread'] is True
+
+    assert [asset.meta['derived'] for asset in assets] == [
+        {'width': 10 + index, 'height': 20} for index in range(4)
+    ]
+    assert calls == [(1, 4), (2, 4), (3, 4), (4, 4)]
@@ -169,3 +169,72 @@ def test_fail_create_collaboration(collab_user_a, collab_user_b):
 
     # member that isn't a user
     validate_failure([collab_user_a, 'random string'], collab_user_b)
+
+
+@pytest.mark.skipif(
+    module_unavailable('collaborations'), reason='Collaborations module disabled'
+)
+def test_collaboration_peers_cache(db, collab_user_a, collab_user_b, request, fake_redis):
+    from app.modules.collaborations.models import (
+        COLLABORATION_PEERS_GENERATION_KEY,
+        Collaboration,
+        CollaborationUserState,
+    )
+
+    def generation():
+        return int(fake_redis.get(COLLABORATION_PEERS_GENERATION_KEY) or 0)
+
+    collab = Collaboration([collab_user_a, collab_user_b], collab_user_a)
+    with db.session.begin():
+        db.session.add(collab)
+    request.addfinalizer(collab.delete)
+
+    # User b has not approved yet, warms the cache with no peers
+    assert Collaboration.get_users_for_read(collab_user_a) == []
+    with mock.patch.object(Collaboration, '_query_peer_guids') as query:
+        assert Collaboration.get_users_for_read(collab_user_a) == []
+    query.assert_not_called()
+
+    collab.set_approval_state_for_user(
+        collab_user_b.guid, CollaborationUserState.APPROVED
+    )
+    assert Collaboration.get_users_for_read(collab_user_a) == [collab_user_b]
+    assert Collaboration.get_users_for_read(collab_user_b) == [collab_user_a]
+    assert Collaboration.get_users_for_write(collab_user_a) == []
+
+    collab.set_approval_state_for_user(
+        collab_user_a.guid, CollaborationUserState.APPROVED, is_edit=True
+    )
+    collab.set_approval_state_for_user(
+        collab_user_b.guid, CollaborationUserState.APPROVED, is_edit=True
+    )
+    assert Collaboration.get_peer_guids(collab_user_a.guid)['edit'] == [
+        collab_user_b.guid
+    ]
+
+    # Other processes are only told once the change is committed, the transaction
+    # itself does not use the cache meanwhile
+    association = collab._get_association_for_user(collab_user_b.guid)
+    before = generation()
+    with db.session.begin():
+        association.edit_approval_state = CollaborationUserState.REVOKED
+        db.session.merge(association)
+        db.session.flush()
+        assert Collaboration.get_peer_guids(collab_user_a.guid)['edit'] == []
+        assert generation() == before
+    assert generation() == before + 1
+    assert Collaboration.get_peer_guids(collab_user_a.guid)['edit'] == []
+
+    # and not at all if it is rolled back
+    with pytest.raises(ValueError):
+        with db.session.begin():
+            association.read_approval_state = CollaborationUserState.REVOKED
+            db.session.merge(association)
+            db.session.flush()
+            raise ValueError()
+    db.session.refresh(association)
+    assert generation() == before + 1
+    assert Collaboration.get_users_for_read(collab_user_a) == [collab_user_b]
+
+    collab.set_approval_state_for_user(collab_user_b.guid, CollaborationUserState.REVOKED)
+    assert Collaboration.get_users_for_read(collab_user_a) == []
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+import json
+import time
+import uuid
+from unittest import mock
+
+from etaprogress.eta import ETA
+
+
+def test_eta_serialization():
+    from app.modules.progress.eta_cache import deserialize_eta, serialize_eta
+
+    pgeta = ETA(100, scope=10)
+    for numerator in (5, 10, 20, 35):
+        pgeta.numerator = numerator
+        pgeta._timing_data[-1] = (pgeta._timing_data[-1][0] - 1, numerator)
+
+    data = json.loads(json.dumps(serialize_eta(pgeta)))
+    restored = deserialize_eta(data)
+    assert restored.denominator == pgeta.denominator
+    assert restored._timing_data.maxlen == pgeta._timing_data.maxlen
+    assert list(restored._timing_data) == list(pgeta._timing_data)
+    assert restored.numerator == pgeta.numerator
+    assert restored.eta_epoch == pgeta.eta_epoch
+    assert restored.rate == pgeta.rate
+    assert restored._start_time == pgeta._start_time
+
+    assert serialize_eta(None) is None
+    assert deserialize_eta(None) is None
+
+
+def test_eta_cache_eviction():
+    from app.modules.progress.eta_cache import ETACache
+
+    cache = ETACache(max_size=2, ttl=60)
+    # Only the local copy is used
+    cache.unavailable_until = time.time() + 60
+
+    guids = [str(uuid.uuid4()) for _ in range(3)]
+    for guid in guids[:2]:
+        cache.get(guid)['items'] = [guid]
+    # The least recently used entry is evicted first
+    cache.get(guids[0])
+    cache.get(guids[2])
+    assert list(cache.entries) == [guids[0], guids[2]]
+    assert cache.get(guids[0])['items'] == [guids[0]]
+
+    # Entries not used within the TTL expire
+    cache.entries[guids[0]]['accessed'] -= 60
+    assert cache.get(guids[0])['items'] is None
+    cache.entries[guids[2]]['accessed'] -= 60
+    cache.get(guids[1])
+    assert list(cache.entries) == [guids[0], guids[1]]
+
+    cache.pop(guids[0])
+    assert list(cache.entries) == [guids[1]]
+
+
+def test_eta_cache_sync(fake_redis):
+    from app.modules.progress.eta_cache import ETACache
+
+    # Two processes sharing the same Redis
+    cache_1, cache_2 = ETACache(), ETACache()
+    guid = uuid.uuid4()
+
+    entry_1 = cache_1.get(guid)
+    entry_1['items'] = [1, 2, 3, 4]
+    entry_1['pgeta'] = ETA(4)
+    entry_1['pgeta'].numerator = 1
+    assert cache_1.save(guid)
+    assert entry_1['version'] == 1
+    assert fake_redis.ttl(cache_1._key(guid)) > 0
+
+    entry_2 = cache_2.get(guid)
+    assert entry_2['items'] == [1, 2, 3, 4]
+    assert entry_2['pgeta'].numerator == 1
+    assert entry_2['version'] == 1
+
+    # Updates are picked up with sync, only when there is a newer version
+    entry_2['pgeta'].numerator = 3
+    assert cache_2.save(guid)
+    assert entry_2['version'] == 2
+    assert cache_1.sync(guid)['pgeta'].numerator == 3
+    pgeta = entry_1['pgeta']
+    assert cache_1.sync(guid)['pgeta'] is pgeta
+
+    # The versions come from Redis, they keep increasing whichever process saves
+    assert cache_1.save(guid)
+    assert cache_2.save(guid)
+    assert (entry_1['version'], entry_2['version']) == (3, 4)
+    assert cache_1.sync(guid)['version'] == 4
+
+    # and after the entry was dropped, so the new entry is not ignored
+    cache_1.pop(guid)
+    assert fake_redis.get(cache_1._key(guid)) is None
+    entry_1 = cache_1.get(guid)
+    assert entry_1['items'] is None
+    entry_1['items'] = [1, 2]
+    assert cache_1.save(guid)
+    assert entry_1['version'] == 5
+    assert cache_2.sync(guid)['items'] == [1, 2]
+
+    # Items that are not JSON serializable are only kept locally
+    entry_1['items'] = [object()]
+    assert cache_1.save(guid)
+    assert cache_2.sync(guid)['items'] is None
+    assert cache_2.get(guid)['version'] == 6
+
+
+def test_eta_cache_unavailable(fake_redis):
+    from app.modules.progress.eta_cache import ETACache
+
+    cache = ETACache()
+    guid = uuid.uuid4()
+    with mock.patch.object(fake_redis, 'transaction', side_effect=ConnectionError):
+        cache.get(guid)['items'] = [1]
+        assert not cache.save(guid)
+    # The local copy is used until the retry interval is over
+    assert cache.unavailable_until > time.time()
+    assert not cache.save(guid)
+    assert cache.get(guid)['items'] == [1]
+    assert cache.get(guid)['version'] == 0
+    assert fake_redis.get(cache._key(guid)) is None
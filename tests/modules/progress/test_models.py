@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+from unittest import mock
+
+
+def _create_progresses(db, count, parent=None):
+    from app.modules.progress.models import Progress
+
+    progresses = [
+        Progress(
+            description='Test',
+            parent_guid=None if parent is None else parent.guid,
+        )
+        for _ in range(count)
+    ]
+    with db.session.begin():
+        for progress in progresses:
+            db.session.add(progress)
+    return progresses
+
+
+def _delete(db, progresses):
+    from app.modules.progress.models import ETA_CACHE
+
+    with db.session.begin():
+        for progress in progresses:
+            db.session.delete(progress)
+    for progress in progresses:
+        ETA_CACHE.pop(progress.guid)
+
+
+def test_progress_coalesced(db, fake_redis):
+    from app.modules.progress.models import ETA_CACHE, ProgressStatus
+
+    (progress,) = _create_progresses(db, 1)
+    try:
+        progress.config(list(range(200)))
+
+        # Small and quick updates are only tracked in memory
+        assert progress.set(1, coalesce=True) == 'coalesced'
+        assert progress.set(4, coalesce=True) == 'coalesced'
+        db.session.refresh(progress)
+        assert progress.percentage == 0
+        assert int(progress.pgeta.percent) == 4
+
+        # Written once they move far enough
+        assert progress.set(5, coalesce=True) == 'set'
+        db.session.refresh(progress)
+        assert progress.percentage == 5
+
+        # or once enough time has passed since the last write
+        assert progress.set(6, coalesce=True) == 'coalesced'
+        written_time, written_percentage = ETA_CACHE.get(progress.guid)['written']
+        ETA_CACHE.get(progress.guid)['written'] = (written_time - 2, written_percentage)
+        assert progress.set(6, coalesce=True) == 'set'
+
+        # Iterating coalesces too
+        for _ in range(4):
+            progress.iterate()
+        db.session.refresh(progress)
+        assert progress.percentage == 6
+        assert progress.pgeta.numerator == 16
+
+        # Uncoalesced updates are always written
+        assert progress.set(7) == 'set'
+        db.session.refresh(progress)
+        assert progress.percentage == 7
+
+        # Completing the progress is always written
+        assert progress.set(100, coalesce=True) == 'set'
+        db.session.refresh(progress)
+        assert progress.percentage == 100
+        assert progress.status == ProgressStatus.completed
+        assert ETA_CACHE.get(progress.guid)['written'] is None
+    finally:
+        _delete(db, [progress])
+
+
+def test_progress_notify_on_status_change(db, fake_redis):
+    from app.modules.progress.models import Progress, ProgressStatus
+
+    (parent,) = _create_progresses(db, 1)
+    steps = _create_progresses(db, 3, parent=parent)
+    try:
+        with mock.patch.object(
+            Progress, 'notify', autospec=True, side_effect=Progress.notify
+        ) as notify:
+            # The first update of a step starts it, which is a status change
+            steps[0].set(10)
+            assert notify.call_count == 1
+            db.session.refresh(parent)
+            assert parent.status == ProgressStatus.healthy
+            assert parent.percentage == 0
+
+            # Only the percentage changes, the parent is not notified
+            steps[0].set(50)
+            for _ in range(10):
+                steps[0].set(60, coalesce=True)
+            assert notify.call_count == 1
+
+            # Completed, cancelled and skipped steps count as done
+            steps[0].set(100)
+            steps[1].skip()
+            assert notify.call_count == 3
+            db.session.refresh(parent)
+            assert parent.percentage == 66
+            assert parent.status == ProgressStatus.healthy
+
+            # A failed step fails the parent
+            steps[2].set(10)
+            steps[2].fail('Step failed')
+            assert notify.call_count == 5
+            db.session.refresh(parent)
+            assert parent.status == ProgressStatus.failed
+            assert 'Step failed' in parent.message
+    finally:
+        _delete(db, steps + [parent])
+
+
+def test_progress_notify_counts_steps(db, fake_redis):
+    from app.modules.progress.models import ProgressStatus
+
+    (parent,) = _create_progresses(db, 1)
+    steps = _create_progresses(db, 4, parent=parent)
+    try:
+        with db.session.begin():
+            steps[0].status = ProgressStatus.completed
+            steps[0].percentage = 100
+            steps[1].status = ProgressStatus.cancelled
+            # Healthy, but not done yet
+            steps[2].status = ProgressStatus.healthy
+            steps[2].percentage = 99
+            for step in steps[:3]:
+                db.session.merge(step)
+
+        parent.notify(steps[0].guid)
+        db.session.refresh(parent)
+        assert parent.percentage == 50
+        assert parent.pgeta.numerator == 2
+        assert parent.pgeta.denominator == 4
+        assert parent.status == ProgressStatus.healthy
+
+        steps[3].set(100)
+        db.session.refresh(parent)
+        assert parent.percentage == 75
+    finally:
+        _delete(db, steps + [parent])
@@ -80,3 +80,105 @@ def test_get_value(db, flask_app):
     guid_setting = SiteSetting.query.get('system_guid')
     assert guid_setting is not None
     db.session.delete(guid_setting)
+
+
+def test_value_cache(db):
+    key = 'email_title_greeting'
+    setting = SiteSetting.set_key_value(key, 'Hello')
+    try:
+        assert SiteSetting.get_value(key) == 'Hello'
+
+        # Change made by another worker, not seen until the generation is bumped
+        with db.session.begin():
+            db.session.execute(
+                SiteSetting.__table__.update()
+                .where(SiteSetting.__table__.c.key == key)
+                .values(string='Bonjour')
+            )
+        if SiteSetting._get_generation() is not None:
+            assert SiteSetting.get_value(key) == 'Hello'
+        db.session.expire(setting)
+        SiteSetting.bump_generation()
+        assert SiteSetting.get_value(key) == 'Bonjour'
+
+        SiteSetting.forget_key_value(key)
+        assert SiteSetting.get_value(key) == SiteSetting._get_default_value(key)
+    finally:
+        setting = SiteSetting.query.get(key)
+        if setting:
+            db.session.delete(setting)
+
+
+def test_value_cache_bumped_on_commit(db, fake_redis):
+    from app.modules.site_settings.models import SITE_SETTINGS_GENERATION_KEY
+
+    def generation():
+        return int(fake_redis.get(SITE_SETTINGS_GENERATION_KEY) or 0)
+
+    key = 'email_title_greeting'
+    SiteSetting.set_key_value(key, 'Hello')
+    try:
+        before = generation()
+        assert SiteSetting.get_value(key) == 'Hello'
+
+        # Other workers are only told once the change is committed, the transaction
+        # itself reads its own changes meanwhile
+        with db.session.begin():
+            SiteSetting.set_key_value(key, 'Bonjour')
+            assert SiteSetting.get_value(key) == 'Bonjour'
+            assert generation() == before
+        assert generation() == before + 1
+        assert SiteSetting.get_value(key) == 'Bonjour'
+
+        # and not at all if it is rolled back
+        with pytest.raises(ValueError):
+            with db.session.begin():
+                SiteSetting.set_key_value(key, 'Hola')
+                raise ValueError()
+        assert generation() == before + 1
+        assert SiteSetting.get_value(key) == 'Bonjour'
+    finally:
+        setting = SiteSetting.query.get(key)
+        if setting:
+            db.session.delete(setting)
+
+
+def test_value_cache_generation_check_interval(db, fake_redis, monkeypatch):
+    from app.modules.site_settings import models
+    from app.modules.site_settings.models import SITE_SETTINGS_GENERATION_KEY
+
+    now = [1000.0]
+    monkeypatch.setattr(models.time, 'monotonic', lambda: now[0])
+    reads = []
+    get = fake_redis.get
+    monkeypatch.setattr(fake_redis, 'get', lambda key: reads.append(key) or get(key))
+
+    key = 'email_title_greeting'
+    setting = SiteSetting.set_key_value(key, 'Hello')
+    try:
+        assert SiteSetting.get_value(key) == 'Hello'
+        assert SiteSetting.get_value(key) == 'Hello'
+        assert reads.count(SITE_SETTINGS_GENERATION_KEY) == 1
+
+        # Change made by another worker, only checked for once the interval elapsed
+        with db.session.begin():
+            db.session.execute(
+                SiteSetting.__table__.update()
+                .where(SiteSetting.__table__.c.key == key)
+                .values(string='Bonjour')
+            )
+        db.session.expire(setting)
+        fake_redis.incr(SITE_SETTINGS_GENERATION_KEY)
+        assert SiteSetting.get_value(key) == 'Hello'
+        assert reads.count(SITE_SETTINGS_GENERATION_KEY) == 1
+        now[0] += models.SITE_SETTINGS_GENERATION_CHECK_INTERVAL
+        assert SiteSetting.get_value(key) == 'Bonjour'
+        assert reads.count(SITE_SETTINGS_GENERATION_KEY) == 2
+
+        # Changes made by this worker are seen right away
+        SiteSetting.set_key_value(key, 'Hola')
+        assert SiteSetting.get_value(key) == 'Hola'
+    finally:
+        setting = SiteSetting.query.get(key)
+        if setting:
+            db.session.delete(setting)
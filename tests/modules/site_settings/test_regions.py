@@ -72,3 +72,32 @@ def test_regions():
     found = regions.find_fuzzy_list(['BE-3', 'pots', 'foo'])
     assert found
     assert found[0].get('id') == parent3
+
+
+def test_site_regions(db):
+    from app.modules.site_settings.models import Regions, SiteSetting
+
+    old_value = SiteSetting.get_value('site.custom.regions')
+    try:
+        SiteSetting.set_key_value(
+            'site.custom.regions',
+            {'id': 'top', 'locationID': [{'id': 'region-1', 'name': 'Region 1'}]},
+        )
+        regions = Regions.get_site_regions()
+        assert Regions.is_region_guid_valid('region-1')
+        assert Regions.get_region_name('region-1') == 'Region 1'
+        if SiteSetting._get_generation() is not None:
+            # Indexed once, until the setting changes
+            assert Regions.get_site_regions() is regions
+
+        SiteSetting.set_key_value(
+            'site.custom.regions',
+            {'id': 'top', 'locationID': [{'id': 'region-2', 'name': 'Region 2'}]},
+        )
+        assert not Regions.is_region_guid_valid('region-1')
+        assert Regions.get_region_name('region-2') == 'Region 2'
+    finally:
+        if old_value:
+            SiteSetting.set_key_value('site.custom.regions', old_value)
+        else:
+            SiteSetting.forget_key_value('site.custom.regions')
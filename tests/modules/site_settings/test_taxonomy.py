@@ -26,3 +26,104 @@ def test_taxonomy(flask_app_client, admin_user):
     tx = Taxonomy.find_fuzzy_list(['cow', 'a' + conf_tx['scientificName'], 'cat'])
     assert len(tx) == 1
     assert tx[0].scientificName == conf_tx['scientificName']
+
+
+def test_fuzzy_match_index():
+    from app.utils import FuzzyMatchIndex, fuzzy_match
+
+    candidates = {
+        'zebra': 'Plains Zebra Equus quagga',
+        'giraffe': 'Giraffe Giraffa camelopardalis',
+        'dolphin': 'Bottlenose Dolphin Tursiops truncatus',
+    }
+    matches = ['zebra', 'girafe', 'tursiops', 'cow']
+
+    index = FuzzyMatchIndex(candidates)
+    results = index.match_many(matches)
+    for match, result in zip(matches, results):
+        assert result == fuzzy_match(match, candidates)
+        assert [res['score'] for res in result] == sorted(
+            (res['score'] for res in result), reverse=True
+        )
+    assert [result[0]['id'] for result in results[:3]] == ['zebra', 'giraffe', 'dolphin']
+
+    # Same best matches when the pairs below the cutoff are not scored
+    best = index.match_many(matches, limit=1, score_cutoff=120)
+    assert best == [
+        [res for res in result[:1] if res['score'] >= 120] for result in results
+    ]
+
+
+def test_fuzzy_match_scores():
+    from app.utils import FuzzyMatchIndex, fuzzy_match
+
+    candidates = {
+        'zebra': 'Grevy zebra Equus grevyi',
+        'giraffe': 'Giraffe Giraffa camelopardalis',
+        'dolphin': 'Bottlenose Dolphin Tursiops truncatus',
+        'whale': 'Humpback Whale Megaptera novaeangliae',
+    }
+    index = FuzzyMatchIndex(candidates)
+
+    def best(matches, score_cutoff):
+        results = index.match_many(matches, limit=1, score_cutoff=score_cutoff)
+        return [[(res['id'], res['score']) for res in result] for result in results]
+
+    # Scores are fuzzywuzzy's, the cutoffs below are tuned for them (rapidfuzz's
+    # partial_ratio would score e.g. 'girafe' 124 and 'humpbak' 124)
+    assert best(['girafe', 'humpbak', 'turisops', 'grevys'], 120) == [
+        [],
+        [],
+        [],
+        [('zebra', 123)],
+    ]
+    assert best(['camelopard', 'novaeangliae'], 150) == [[('giraffe', 150)], []]
+
+    scores = {res['id']: res['score'] for res in fuzzy_match('cow', candidates)}
+    assert scores['dolphin'] == 38
+    scores = {res['id']: res['score'] for res in fuzzy_match('girafe', candidates)}
+    assert scores['giraffe'] == 116
+
+
+def test_fuzzy_match_pruning():
+    import random
+
+    from fuzzywuzzy import fuzz
+
+    from app.utils import FuzzyMatchIndex
+
+    # Candidates pruned by the score bounds must never change the results, compare
+    # with every pair scored by fuzzywuzzy, including empty, equal, accented and long
+    # (more than FUZZY_MATCH_EXACT_NEEDLE characters) strings
+    rng = random.Random(7)
+
+    def word(length):
+        return ''.join(rng.choice('abcde fgé') for _ in range(rng.randint(0, length)))
+
+    for _ in range(50):
+        texts = [word(rng.choice([8, 30, 90])) for _ in range(rng.randint(1, 30))]
+        texts += rng.sample(texts, min(3, len(texts)))
+        queries = [word(rng.choice([5, 12, 80])) for _ in range(5)]
+        queries += rng.sample(texts, 2)
+        index = FuzzyMatchIndex(texts)
+
+        for limit in (None, 1, 3):
+            for score_cutoff in (0, 100, 120, 150):
+                expected = []
+                for query in queries:
+                    scores = [
+                        (fuzz.partial_ratio(query, text) + fuzz.ratio(query, text), i)
+                        for i, text in enumerate(texts)
+                    ]
+                    scores.sort(key=lambda item: (-item[0], item[1]))
+                    expected.append(
+                        [
+                            {'text': texts[i], 'score': score}
+                            for score, i in scores
+                            if score >= score_cutoff
+                        ][:limit]
+                    )
+                results = index.match_many(
+                    queries, limit=limit, score_cutoff=score_cutoff
+                )
+                assert results == expected
@@ -622,3 +622,86 @@ def test_admin_user_and_staff_access(
         flask_app_client, staff_user, encounter_id
     ).json
     assert enc_resp['locationId'] == region1_id
+
+
+@pytest.mark.skipif(
+    module_unavailable('collaborations', 'encounters'),
+    reason='Collaborations or Encounters module disabled',
+)
+def test_permission_context(flask_app, db, collab_user_a, collab_user_b, request):
+    from app.modules.collaborations.models import Collaboration, CollaborationUserState
+    from app.modules.encounters.models import Encounter
+    from app.modules.users.permissions.rules import ObjectActionRule, PermissionContext
+
+    encounters = [Encounter(owner=collab_user_b) for _ in range(3)]
+    with db.session.begin():
+        db.session.add_all(encounters)
+    for encounter in encounters:
+        request.addfinalizer(encounter.delete)
+
+    def can_read_all():
+        return all(
+            ObjectActionRule(encounter, AccessOperation.READ, collab_user_a).check()
+            for encounter in encounters
+        )
+
+    with flask_app.test_request_context('/'):
+        assert not can_read_all()
+        context = PermissionContext.get(collab_user_a)
+        # The collaborators were only looked up for the first encounter
+        assert (context.hits, context.misses) == (2, 1)
+
+        # Approving the collaboration invalidates the cached collaborators
+        collab = Collaboration([collab_user_a, collab_user_b], collab_user_a)
+        with db.session.begin():
+            db.session.add(collab)
+        request.addfinalizer(collab.delete)
+        with db.session.begin():
+            for association in collab.collaboration_user_associations:
+                association.read_approval_state = CollaborationUserState.APPROVED
+                db.session.merge(association)
+        assert can_read_all()
+        assert context.misses == 2
+
+    # Outside of a request there is no context, but the answer is the same
+    assert PermissionContext.get(collab_user_a) is None
+    assert can_read_all()
+
+
+@pytest.mark.skipif(
+    module_unavailable('collaborations', 'encounters'),
+    reason='Collaborations or Encounters module disabled',
+)
+def test_filter_query_matches_check(
+    db, collab_user_a, collab_user_b, researcher_1, request
+):
+    from app.modules.collaborations.models import Collaboration, CollaborationUserState
+    from app.modules.encounters.models import Encounter
+    from app.modules.users.models import User
+    from app.modules.users.permissions.rules import ObjectActionRule
+
+    owners = [collab_user_a, collab_user_b, researcher_1, User.get_public_user()]
+    encounters = [Encounter(owner=owner) for owner in owners]
+    with db.session.begin():
+        db.session.add_all(encounters)
+    for encounter in encounters:
+        request.addfinalizer(encounter.delete)
+
+    collab = Collaboration([collab_user_a, collab_user_b], collab_user_a)
+    with db.session.begin():
+        db.session.add(collab)
+        for association in collab.collaboration_user_associations:
+            association.read_approval_state = CollaborationUserState.APPROVED
+    request.addfinalizer(collab.delete)
+
+    guids = [encounter.guid for encounter in encounters]
+    for user in (collab_user_a, collab_user_b, researcher_1):
+        for action in (AccessOperation.READ, AccessOperation.WRITE):
+            query = Encounter.query.filter(Encounter.guid.in_(guids))
+            permitted = ObjectActionRule.filter_query(Encounter, user, action, query)
+            expected = {
+                encounter.guid
+                for encounter in encounters
+                if ObjectActionRule(encounter, action, user).check()
+            }
+            assert {encounter.guid for encounter in permitted} == expected